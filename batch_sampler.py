@@ -0,0 +1,106 @@
+from torch.utils.data import Sampler
+import numpy as np
+import math
+
+def get_padding_ratio(lengths, batches):
+    """ Get the fraction of padding tokens in padded batches
+
+    :param lengths: token lengths of each example, 2d with one column per separately padded text
+    :param batches: list of example index lists
+    :return: padding tokens / all tokens
+    """
+    lengths = np.asarray(lengths).reshape(len(lengths), -1)
+    num_tokens = 0
+    num_padded = 0
+    for batch in batches:
+        batch_lengths = lengths[batch]
+        num_tokens += batch_lengths.sum()
+        num_padded += len(batch) * batch_lengths.max(axis=0).sum()
+    return 1 - num_tokens / num_padded if num_padded else 0.0
+
+class LengthBucketSampler(Sampler):
+    """ Batch sampler grouping examples of similar token length, so that batches are padded less.
+    With shuffle, examples are shuffled, split into buckets of bucket_size batches, sorted by length
+    within each bucket, and the batches of all buckets are shuffled, so batch composition and order
+    stay random across buckets. Without shuffle, batches are cut from examples sorted by length.
+
+    :param lengths: token lengths of each example, 2d with one column per separately padded text
+    :param batch_size: number of examples per batch
+    :param bucket_size: number of batches per bucket
+    :param shuffle: shuffle examples and batches every epoch
+    :param seed: random seed, combined with the epoch number
+    :param num_replicas: number of distributed workers the batches are sharded over
+    :param rank: rank of the worker iterating over its shard
+    """
+    def __init__(self, lengths, batch_size, bucket_size=100, shuffle=True, seed=0, num_replicas=1, rank=0):
+        self.lengths = np.asarray(lengths).reshape(len(lengths), -1)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """ Set the epoch number of the next iteration, iterations advance it by one
+
+        :param epoch: epoch number
+        :param start: number of batches of the epoch to skip, to resume an interrupted epoch
+        """
+        self.epoch = epoch
+        self.start = start
+
+    def get_batches(self, epoch):
+        """ Get the batches of an epoch of this worker. Every worker computes the same batches
+        and takes every num_replicas-th one, wrapping around so that all workers get as many batches.
+
+        :param epoch: epoch number
+        :return: list of example index arrays
+        """
+        batches = self.get_all_batches(epoch)
+        if self.num_replicas > 1:
+            batches = batches + batches[:len(self) * self.num_replicas - len(batches)]
+            batches = batches[self.rank::self.num_replicas]
+        return batches
+
+    def get_all_batches(self, epoch):
+        """ Get the batches of an epoch of all workers
+
+        :param epoch: epoch number
+        :return: list of example index arrays
+        """
+        sort_lengths = self.lengths.sum(axis=1)
+        if not self.shuffle:
+            order = np.argsort(sort_lengths, kind='stable')
+            return [order[start:start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+
+        rng = np.random.default_rng([self.seed, epoch])
+        order = rng.permutation(len(sort_lengths))
+        bucket_length = self.batch_size * self.bucket_size
+
+        batches = []
+        for start in range(0, len(order), bucket_length):
+            bucket = order[start:start + bucket_length]
+            bucket = bucket[np.argsort(sort_lengths[bucket], kind='stable')]
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+        return [batches[i] for i in rng.permutation(len(batches))]
+
+    def get_padding_ratio(self, epoch=None):
+        """ Get the fraction of padding tokens in the batches of an epoch
+
+        :param epoch: epoch number, defaults to the next epoch
+        :return: padding tokens / all tokens
+        """
+        return get_padding_ratio(self.lengths, self.get_batches(self.epoch if epoch is None else epoch))
+
+    def __iter__(self):
+        batches = self.get_batches(self.epoch)[self.start:]
+        self.epoch += 1
+        self.start = 0
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        return math.ceil(math.ceil(len(self.lengths) / self.batch_size) / self.num_replicas)
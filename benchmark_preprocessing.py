@@ -0,0 +1,127 @@
+""" Micro-benchmark of the data-preparation row builders and deduplication against the iterrows loops and list scans they replaced,
+    run on the bundled CovidFAQ / StackFAQ data from the project root: python benchmark_preprocessing.py
+"""
+from training_data_generator import Training_Data_Generator
+from faq_bert_finetuning import FAQ_BERT_Finetuning
+from sentence_transformers.readers import InputExample
+from parser.covidfaq import CovidFAQ_Parser
+from parser.stackfaq import StackFAQ_XML_Parser
+from shared.utils import load_from_json
+from types import SimpleNamespace
+import pandas as pd
+import timeit
+
+def iterrows_pos_labels(query_answer_pairs, query_type):
+    """ Training_Data_Generator.generate_pos_labels as an iterrows loop """
+    qap_df = pd.DataFrame.from_records(query_answer_pairs)
+    qap_by_query_type = qap_df[qap_df['query_type'] == query_type]
+
+    pos_labels = []
+    for _, row in qap_by_query_type.iterrows():
+        pos_labels.append({
+            "id": row['id'],
+            "label": 1,
+            "question": row['question'],
+            "answer": row['answer'],
+            "query_type": row['query_type']
+        })
+    return pos_labels
+
+def iterrows_faq_pairs(df):
+    """ CovidFAQ_Parser.extract_pairs(df, 'faq') as an iterrows loop, with the same hash set deduplication """
+    qa_pairs = []
+    seen = set()
+    for _, row in df[['question', 'answer']].iterrows():
+        key = (row["question"], row["answer"])
+        if key not in seen:
+            seen.add(key)
+            qa_pairs.append({"label": 1, "query_type": "faq", "question": row["question"], "answer": row["answer"]})
+    return qa_pairs
+
+def scan_dedup_faq_pairs(df):
+    """ CovidFAQ_Parser.extract_pairs(df, 'faq') with the list-scan deduplication it replaced """
+    pairs = []
+    for question, answer in zip(df['question'].tolist(), df['answer'].tolist()):
+        pair = {"label": 1, "query_type": "faq", "question": question, "answer": answer}
+        if pair not in pairs:
+            pairs.append(pair)
+    return pairs
+
+def iterrows_triplets(df):
+    """ FAQ_BERT_Finetuning.generate_triplets(df) of triplet loss as an iterrows loop """
+    triplets = []
+    for _, row in df.iterrows():
+        triplets.append(InputExample(texts=[row['question'], row['positive'], row['negative']], label=0))
+    return triplets
+
+def get_example_fields(examples):
+    """ Get comparable texts and labels of InputExample list """
+    return [(example.texts, example.label) for example in examples]
+
+def get_datasets():
+    """ Load bundled query answer pairs
+
+    :return: dictionary (dataset name: key, query answer pairs: value)
+    """
+    stackfaq_parser = StackFAQ_XML_Parser()
+    return {
+        "CovidFAQ": load_from_json("data/CovidFAQ/query_answer_pairs.json"),
+        "StackFAQ": stackfaq_parser.extract_query_answer_pairs(load_from_json("data/StackFAQ/stackExchange-FAQ.json"))
+    }
+
+def get_triplet_df(query_answer_pairs):
+    """ Build a triplet dataframe pairing each question with the next answer as negative """
+    df = pd.DataFrame.from_records(query_answer_pairs)
+    return pd.DataFrame({
+        "question": df['question'],
+        "positive": df['answer'],
+        "negative": df['answer'].shift(-1).fillna("")
+    })
+
+def run(name, legacy, vectorized, number=5, normalize=None):
+    """ Time legacy and vectorized builders, checking they build the same records
+
+    :param normalize: function applied to both outputs before comparing them
+    :return: dictionary of timings
+    """
+    normalize = normalize or (lambda records: records)
+    if normalize(legacy()) != normalize(vectorized()):
+        raise ValueError("error, {} builders disagree".format(name))
+    legacy_time = min(timeit.repeat(legacy, number=1, repeat=number))
+    vectorized_time = min(timeit.repeat(vectorized, number=1, repeat=number))
+    return {
+        "Benchmark": name,
+        "before (ms)": round(legacy_time * 1000, 2),
+        "after (ms)": round(vectorized_time * 1000, 2),
+        "Speedup": round(legacy_time / vectorized_time, 1)
+    }
+
+if __name__ == "__main__":
+
+    rows = []
+    for dataset, query_answer_pairs in get_datasets().items():
+        df = pd.DataFrame.from_records(query_answer_pairs)
+        triplet_df = get_triplet_df(query_answer_pairs)
+        tdg = Training_Data_Generator(query_type='faq')
+        # generate_triplets only reads loss_type, the BERT model built by __init__ is not needed
+        finetuning = SimpleNamespace(loss_type='triplet')
+
+        rows.append(run(
+            dataset + " generate_pos_labels",
+            lambda: iterrows_pos_labels(query_answer_pairs, 'faq'),
+            lambda: tdg.generate_pos_labels(query_answer_pairs)
+        ))
+        rows.append(run(
+            dataset + " extract_pairs (faq)", lambda: iterrows_faq_pairs(df), lambda: CovidFAQ_Parser().extract_pairs(df, 'faq')
+        ))
+        rows.append(run(
+            dataset + " extract_pairs dedup", lambda: scan_dedup_faq_pairs(df), lambda: CovidFAQ_Parser().extract_pairs(df, 'faq')
+        ))
+        rows.append(run(
+            dataset + " generate_triplets",
+            lambda: iterrows_triplets(triplet_df),
+            lambda: FAQ_BERT_Finetuning.generate_triplets(finetuning, triplet_df),
+            normalize=get_example_fields
+        ))
+
+    print(pd.DataFrame(rows).to_string(index=False))
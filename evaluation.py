@@ -1,10 +1,18 @@
-from sklearn.metrics import average_precision_score
-from sklearn.metrics import ndcg_score
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from shared.utils import load_from_json
+from shared.utils import dump_to_json
+from shared.utils import load_from_jsonl
+from shared.utils import load_from_parquet
+from shared.utils import load_parquet_columns
+from tqdm import tqdm
 import textdistance
 import pandas as pd
 import numpy as np
+import threading
+import logging
+import psutil
 import os.path
+import time
 
 pd.set_option('display.max_rows', 100)
 
@@ -37,6 +45,455 @@ def get_relevance_label(relevance_label_df):
     relevance_label = relevance_label_df.groupby(['query_string'])['answer'].apply(list).to_dict()
     return relevance_label
 
+class Qrels(object):
+    """ Relevance judgments index with interned query and answer ids
+
+    Query strings and answers are mapped once to integer ids, so that
+    relevance checks are O(1) set lookups on (query id, answer id) pairs.
+
+    :param relevance_label_df: dataframe of relevance labels
+    """
+    def __init__(self, relevance_label_df=None):
+        self.query2id = dict()
+        self.answer2id = dict()
+        self.pairs = set()
+
+        if relevance_label_df is not None:
+            query_col = 'query_string' if 'query_string' in relevance_label_df.columns else 'question'
+            self.add_pairs(relevance_label_df[query_col].tolist(), relevance_label_df['answer'].tolist())
+
+    def add_pairs(self, query_strings, answers):
+        """ Add relevant query-answer pairs
+
+        :param query_strings: list of query strings
+        :param answers: list of relevant answers
+        """
+        for query_string, answer in zip(query_strings, answers):
+            query_id = self.query2id.setdefault(query_string, len(self.query2id))
+            answer_id = self.answer2id.setdefault(answer, len(self.answer2id))
+            self.pairs.add((query_id, answer_id))
+
+    def get_answer_ids(self, answers):
+        """ Map answers to their interned ids, once per answer list
+
+        :param answers: list of answers
+        :return: list of answer ids, None for unjudged answers
+        """
+        return [self.answer2id.get(answer) for answer in answers]
+
+    def is_relevant_id(self, query_id, answer_id):
+        """ Check if an interned answer id is a true answer of an interned query id
+
+        :param query_id: query id
+        :param answer_id: answer id
+        :return: boolean
+        """
+        return (query_id, answer_id) in self.pairs
+
+    def is_relevant(self, query_string, answer):
+        """ Check if answer is a true answer of query string
+
+        :param query_string: query string
+        :param answer: answer
+        :return: boolean
+        """
+        return self.is_relevant_id(self.query2id.get(query_string), self.answer2id.get(answer))
+
+    def get_label(self, query_string, answer):
+        """ Get relevance label of a query-answer pair
+
+        :param query_string: query string
+        :param answer: answer
+        :return: 1 if answer is a true answer, else 0
+        """
+        return 1 if self.is_relevant(query_string, answer) else 0
+
+    def __contains__(self, query_string):
+        return query_string in self.query2id
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def dump(self, filepath):
+        """ Dump qrels to json file with interned ids
+
+        :param filepath: filepath name
+        """
+        data = {
+            "queries": list(self.query2id.keys()),
+            "answers": list(self.answer2id.keys()),
+            "pairs": sorted(self.pairs)
+        }
+        dump_to_json(data, filepath, indent=None, sort_keys=False)
+
+def load_qrels(filepath):
+    """ Load qrels dumped by Qrels.dump
+
+    :param filepath: filepath name
+    :return: Qrels
+    """
+    data = load_from_json(filepath)
+    qrels = Qrels()
+    qrels.query2id = {query_string: i for i, query_string in enumerate(data['queries'])}
+    qrels.answer2id = {answer: i for i, answer in enumerate(data['answers'])}
+    qrels.pairs = set(map(tuple, data['pairs']))
+    return qrels
+
+def get_qrels(query_answer_pair_filepath, qrels_filepath=None):
+    """ Get qrels of a dataset, built once and persisted to qrels_filepath
+    (e.g. data/CovidFAQ/qrels.json), and rebuilt when query_answer_pairs.json is newer
+
+    :param query_answer_pair_filepath: filepath to query_answer_pairs.json
+    :param qrels_filepath: filepath to persisted qrels
+    :return: Qrels
+    """
+    if qrels_filepath and os.path.isfile(qrels_filepath) and \
+            os.path.getmtime(qrels_filepath) >= os.path.getmtime(query_answer_pair_filepath):
+        return load_qrels(qrels_filepath)
+
+    qrels = Qrels(get_relevance_label_df(query_answer_pair_filepath))
+    if qrels_filepath:
+        qrels.dump(qrels_filepath)
+    return qrels
+
+def load_rank_results(result_filepath):
+    """ Load rank results from json or parquet file, or read them incrementally from JSONL file
+
+    :param result_filepath: filepath to rank results (.json, .jsonl or .parquet)
+    :return: iterable of query strings and associated top-k predictions
+    """
+    if result_filepath.endswith(".jsonl"):
+        return load_from_jsonl(result_filepath)
+    if result_filepath.endswith(".parquet"):
+        return load_from_parquet(result_filepath)
+    return load_from_json(result_filepath)
+
+def get_parquet_rank_arrays(result_filepath, valid_queries):
+    """ Load padded label and score arrays of valid queries from the typed columns
+    of a parquet rank result file, without materializing the texts
+
+    :param result_filepath: filepath to parquet rank results
+    :param valid_queries: query strings to evaluate
+    :return: query strings, labels, scores (num_queries x max_len), number of results per query
+    """
+    columns, _ = load_parquet_columns(result_filepath, columns=["query_string", "rank", "label", "score"])
+    # queries without predictions have a single row with null rank, and no label and score columns if all are empty
+    ranks = columns['rank'].fill_null(-1).to_numpy()
+    labels = columns['label'].fill_null(0).to_numpy().astype(float) if 'label' in columns else np.zeros(len(ranks))
+    scores = columns['score'].fill_null(0).to_numpy() if 'score' in columns else np.zeros(len(ranks))
+
+    # rows of a query are contiguous and start at rank 0, or at a null rank
+    starts = np.flatnonzero(ranks <= 0)
+    lengths = np.diff(np.append(starts, len(ranks)))
+    lengths[ranks[starts] < 0] = 0
+
+    query_column = columns['query_string']
+    dictionary = query_column.dictionary.to_pylist()
+    query_strings = [dictionary[i] for i in query_column.indices.to_numpy()[starts]]
+    valid = np.array([query_string in valid_queries for query_string in query_strings], dtype=bool)
+
+    max_len = int(lengths.max()) if len(lengths) else 0
+    rows = np.cumsum(ranks <= 0) - 1
+    preds = ranks >= 0
+    label_array = np.zeros((len(starts), max_len))
+    score_array = np.full((len(starts), max_len), -np.inf)
+    label_array[rows[preds], ranks[preds]] = labels[preds]
+    score_array[rows[preds], ranks[preds]] = scores[preds]
+
+    query_strings = [query_string for query_string, v in zip(query_strings, valid) if v]
+    return query_strings, label_array[valid], score_array[valid], lengths[valid]
+
+def get_rank_arrays(query_results, valid_queries):
+    """ Load rank results of valid queries into padded label and score arrays
+
+    :param query_results: iterable of query strings and associated rerank_preds
+    :param valid_queries: query strings to evaluate
+    :return: query strings, labels, scores (num_queries x max_len), number of results per query
+    """
+    query_strings = []
+    rows = []
+    for result in query_results:
+        if result['query_string'] in valid_queries:
+            query_strings.append(result['query_string'])
+            # keep only labels and scores, so results can be read one at a time
+            rows.append((
+                [topk['label'] for topk in result['rerank_preds']],
+                [topk['score'] for topk in result['rerank_preds']]
+            ))
+
+    lengths = np.array([len(row_labels) for row_labels, _ in rows], dtype=int)
+    max_len = int(lengths.max()) if len(rows) else 0
+
+    # pad labels with 0 and scores with -inf so padding ranks last
+    labels = np.zeros((len(rows), max_len))
+    scores = np.full((len(rows), max_len), -np.inf)
+    for i, (row_labels, row_scores) in enumerate(rows):
+        labels[i, :lengths[i]] = row_labels
+        scores[i, :lengths[i]] = row_scores
+
+    return query_strings, labels, scores, lengths
+
+def get_tie_groups(labels, scores):
+    """ Sort each row by descending score and group tied scores
+
+    :param labels: padded label array
+    :param scores: padded score array
+    :return: sorted labels, group start mask, group end mask, flat group ids
+    """
+    order = np.argsort(-scores, axis=1, kind='stable')
+    labels = np.take_along_axis(labels, order, axis=1)
+    scores = np.take_along_axis(scores, order, axis=1)
+
+    start = np.ones(scores.shape, dtype=bool)
+    start[:, 1:] = scores[:, 1:] != scores[:, :-1]
+    end = np.ones(scores.shape, dtype=bool)
+    end[:, :-1] = start[:, 1:]
+    group_ids = np.cumsum(start.ravel()) - 1
+
+    return labels, start, end, group_ids
+
+def compute_ap_scores(labels, scores):
+    """ Compute average precision per query, equal to sklearn average_precision_score
+    0 for queries without any relevant result
+
+    :param labels: padded label array
+    :param scores: padded score array
+    :return: average precision array
+    """
+    num_queries, max_len = labels.shape
+    if max_len == 0:
+        return np.zeros(num_queries)
+
+    labels, _, end, group_ids = get_tie_groups(labels, scores)
+    num_pos = labels.sum(axis=1)
+
+    # precision and recall gain at each distinct score threshold
+    group_tp = np.bincount(group_ids, weights=labels.ravel())
+    end = end.ravel()
+    tp_at_end = np.cumsum(labels, axis=1).ravel()[end]
+    num_at_end = np.tile(np.arange(1, max_len + 1), num_queries)[end]
+    rows = np.repeat(np.arange(num_queries), max_len)[end]
+
+    ap = np.bincount(rows, weights=group_tp * tp_at_end / num_at_end, minlength=num_queries)
+    return np.where(num_pos > 0, ap / np.maximum(num_pos, 1), 0.0)
+
+def compute_prec_scores(labels, lengths, k):
+    """ Compute precision of the first k results per query
+    0 for queries without any relevant result in the first k
+
+    :param labels: padded label array
+    :param lengths: number of results per query
+    :param k: top k
+    :return: precision array
+    """
+    num_rel = labels[:, :k].sum(axis=1)
+    num_ret = np.minimum(lengths, k)
+    return np.where(num_rel > 0, num_rel / np.maximum(num_ret, 1), 0.0)
+
+def compute_ndcg_scores(labels, scores, lengths, k):
+    """ Compute NDCG of the first k results per query, equal to sklearn ndcg_score
+    with tied scores averaged; 0 for queries without results
+
+    :param labels: padded label array
+    :param scores: padded score array
+    :param lengths: number of results per query
+    :param k: top k
+    :return: NDCG array
+    """
+    labels = labels[:, :k]
+    scores = scores[:, :k]
+    num_queries, width = labels.shape
+    if width == 0:
+        return np.zeros(num_queries)
+
+    valid = np.arange(width) < np.minimum(lengths, k)[:, None]
+    discount = 1 / (np.log(np.arange(width) + 2) / np.log(2))
+
+    # DCG with the gain of tied results averaged over their group
+    sorted_labels, _, _, group_ids = get_tie_groups(labels, scores)
+    group_gain = np.bincount(group_ids, weights=sorted_labels.ravel())
+    group_size = np.bincount(group_ids, weights=valid.ravel())
+    gain = (group_gain / np.maximum(group_size, 1))[group_ids].reshape(labels.shape)
+    dcg = (gain * valid * discount).sum(axis=1)
+
+    ideal_labels = -np.sort(-labels, axis=1)
+    idcg = (ideal_labels * discount).sum(axis=1)
+
+    return np.where(idcg > 0, dcg / np.where(idcg > 0, idcg, 1), 0.0)
+
+def compute_rank_metrics(result_filepath, valid_queries, top_k):
+    """ Load a rank result file and compute MAP, P@k and NDCG@k for all top_k
+
+    Module-level so that it can run in a worker process.
+
+    :param result_filepath: filepath to rank results
+    :param valid_queries: query strings to evaluate
+    :param top_k: list of top k
+    :return: dictionary of query strings and per-query metric arrays
+    """
+    start = time.time()
+
+    if result_filepath.endswith(".parquet"):
+        query_strings, labels, scores, lengths = get_parquet_rank_arrays(result_filepath, valid_queries)
+    else:
+        query_results = load_rank_results(result_filepath)
+        query_strings, labels, scores, lengths = get_rank_arrays(query_results, valid_queries)
+
+    return {
+        "query_strings": query_strings,
+        "labels": labels,
+        "scores": scores,
+        "lengths": lengths,
+        "map": compute_ap_scores(labels, scores),
+        "prec": {k: compute_prec_scores(labels, lengths, k) for k in top_k},
+        "ndcg": {k: compute_ndcg_scores(labels, scores, lengths, k) for k in top_k},
+        "time": time.time() - start
+    }
+
+def get_resample_counts(rng, num_queries, num_resamples):
+    """ Draw bootstrap resamples of queries as counts of each query per resample
+
+    :param rng: numpy random generator
+    :param num_queries: number of queries
+    :param num_resamples: number of resamples
+    :return: count array (num_resamples x num_queries)
+    """
+    return rng.multinomial(num_queries, np.full(num_queries, 1 / num_queries), size=num_resamples)
+
+def bootstrap_ci(scores, num_resamples=10000, alpha=0.05, seed=0, chunk_size=1000):
+    """ Compute bootstrap confidence intervals of mean per-query scores.
+    Rows of scores are resampled with the same queries, so intervals of a
+    difference array (config_a - config_b) are paired bootstrap intervals.
+
+    :param scores: per-query score array (num_queries) or (num_configs x num_queries)
+    :param num_resamples: number of bootstrap resamples
+    :param alpha: 1 - confidence level
+    :param seed: random seed
+    :param chunk_size: number of resamples drawn at once
+    :return: mean, lower bound, upper bound (arrays for 2d scores)
+    """
+    ndim = np.ndim(scores)
+    scores = np.atleast_2d(np.asarray(scores, dtype=float))
+    num_queries = scores.shape[1]
+    rng = np.random.default_rng(seed)
+
+    # resampled means of all configurations with one matrix product per chunk
+    means = []
+    for start in range(0, num_resamples, chunk_size):
+        counts = get_resample_counts(rng, num_queries, min(chunk_size, num_resamples - start))
+        means.append(counts @ scores.T / num_queries)
+    means = np.concatenate(means)
+
+    low, high = np.quantile(means, [alpha / 2, 1 - alpha / 2], axis=0)
+    mean = scores.mean(axis=1)
+    if ndim == 1:
+        return float(mean[0]), float(low[0]), float(high[0])
+    return mean, low, high
+
+def randomization_test(scores_a, scores_b, num_resamples=10000, seed=0, chunk_size=1000):
+    """ Paired two-sided randomization test of the difference of mean per-query scores,
+    swapping the scores of a and b per query at random
+
+    :param scores_a: per-query scores of configuration a
+    :param scores_b: per-query scores of configuration b, aligned with scores_a
+    :param num_resamples: number of random permutations
+    :param seed: random seed
+    :param chunk_size: number of permutations drawn at once
+    :return: p-value
+    """
+    diffs = np.asarray(scores_a, dtype=float) - np.asarray(scores_b, dtype=float)
+    observed = abs(diffs.mean())
+    rng = np.random.default_rng(seed)
+
+    num_extreme = 0
+    for start in range(0, num_resamples, chunk_size):
+        signs = rng.choice([-1.0, 1.0], size=(min(chunk_size, num_resamples - start), len(diffs)))
+        num_extreme += int((np.abs(signs @ diffs / len(diffs)) >= observed - 1e-12).sum())
+
+    return (num_extreme + 1) / (num_resamples + 1)
+
+def get_rss():
+    """ Get the resident set size of the current process
+
+    :return: RSS in MB
+    """
+    return psutil.Process().memory_info().rss / 2 ** 20
+
+class PeakRSSMonitor(object):
+    """ Sample the resident set size of the current process in a background thread and keep its peak,
+    so that each benchmarked configuration gets its own peak instead of the process lifetime peak
+
+    :param interval: seconds between samples
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0.0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def sample(self):
+        self.peak = max(self.peak, get_rss())
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+
+def run_benchmark(stages, queries, load_model=None, num_warmup=1):
+    """ Replay queries through ranking stages and measure latency per stage, throughput and peak RSS
+
+    :param stages: list of (stage name, function); the first function takes a query string,
+        each following one takes the output of the previous stage
+    :param queries: list of query strings
+    :param load_model: if given, function loading the model afresh, timed once before the queries
+    :param num_warmup: number of first queries run before measuring, left out of the measurements
+    :return: dictionary of cost metrics
+    """
+    costs = dict()
+    with PeakRSSMonitor() as monitor:
+        if load_model is not None:
+            rss = get_rss()
+            start = time.perf_counter()
+            load_model()
+            costs["Load (s)"] = round(time.perf_counter() - start, 4)
+            costs["Load RSS (MB)"] = round(get_rss() - rss, 1)
+
+        for query_string in queries[:num_warmup]:
+            output = query_string
+            for _, stage in stages:
+                output = stage(output)
+
+        queries = queries[num_warmup:]
+        latencies = np.zeros((len(queries), len(stages)))
+        start = time.perf_counter()
+        for i, query_string in enumerate(tqdm(queries)):
+            output = query_string
+            for j, (_, stage) in enumerate(stages):
+                stage_start = time.perf_counter()
+                output = stage(output)
+                latencies[i, j] = time.perf_counter() - stage_start
+        elapsed = time.perf_counter() - start
+
+    if len(queries):
+        names = [name for name, _ in stages] + ["total"]
+        latencies = np.hstack([latencies, latencies.sum(axis=1, keepdims=True)]) * 1000
+        for name, percentiles in zip(names, np.percentile(latencies, [50, 95, 99], axis=0).T):
+            for q, value in zip([50, 95, 99], percentiles):
+                costs["{} p{} (ms)".format(name, q)] = round(float(value), 2)
+
+    costs["QPS"] = round(len(queries) / elapsed, 2) if elapsed > 0 else 0.0
+    costs["Peak RSS (MB)"] = round(monitor.peak, 1)
+    return costs
+
 class Result:
     """ Class for saving evaluation metrics results in a dictionary data structure 
     
@@ -105,16 +562,18 @@ class Evaluation(object):
     :param query_types: query types e.g. faq, user_query
     :param neg_types: negative types e.g. simple, hard
     :param top_k: top k e.g. 2, 3, 5
+    :param num_workers: number of worker processes evaluating rank result files
     """
 
     def __init__(self, qas_filename, rank_results_filepath, jc_threshold=1.0, test_data="synthetic", rankers=["unsupervised", "supervised"], 
                  rank_fields=["BERT-Q-a", "BERT-Q-q"], loss_types=["triplet", "softmax"], query_types=["faq", "user_query"], 
-                 neg_types=["simple", "hard"], top_k=[2, 3, 5]):
+                 neg_types=["simple", "hard"], top_k=[2, 3, 5], num_workers=1):
         
         if test_data not in {'synthetic', 'user_query'}:
             raise ValueError('error, test_data not exist')
 
         self.top_k = top_k
+        self.num_workers = num_workers
         self.rankers = rankers
         self.neg_types = neg_types
         self.test_data = test_data
@@ -126,13 +585,15 @@ class Evaluation(object):
         self.ndcg_per_query = []
         self.prec_per_query = []
         self.map_per_query = []
+        self.metrics = dict()
+        self.benchmarks = dict()
 
         list_of_qas = load_from_json(qas_filename)
 
         total_questions = 0
         filtered_questions = 0
 
-        self.valid_queries = []
+        self.valid_queries = set()
         
         for item in list_of_qas:
             total_questions += 1
@@ -140,8 +601,99 @@ class Evaluation(object):
                 jc = float(item['jc_sim'])
                 if jc <= jc_threshold:
                     filtered_questions += 1
-                    self.valid_queries.append(item['question'])
+                    self.valid_queries.add(item['question'])
     
+    def get_metrics(self, result_filepath):
+        """ Load a rank result file once and compute MAP, P@k and NDCG@k for all top_k
+
+        :param result_filepath: filepath to rank results
+        :return: dictionary of query strings and per-query metric arrays
+        """
+        result_filepath = self.get_result_filepath(result_filepath)
+        if result_filepath not in self.metrics:
+            self.metrics[result_filepath] = compute_rank_metrics(result_filepath, self.valid_queries, self.top_k)
+
+        return self.metrics[result_filepath]
+
+    def get_result_filepaths(self):
+        """ Get the rank result files of the evaluation grid
+
+        :return: list of existing rank result filepaths
+        """
+        match_fields = ["answer", "question", "question_answer", "question_answer_concat"]
+        filepaths = []
+
+        for ranker in self.rankers:
+            if ranker == "unsupervised":
+                file_path = self.rank_results_filepath + "/" + ranker + "/" + self.test_data
+                filepaths += [file_path + "/es_query_by_" + field + ".json" for field in match_fields]
+
+            elif ranker == "supervised":
+                for rank_field in self.rank_fields:
+                    for loss_type in self.loss_types:
+                        for query_type in self.query_types:
+                            for neg_type in self.neg_types:
+                                file_path = self.rank_results_filepath + "/" + ranker + "/" + self.test_data + "/" + rank_field + "/" + loss_type + "/" + query_type + "/" + neg_type
+                                filepaths += [file_path + "/reranked_query_by_" + field + ".json" for field in match_fields]
+
+        filepaths = [self.get_result_filepath(filepath) for filepath in filepaths]
+        return [filepath for filepath in filepaths if os.path.isfile(filepath)]
+
+    def get_result_filepath(self, result_filepath):
+        """ Resolve a json rank result filepath to the existing result file, falling back
+        to JSONL results streamed by ReRanker, then to parquet results
+
+        :param result_filepath: filepath to json rank results
+        :return: existing rank result filepath, result_filepath if none exists
+        """
+        if result_filepath.endswith(".json"):
+            for candidate in [result_filepath, result_filepath + "l", result_filepath[:-len(".json")] + ".parquet"]:
+                if os.path.isfile(candidate):
+                    return candidate
+        return result_filepath
+
+    def compute_grid_metrics(self):
+        """ Compute metrics of every rank result file in the grid over a process pool,
+        one file per task. Results are cached by filepath, so merging them into
+        the evaluation output does not depend on completion order.
+        """
+        filepaths = [f for f in self.get_result_filepaths() if f not in self.metrics]
+
+        if self.num_workers > 1:
+            with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+                futures = {
+                    executor.submit(compute_rank_metrics, filepath, self.valid_queries, self.top_k): filepath
+                    for filepath in filepaths
+                }
+                for future in tqdm(as_completed(futures), total=len(futures)):
+                    self.metrics[futures[future]] = future.result()
+        else:
+            for filepath in tqdm(filepaths):
+                self.get_metrics(filepath)
+
+        for filepath in filepaths:
+            logging.info("{} evaluated in {:.2f}s".format(filepath, self.metrics[filepath]['time']))
+
+    def get_metric_scores(self, result_filepath, metric, k=None):
+        """ Get query strings and per-query scores of a metric from a rank result file
+
+        :param result_filepath: filepath to rank results
+        :param metric: map / prec / ndcg
+        :param k: top k, not used for map
+        :return: query strings, list of per-query scores
+        """
+        metrics = self.get_metrics(result_filepath)
+        if metric == "map":
+            scores = metrics['map']
+        else:
+            if k not in metrics[metric]:
+                if metric == "prec":
+                    metrics[metric][k] = compute_prec_scores(metrics['labels'], metrics['lengths'], k)
+                else:
+                    metrics[metric][k] = compute_ndcg_scores(metrics['labels'], metrics['scores'], metrics['lengths'], k)
+            scores = metrics[metric][k]
+        return metrics['query_strings'], scores.tolist()
+
     def compute_map(self, result_filepath, ranker, match_field, rank_field="", loss_type="", query_type="", neg_type=""):
         """ Compute average precision score for a set of rank results
         
@@ -153,49 +705,23 @@ class Evaluation(object):
         :param query_type: faq / user_query
         :param neg_type: simple / hard
         """
-        query_results = load_from_json(result_filepath)
+        query_strings, scores = self.get_metric_scores(result_filepath, "map")
 
-        sum_ap = 0
-        num_queries = 0
         map_per_query = []
-        for result in query_results:
-            query_string = result['query_string']
-
-            if query_string in self.valid_queries:
-
-                topk_results = result['rerank_preds']
-
-                labels = []
-                reranks = []
-
-                for topk in topk_results:
-                    labels.append(topk['label'])
-                    reranks.append(topk['score'])
-
-                true_relevance = np.array(labels)
-                scores = np.array(reranks)
-
-                ap = 0
-                all_zeros = not np.any(labels)
-                if labels and reranks and not all_zeros:
-                    ap = average_precision_score(true_relevance, scores)
-
-                sum_ap = sum_ap + ap
-                num_queries = num_queries + 1
-
-                query_map = {
-                    "Query": query_string,
-                    "MAP": ap,
-                    "Method": ranker,
-                    "Matching Field": match_field,
-                    "Ranking Field": rank_field,
-                    "Loss": loss_type,
-                    "Training Data": query_type,
-                    "Negative Sampling": neg_type
-                }
-                map_per_query.append(query_map)
-
-        return (float(sum_ap / num_queries)), map_per_query
+        for query_string, ap in zip(query_strings, scores):
+            query_map = {
+                "Query": query_string,
+                "MAP": ap,
+                "Method": ranker,
+                "Matching Field": match_field,
+                "Ranking Field": rank_field,
+                "Loss": loss_type,
+                "Training Data": query_type,
+                "Negative Sampling": neg_type
+            }
+            map_per_query.append(query_map)
+
+        return (float(sum(scores) / len(scores))), map_per_query
 
     def compute_prec(self, result_filepath, k, ranker, match_field, rank_field="", loss_type="", query_type="", neg_type=""):
         """ Compute precision score for a set of rank results
@@ -208,49 +734,24 @@ class Evaluation(object):
         :param query_type: faq / user_query
         :param neg_type: simple / hard
         """
-        query_results = load_from_json(result_filepath)
+        query_strings, scores = self.get_metric_scores(result_filepath, "prec", k)
 
-        sum_prec = 0
-        num_queries = 0
         prec_per_query = []
-        for result in query_results:
-            query_string = result['query_string']
-
-            if query_string in self.valid_queries:
-                topk_results = result['rerank_preds']
-
-                labels = []
-                reranks = []
-
-                for topk in topk_results[:k]:
-                    labels.append(topk['label'])
-                    reranks.append(topk['score'])
-
-                true_relevance = np.array(labels)
-                scores = np.array(reranks)
-
-                prec = 0
-                all_zeros = not np.any(labels)
-                if labels and reranks and not all_zeros:
-                    prec = sum(true_relevance) / len(true_relevance)
-
-                sum_prec = sum_prec + prec
-                num_queries = num_queries + 1
-
-                query_prec = {
-                    "Query": query_string,
-                    "k": k,
-                    "Prec": prec,
-                    "Method": ranker,
-                    "Matching Field": match_field,
-                    "Ranking Field": rank_field,
-                    "Loss": loss_type,
-                    "Training Data": query_type,
-                    "Negative Sampling": neg_type
-                }
-                prec_per_query.append(query_prec)
-
-        return (float(sum_prec / num_queries)), prec_per_query
+        for query_string, prec in zip(query_strings, scores):
+            query_prec = {
+                "Query": query_string,
+                "k": k,
+                "Prec": prec,
+                "Method": ranker,
+                "Matching Field": match_field,
+                "Ranking Field": rank_field,
+                "Loss": loss_type,
+                "Training Data": query_type,
+                "Negative Sampling": neg_type
+            }
+            prec_per_query.append(query_prec)
+
+        return (float(sum(scores) / len(scores))), prec_per_query
 
     def compute_ndcg(self, result_filepath, k, ranker, match_field, rank_field="", loss_type="", query_type="", neg_type=""):
         """ Compute NDCG score for a set of rank results
@@ -263,50 +764,24 @@ class Evaluation(object):
         :param query_type: faq / user_query
         :param neg_type: simple / hard
         """
-        query_results = load_from_json(result_filepath)
+        query_strings, scores = self.get_metric_scores(result_filepath, "ndcg", k)
 
-        sum_ndcg = 0
-        num_queries = 0
         ndcg_per_query = []
-
-        for result in query_results:
-            query_string = result['query_string']
-         
-            if query_string in self.valid_queries:
-                
-                topk_results = result['rerank_preds']
-
-                labels = []
-                reranks = []
-
-                for topk in topk_results[:k]:
-                    labels.append(topk['label'])
-                    reranks.append(topk['score'])
-
-                true_relevance = np.asarray([labels])
-                scores = np.asarray([reranks])
-                
-                ndcg = 0
-                if labels and reranks:
-                    ndcg = ndcg_score(true_relevance, scores)
-
-                sum_ndcg = sum_ndcg + ndcg
-                num_queries = num_queries + 1
-
-                query_ndcg = {
-                    "Query": query_string,
-                    "k": k,
-                    "NDCG": ndcg,
-                    "Method": ranker,
-                    "Matching Field": match_field,
-                    "Ranking Field": rank_field,
-                    "Loss": loss_type,
-                    "Training Data": query_type,
-                    "Negative Sampling": neg_type
-                }
-                ndcg_per_query.append(query_ndcg)
-
-        return (float(sum_ndcg / num_queries)), ndcg_per_query
+        for query_string, ndcg in zip(query_strings, scores):
+            query_ndcg = {
+                "Query": query_string,
+                "k": k,
+                "NDCG": ndcg,
+                "Method": ranker,
+                "Matching Field": match_field,
+                "Ranking Field": rank_field,
+                "Loss": loss_type,
+                "Training Data": query_type,
+                "Negative Sampling": neg_type
+            }
+            ndcg_per_query.append(query_ndcg)
+
+        return (float(sum(scores) / len(scores))), ndcg_per_query
     
     def get_eval_output(self):
         """ Generate evaluation metrics and save them into a dictionary
@@ -316,6 +791,8 @@ class Evaluation(object):
         output = dict()
         output['eval'] = dict()
 
+        self.compute_grid_metrics()
+
         for ranker in self.rankers:
     
             # Compute metrics for the unsupervised method
@@ -542,5 +1019,126 @@ class Evaluation(object):
                                                                 orient='index')
 
         df.reset_index(drop=True, inplace=True)
+
+        # add the cost of each benchmarked configuration to its row
+        if self.benchmarks:
+            keys = ["Method", "Matching Field", "Ranking Field", "Loss", "Training Data", "Negative Sampling"]
+            costs = pd.DataFrame([dict(zip(keys, key), **cost) for key, cost in self.benchmarks.items()])
+            df = df.merge(costs, on=keys, how='left')
         return df
     
+
+    def get_paired_scores(self, result_filepath_a, result_filepath_b, metric, k=None):
+        """ Get per-query scores of two rank result files on the queries they share
+
+        :param result_filepath_a: filepath to rank results of configuration a
+        :param result_filepath_b: filepath to rank results of configuration b
+        :param metric: map / prec / ndcg
+        :param k: top k, not used for map
+        :return: aligned score arrays of a and b
+        """
+        query_strings_a, scores_a = self.get_metric_scores(result_filepath_a, metric, k)
+        query_strings_b, scores_b = self.get_metric_scores(result_filepath_b, metric, k)
+        query2score_b = dict(zip(query_strings_b, scores_b))
+
+        pairs = [(score, query2score_b[query_string]) for query_string, score in zip(query_strings_a, scores_a) if query_string in query2score_b]
+        if not pairs:
+            return np.zeros(0), np.zeros(0)
+        scores_a, scores_b = zip(*pairs)
+        return np.array(scores_a), np.array(scores_b)
+
+    def compare(self, result_filepath_a, result_filepath_b, metric, k=None, num_resamples=10000, alpha=0.05, seed=0):
+        """ Compare two configurations with a paired bootstrap confidence interval
+        of the metric difference and a paired randomization test
+
+        :param result_filepath_a: filepath to rank results of configuration a
+        :param result_filepath_b: filepath to rank results of configuration b
+        :param metric: map / prec / ndcg
+        :param k: top k, not used for map
+        :param num_resamples: number of bootstrap resamples and random permutations
+        :param alpha: 1 - confidence level
+        :param seed: random seed
+        :return: dictionary of mean difference, confidence interval and p-value
+        """
+        scores_a, scores_b = self.get_paired_scores(result_filepath_a, result_filepath_b, metric, k)
+        diff, low, high = bootstrap_ci(scores_a - scores_b, num_resamples, alpha, seed)
+        return {
+            "Queries": len(scores_a),
+            "Diff": diff,
+            "CI Low": low,
+            "CI High": high,
+            "p-value": randomization_test(scores_a, scores_b, num_resamples, seed)
+        }
+
+    def get_ci_df(self, metric, k=None, num_resamples=10000, alpha=0.05, seed=0):
+        """ Generate bootstrap confidence intervals of a metric for every rank result file in the grid
+
+        :param metric: map / prec / ndcg
+        :param k: top k, not used for map
+        :param num_resamples: number of bootstrap resamples
+        :param alpha: 1 - confidence level
+        :param seed: random seed
+        :return: DataFrame with one row per rank result file
+        """
+        self.compute_grid_metrics()
+
+        rows = []
+        for result_filepath in self.get_result_filepaths():
+            _, scores = self.get_metric_scores(result_filepath, metric, k)
+            mean, low, high = bootstrap_ci(scores, num_resamples, alpha, seed)
+            rows.append({
+                "Result": os.path.relpath(result_filepath, self.rank_results_filepath),
+                "Metric": metric if metric == "map" else "{}@{}".format(metric, k),
+                "Mean": mean,
+                "CI Low": low,
+                "CI High": high
+            })
+        return pd.DataFrame(rows)
+
+    def get_significance_df(self, baseline_filepath, metric, k=None, num_resamples=10000, alpha=0.05, seed=0):
+        """ Compare every rank result file in the grid against a baseline configuration
+
+        :param baseline_filepath: filepath to rank results of the baseline e.g. es_query_by_question_answer.json
+        :param metric: map / prec / ndcg
+        :param k: top k, not used for map
+        :param num_resamples: number of bootstrap resamples and random permutations
+        :param alpha: 1 - confidence level
+        :param seed: random seed
+        :return: DataFrame with one row per rank result file
+        """
+        self.compute_grid_metrics()
+        baseline_filepath = self.get_result_filepath(baseline_filepath)
+
+        rows = []
+        for result_filepath in self.get_result_filepaths():
+            if result_filepath == baseline_filepath:
+                continue
+            row = {"Result": os.path.relpath(result_filepath, self.rank_results_filepath)}
+            row.update(self.compare(result_filepath, baseline_filepath, metric, k, num_resamples, alpha, seed))
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    def benchmark(self, stages, queries, ranker, match_field, rank_field="", loss_type="", query_type="", neg_type="", 
+                  load_model=None, num_warmup=1):
+        """ Benchmark a serving configuration, its costs are added to its row of get_eval_df
+
+        e.g. FAQ_BERT_Ranker: ev.benchmark(faq_bert_ranker.get_stages(), queries, "supervised", "question_answer",
+                                           "BERT-Q-a", "triplet", "user_query", "hard", load_model=lambda: faq_bert_ranker.get_faq_bert(reload=True))
+             ReRanker: ev.benchmark(reranker.get_stages(es, index, query_by, top_k), queries, ...,
+                                    load_model=lambda: reranker.get_faq_bert(reload=True))
+
+        :param stages: list of (stage name, function) replayed for each query, see run_benchmark
+        :param queries: list of query strings
+        :param ranker: supervised / unsupervised
+        :param match_field: answer / question / question_answer / question_answer_concat
+        :param rank_field: BERT-Q-a / BERT-Q-q
+        :param loss_type: triplet / softmax
+        :param query_type: faq / user_query
+        :param neg_type: simple / hard
+        :param load_model: if given, function loading the model afresh, timed once before the queries
+        :param num_warmup: number of first queries run before measuring, left out of the measurements
+        :return: dictionary of cost metrics
+        """
+        costs = run_benchmark(stages, list(queries), load_model, num_warmup)
+        self.benchmarks[(ranker.capitalize(), match_field, rank_field, loss_type, query_type, neg_type)] = costs
+        return costs
@@ -2,7 +2,10 @@ import sentence_transformers
 from sentence_transformers import SentenceTransformer, util
 from sentence_transformers import CrossEncoder
 from shared.utils import isDir
+from batch_sampler import LengthBucketSampler
+from tqdm import tqdm
 import numpy as np
+import logging
 import os
 
 
@@ -10,10 +13,13 @@ class FAQ_BERT(object):
     """ Class for predicting a continuous value from 0..1 for a given question-answer pair
 
     :param bert_model_path: trained FAQ BERT model path
+    :param max_seq_length: maximum number of tokens per input, longer inputs are truncated
     """ 
-    def __init__(self, bert_model_path):
+    def __init__(self, bert_model_path, max_seq_length=None):
         
         self.bert_model_path = bert_model_path
+        self.max_seq_length = max_seq_length
+        self.padding_ratio = None
         self.abs_path = ""
         self.model_path = ""
         self.model_dirname = ""
@@ -39,8 +45,10 @@ class FAQ_BERT(object):
         self.model = None
         if self.loss_type == "triplet":
             self.model = SentenceTransformer(self.model_path)
+            if self.max_seq_length:
+                self.model.max_seq_length = self.max_seq_length
         elif self.loss_type == "softmax":
-            self.model = CrossEncoder(self.model_path, num_labels=1)
+            self.model = CrossEncoder(self.model_path, num_labels=1, max_length=self.max_seq_length)
 
     def predict(self, question, answer):
         """ Predict score for question-answer pair 
@@ -62,3 +70,47 @@ class FAQ_BERT(object):
             score = self.model.predict(pair, convert_to_numpy=True, show_progress_bar=False)
             score = float(score)
         return score
+
+    def get_token_lengths(self, pairs):
+        """ Get the number of tokens of each question-answer pair, truncated to max_seq_length
+
+        :param pairs: list of (question, answer) pairs
+        :return: array of token lengths
+        """
+        questions = [question for question, _ in pairs]
+        answers = [answer for _, answer in pairs]
+        encoded = self.model.tokenizer(
+            questions, answers, truncation=True, max_length=self.max_seq_length or self.model.tokenizer.model_max_length
+        )
+        return np.array([len(input_ids) for input_ids in encoded['input_ids']])
+
+    def predict_batch(self, pairs, batch_size=64):
+        """ Predict scores of many question-answer pairs at once, equal to predict on each pair.
+        For triplet models each distinct text is encoded once, for softmax models pairs
+        are batched by token length with LengthBucketSampler to minimize padding.
+
+        :param pairs: list of (question, answer) pairs
+        :param batch_size: number of inputs per forward pass
+        :return: list of scores aligned with pairs
+        """
+        if not pairs:
+            return []
+
+        scores = np.zeros(len(pairs))
+        if self.loss_type == "triplet":
+            texts = sorted({text for pair in pairs for text in pair}, key=len)
+            embeddings = self.model.encode(texts, batch_size=batch_size, convert_to_numpy=True, show_progress_bar=True)
+            embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+            text2id = {text: i for i, text in enumerate(texts)}
+            question_ids = np.array([text2id[question] for question, _ in pairs])
+            answer_ids = np.array([text2id[answer] for _, answer in pairs])
+            scores = (embeddings[question_ids] * embeddings[answer_ids]).sum(axis=1)
+        elif self.loss_type == "softmax":
+            batch_sampler = LengthBucketSampler(self.get_token_lengths(pairs), batch_size, shuffle=False)
+            self.padding_ratio = batch_sampler.get_padding_ratio()
+            logging.info("Scoring {} pairs with padding ratio {:.1%}".format(len(pairs), self.padding_ratio))
+            for batch in tqdm(batch_sampler):
+                scores[batch] = self.model.predict(
+                    [list(pairs[i]) for i in batch], batch_size=batch_size, convert_to_numpy=True, show_progress_bar=False
+                )
+        return [float(score) for score in scores]
@@ -5,13 +5,23 @@ from sentence_transformers.cross_encoder import CrossEncoder
 from sentence_transformers.readers import TripletReader
 from sentence_transformers.readers import InputExample
 from sklearn.model_selection import train_test_split
-from shared.utils import make_dirs, dump_to_json
+from shared.utils import make_dirs, dump_to_json, load_from_json
+from token_cache import TokenCache, CachedCollator
+from batch_sampler import LengthBucketSampler
+from transformers import get_linear_schedule_with_warmup
 from torch.utils.data import DataLoader
+from tqdm import tqdm
 import pandas as pd 
 import numpy as np
 import logging
+import torch.distributed as dist
+import hashlib
+import random
+import shutil
+import socket
 import torch
 import math
+import os
 
 
 device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
@@ -21,6 +31,62 @@ logging.basicConfig(format='%(asctime)s - %(message)s',
                     level=logging.INFO,
                     handlers=[LoggingHandler()])
 
+class CrossEncoderLoss(torch.nn.Module):
+    """ Loss of a CrossEncoder on (features, labels) batches, as computed by CrossEncoder.fit
+
+    :param cross_encoder: CrossEncoder model
+    """
+    def __init__(self, cross_encoder):
+        super(CrossEncoderLoss, self).__init__()
+        self.model = cross_encoder.model
+        self.num_labels = cross_encoder.config.num_labels
+        self.loss_fct = torch.nn.BCEWithLogitsLoss() if self.num_labels == 1 else torch.nn.CrossEntropyLoss()
+
+    def forward(self, features, labels):
+        logits = self.model(**features, return_dict=True).logits
+        if self.num_labels == 1:
+            logits = logits.view(-1)
+        return self.loss_fct(logits, labels)
+
+def get_dataset_fingerprint(df):
+    """ Get fingerprint of a dataframe, telling whether a saved split and checkpoints belong to it
+
+    :param df: pandas DataFrame
+    :return: dictionary of number of rows and sha1 hex digest of columns and row contents
+    """
+    h = hashlib.sha1()
+    h.update(str(list(df.columns)).encode('utf-8'))
+    h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return {"num_rows": len(df), "hash": h.hexdigest()}
+
+def train_worker(rank, finetuning, train_samples, val_samples, output_path, checkpoint_path, init_method):
+    """ Train a FAQ_BERT_Finetuning model as one worker of a gloo process group.
+    Each worker uses its own share of the CPU cores and threads.
+
+    :param rank: worker rank
+    :param finetuning: FAQ_BERT_Finetuning instance
+    :param train_samples: train triplets
+    :param val_samples: validation triplets
+    :param output_path: path to save model
+    :param checkpoint_path: checkpoint directory
+    :param init_method: URL of the process group rendezvous
+    """
+    num_workers = finetuning.num_workers
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    cores_per_worker = max(1, len(cores) // num_workers)
+    if hasattr(os, "sched_setaffinity") and len(cores) >= num_workers:
+        os.sched_setaffinity(0, cores[rank * cores_per_worker:(rank + 1) * cores_per_worker])
+    torch.set_num_threads(finetuning.num_threads or cores_per_worker)
+
+    # workers share the batch order, dropout differs per worker
+    torch.manual_seed(finetuning.seed + rank)
+
+    dist.init_process_group("gloo", init_method=init_method, rank=rank, world_size=num_workers)
+    try:
+        finetuning.train(finetuning.bert_model, train_samples, val_samples, output_path, checkpoint_path)
+    finally:
+        dist.destroy_process_group()
+
 class FAQ_BERT_Finetuning(object):
     """ Class for finetuning BERT on FAQ triplet dataset
 
@@ -34,9 +100,18 @@ class FAQ_BERT_Finetuning(object):
     :param evaluation_steps: evaluation steps
     :param test_size: total number of samples in test set
     :param num_labels: param used for loss_type="softmax"
+    :param token_cache_path: directory of the token id cache, defaults to <output_path>/token_cache
+    :param bucket_size: number of batches per length bucket of the training batch sampler, random batches if None
+    :param seed: random seed of the training batch order, drawn from torch if None
+    :param checkpoint_steps: number of training steps between checkpoints, checkpoints only at the end of epochs if None
+    :param checkpoint_limit: number of most recent checkpoints kept, all if None
+    :param num_workers: number of CPU data-parallel worker processes, each training on batch_size examples per step
+    :param num_threads: torch threads per worker, defaults to the worker's share of CPU cores
     """
     def __init__(self, loss_type="triplet", query_type='faq', neg_type='simple', version="1.1", epochs=4, batch_size=32, 
-                 pre_trained_name='distilbert-base-uncased', evaluation_steps=1000, test_size=0.20, num_labels=1):
+                 pre_trained_name='distilbert-base-uncased', evaluation_steps=1000, test_size=0.20, num_labels=1,
+                 token_cache_path=None, bucket_size=100, seed=None, checkpoint_steps=1000, checkpoint_limit=2,
+                 num_workers=1, num_threads=None):
         
         self.loss_type = loss_type
         self.query_type = query_type
@@ -52,6 +127,15 @@ class FAQ_BERT_Finetuning(object):
         self.train_df = None
         self.test_df = None
         self.val_df = None
+        self.token_cache_path = token_cache_path
+        self.token_cache = None
+        self.dataset_fingerprint = None
+        self.bucket_size = bucket_size
+        self.seed = seed
+        self.checkpoint_steps = checkpoint_steps
+        self.checkpoint_limit = checkpoint_limit
+        self.num_workers = num_workers
+        self.num_threads = num_threads
 
         if self.loss_type not in {'triplet', 'softmax'}:
             raise ValueError('loss_type not exist')
@@ -81,6 +165,44 @@ class FAQ_BERT_Finetuning(object):
         val, test = train_test_split(temp, test_size=0.5)
         return train, val, test
     
+    def get_train_val_test_sets(self, df, split_filepath):
+        """ Split dataframe with split_train_val_test_sets and save the split with the dataset fingerprint,
+        or load the split saved by a previous run of the same model on the same dataframe
+
+        :param df: dataframe
+        :param split_filepath: json filepath of the row positions of each set
+        :return: train, val, test sets
+        """
+        df = df.reset_index(drop=True)
+        self.dataset_fingerprint = get_dataset_fingerprint(df)
+        if os.path.isfile(split_filepath):
+            split = load_from_json(split_filepath)
+            if split.get("dataset_fingerprint") == self.dataset_fingerprint:
+                return df.iloc[split["train"]], df.iloc[split["val"]], df.iloc[split["test"]]
+            logging.warning("Ignoring split {} of a different dataset".format(split_filepath))
+
+        train, val, test = self.split_train_val_test_sets(df)
+        dump_to_json({
+            "train": train.index.tolist(), "val": val.index.tolist(), "test": test.index.tolist(),
+            "dataset_fingerprint": self.dataset_fingerprint
+        }, split_filepath)
+        return train, val, test
+
+    def clear_stale_checkpoints(self, df, checkpoint_path):
+        """ Delete the split and checkpoints of a training run on a different dataframe
+
+        :param df: dataframe
+        :param checkpoint_path: checkpoint directory
+        """
+        split_filepath = checkpoint_path + "/split.json"
+        if not os.path.isfile(split_filepath):
+            return
+        split = load_from_json(split_filepath)
+        if split.get("dataset_fingerprint") != get_dataset_fingerprint(df.reset_index(drop=True)):
+            logging.warning("Dataset changed since the checkpoints in {} were saved, training from scratch".format(checkpoint_path))
+            shutil.rmtree(checkpoint_path)
+            make_dirs(checkpoint_path)
+
     def generate_triplets(self, df):
         """ Generate triplets from a given DataFrame 
         
@@ -88,19 +210,37 @@ class FAQ_BERT_Finetuning(object):
         :return: list of triplets 
         """
         triplets = []
-        for _, row in df.iterrows():
-            if self.loss_type == "triplet":
-                question = row['question']
-                positive = row['positive']
-                negative = row['negative']
-                triplets.append(InputExample(texts=[question, positive, negative], label=0))
-            elif self.loss_type == "softmax":
-                question = row['question']
-                answer = row['answer']
-                label = row['label']
-                triplets.append(InputExample(texts=[question, answer], label=label))
+        if self.loss_type == "triplet":
+            triplets = [
+                InputExample(texts=[question, positive, negative], label=0)
+                for question, positive, negative in zip(df['question'].tolist(), df['positive'].tolist(), df['negative'].tolist())
+            ]
+        elif self.loss_type == "softmax":
+            triplets = [
+                InputExample(texts=[question, answer], label=label)
+                for question, answer, label in zip(df['question'].tolist(), df['answer'].tolist(), df['label'].tolist())
+            ]
         return triplets
 
+    def get_token_cache(self, samples, cache_path):
+        """ Get the token id cache of the BERT model tokenizer holding every text of samples.
+        Texts repeated across triplets, splits and runs are tokenized once.
+
+        :param samples: list of InputExample
+        :param cache_path: directory of the token id cache
+        :return: TokenCache
+        """
+        if self.loss_type == "triplet":
+            tokenizer = self.bert_model._first_module().tokenizer
+            max_length = self.bert_model.max_seq_length
+        else:
+            tokenizer = self.bert_model.tokenizer
+            max_length = self.bert_model.max_length or tokenizer.model_max_length
+
+        token_cache = TokenCache(cache_path, tokenizer, max_length)
+        token_cache.add(text for example in samples for text in example.texts)
+        return token_cache
+
     def create_model(self, df, output_path):
         """ Finetune BERT model on FAQ dataset and generate model at given path
 
@@ -117,22 +257,32 @@ class FAQ_BERT_Finetuning(object):
             models_path = output_path + "/models/" + subdir
             eval_path = output_path + "/evaluation/" + subdir
             label_index_path = output_path + "/label_index/"
+            checkpoint_path = output_path + "/checkpoints/" + subdir
 
             # Create directories
             make_dirs(models_path)
             make_dirs(eval_path)
+            make_dirs(checkpoint_path)
 
             logging.info("Generating triplets for training")
-            # split dataframe into train, test, validation
-            self.train_df, self.val_df, self.test_df = self.split_train_val_test_sets(df)
+            # split dataframe into train, test, validation, keeping the split of a resumed run on the same data
+            self.clear_stale_checkpoints(df, checkpoint_path)
+            self.train_df, self.val_df, self.test_df = self.get_train_val_test_sets(df, checkpoint_path + "/split.json")
             
             # generate triplets for train, test, validation
             train_samples = self.generate_triplets(self.train_df)
             test_samples = self.generate_triplets(self.val_df)
             val_samples = self.generate_triplets(self.test_df)
 
+            logging.info("Tokenizing training texts")
+            token_cache_path = self.token_cache_path or output_path + "/token_cache"
+            self.token_cache = self.get_token_cache(train_samples, token_cache_path)
+
             logging.info("Training model")
-            self.model = self.train(self.bert_model, train_samples, val_samples, models_path)
+            if self.num_workers > 1:
+                self.train_distributed(self.bert_model, train_samples, val_samples, models_path, checkpoint_path)
+            else:
+                self.model = self.train(self.bert_model, train_samples, val_samples, models_path, checkpoint_path)
             
             logging.info("Evaluating model")
             self.model = self.evaluate(test_samples, models_path)
@@ -142,47 +292,267 @@ class FAQ_BERT_Finetuning(object):
             self.test_df.to_csv(eval_path + "/test.csv", index=False)
             self.val_df.to_csv(eval_path + "/val.csv", index=False)
 
+            # training is complete, running the same model again trains from scratch
+            shutil.rmtree(checkpoint_path)
+
         except Exception:
             logging.error('error occured', exc_info=True)   
 
 
-    def train(self, bert_model, train_samples, val_samples, output_path):
-        """ Train model using BERT pre-trained model using train, val triplets 
+    def get_train_dataloader(self, train_samples, num_replicas=1, rank=0):
+        """ Get the train dataloader, batching examples of similar token length if the token cache is built.
+        Batches depend only on seed and epoch, so that a resumed run continues with the same batches.
+
+        :param train_samples: train triplets
+        :param num_replicas: number of distributed workers the batches are sharded over
+        :param rank: rank of this worker
+        :return: DataLoader
+        """
+        if self.token_cache is None or not self.bucket_size:
+            # sorting buckets of a single batch of equal lengths leaves the batches random
+            batch_sampler = LengthBucketSampler(
+                np.zeros(len(train_samples)), self.batch_size, 1, seed=self.seed, num_replicas=num_replicas, rank=rank
+            )
+        else:
+            lengths = self.token_cache.get_lengths(train_samples, pair=self.loss_type == "softmax")
+            batch_sampler = LengthBucketSampler(
+                lengths, self.batch_size, self.bucket_size, seed=self.seed, num_replicas=num_replicas, rank=rank
+            )
+
+            random_batches = LengthBucketSampler(lengths, self.batch_size, 1, seed=self.seed)
+            logging.info("Padding ratio {:.1%} with length buckets, {:.1%} with random batches".format(
+                batch_sampler.get_padding_ratio(), random_batches.get_padding_ratio()))
+
+        # a generator of its own keeps the dataloader from drawing from the global torch RNG
+        # on every epoch, which would shift dropout after resuming mid-epoch
+        return DataLoader(train_samples, batch_sampler=batch_sampler, generator=torch.Generator())
+
+    def get_loss_model(self, bert_model):
+        """ Get the module computing the training loss of a (features, labels) batch
+
+        :param bert_model: BERT pre-trained model
+        :return: loss model
+        """
+        if self.loss_type == "triplet":
+            return losses.TripletLoss(model=bert_model)
+        return CrossEncoderLoss(bert_model)
+
+    def get_evaluator(self, val_samples):
+        """ Get the evaluator of the loss type
+
+        :param val_samples: validation triplets
+        :return: evaluator
+        """
+        if self.loss_type == "triplet":
+            return TripletEvaluator.from_input_examples(val_samples, name='val')
+        return CEBinaryClassificationEvaluator.from_input_examples(val_samples)
+
+    def get_checkpoints(self, checkpoint_path):
+        """ Get the checkpoint files of a training run
+
+        :param checkpoint_path: checkpoint directory
+        :return: list of checkpoint filepaths, oldest first
+        """
+        if not os.path.isdir(checkpoint_path):
+            return []
+        steps = sorted(
+            int(filename[len("checkpoint-"):-len(".pt")]) for filename in os.listdir(checkpoint_path)
+            if filename.startswith("checkpoint-") and filename.endswith(".pt")
+        )
+        return [checkpoint_path + "/checkpoint-{}.pt".format(step) for step in steps]
+
+    def save_checkpoint(self, checkpoint_path, state):
+        """ Save training state and delete the oldest checkpoints beyond checkpoint_limit
+
+        :param checkpoint_path: checkpoint directory
+        :param state: dictionary of training state
+        """
+        make_dirs(checkpoint_path)
+        filepath = checkpoint_path + "/checkpoint-{}.pt".format(state["global_step"])
+
+        # write to a temporary file first, a preempted save leaves the previous checkpoints intact
+        torch.save(state, filepath + ".tmp")
+        os.replace(filepath + ".tmp", filepath)
+        logging.info("Saved checkpoint {}".format(filepath))
+
+        if self.checkpoint_limit:
+            for old_filepath in self.get_checkpoints(checkpoint_path)[:-self.checkpoint_limit]:
+                os.remove(old_filepath)
+
+    def get_rng_state(self):
+        """ Get the state of the random number generators used in training, as plain values and tensors """
+        name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        return {
+            "python": random.getstate(),
+            "numpy": [name, keys.tolist(), pos, has_gauss, cached_gaussian],
+            "torch": torch.get_rng_state()
+        }
+
+    def set_rng_state(self, rng_state):
+        """ Restore the state of the random number generators used in training """
+        name, keys, pos, has_gauss, cached_gaussian = rng_state["numpy"]
+        random.setstate(rng_state["python"])
+        np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+        torch.set_rng_state(rng_state["torch"])
+
+    def train(self, bert_model, train_samples, val_samples, output_path, checkpoint_path=None):
+        """ Train model using BERT pre-trained model using train, val triplets.
+        Follows the fit of SentenceTransformer / CrossEncoder (AdamW, linear warmup schedule, gradient
+        clipping, best model saved on evaluation) and saves the model, optimizer, scheduler, RNG and
+        batch position every checkpoint_steps, resuming from the latest checkpoint in checkpoint_path.
         
         :param bert_model: BERT pre-trained model
         :param train_samples: train triplets
         :param val_samples: validation triplets
         :param output_path: path to save model
+        :param checkpoint_path: checkpoint directory, no checkpoints if None
         :return: trained model
         """
-        model = None
+        distributed = dist.is_available() and dist.is_initialized()
+        rank = dist.get_rank() if distributed else 0
+        num_replicas = dist.get_world_size() if distributed else 1
 
-        if self.loss_type == "triplet":
-            # generate train dataloader
-            train_dataloader = DataLoader(train_samples, shuffle=True, batch_size=self.batch_size)
-            train_loss = losses.TripletLoss(model=bert_model)
-            evaluator = TripletEvaluator.from_input_examples(val_samples, name='val')
-            
-            # train model
-            warmup_steps = int(len(train_dataloader) * self.epochs * 0.1) # 10% of train data
-            model = bert_model.fit(
-                train_objectives=[(train_dataloader, train_loss)], evaluator=evaluator,
-                epochs=self.epochs, evaluation_steps=self.evaluation_steps, 
-                warmup_steps=warmup_steps, output_path=output_path
-            )
-        elif self.loss_type == "softmax":
-            # generate train dataloader
-            train_dataloader = DataLoader(train_samples, shuffle=True, batch_size=self.batch_size)
-            evaluator = CEBinaryClassificationEvaluator.from_input_examples(val_samples)
-      
-            # train the model
-            warmup_steps = int(len(train_dataloader)*self.epochs/self.batch_size*0.1) #10% of train data
-            model = bert_model.fit(train_dataloader=train_dataloader, evaluator=evaluator,
-                epochs=self.epochs, evaluation_steps=self.evaluation_steps, loss_fct=None,
-                warmup_steps=warmup_steps, output_path=output_path,
+        checkpoints = self.get_checkpoints(checkpoint_path) if checkpoint_path else []
+        checkpoint = None
+        if checkpoints:
+            logging.info("Resuming from checkpoint {}".format(checkpoints[-1]))
+            checkpoint = torch.load(checkpoints[-1], map_location=device)
+            if checkpoint.get("dataset_fingerprint") != self.dataset_fingerprint:
+                raise ValueError("error, checkpoint {} was saved for a different dataset".format(checkpoints[-1]))
+            if checkpoint["epoch"] >= self.epochs:
+                logging.info("Training already completed at checkpoint {}".format(checkpoints[-1]))
+            self.seed = checkpoint["seed"]
+        elif self.seed is None:
+            self.seed = int(torch.randint(2 ** 31, (1,)))
+
+        train_dataloader = self.get_train_dataloader(train_samples, num_replicas, rank)
+        train_dataloader.collate_fn = bert_model.smart_batching_collate
+        if self.token_cache is not None:
+            # assemble batches from cached token ids instead of tokenizing texts
+            train_dataloader.collate_fn = CachedCollator(self.token_cache, self.loss_type, device, self.num_labels)
+
+        loss_model = self.get_loss_model(bert_model)
+        loss_model.to(device)
+        train_model = loss_model
+        if distributed:
+            # all-reduce gradients across workers, the token embedding models of
+            # triplet loss leave the pooler of BERT checkpoints without gradients
+            train_model = torch.nn.parallel.DistributedDataParallel(
+                loss_model, find_unused_parameters=self.loss_type == "triplet"
             )
-        
-        return model
+        evaluator = self.get_evaluator(val_samples)
+        os.makedirs(output_path, exist_ok=True)
+
+        steps_per_epoch = len(train_dataloader)
+        if self.loss_type == "triplet":
+            warmup_steps = int(steps_per_epoch * self.epochs * 0.1) # 10% of train data
+        else:
+            warmup_steps = int(steps_per_epoch * self.epochs / self.batch_size * 0.1) # 10% of train data
+
+        no_decay = ['bias', 'LayerNorm.bias', 'LayerNorm.weight']
+        param_optimizer = list(loss_model.named_parameters())
+        optimizer = torch.optim.AdamW([
+            {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)], 'weight_decay': 0.01},
+            {'params': [p for n, p in param_optimizer if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
+        ], lr=2e-5, eps=1e-6)
+        scheduler = get_linear_schedule_with_warmup(
+            optimizer, num_warmup_steps=warmup_steps, num_training_steps=steps_per_epoch * self.epochs
+        )
+
+        start_epoch, start_step, global_step, best_score = 0, 0, 0, -9999999
+        if checkpoint is not None:
+            loss_model.load_state_dict(checkpoint["model"])
+            optimizer.load_state_dict(checkpoint["optimizer"])
+            scheduler.load_state_dict(checkpoint["scheduler"])
+            rng_states = checkpoint["rng_states"]
+            self.set_rng_state(rng_states[rank % len(rng_states)])
+            start_epoch, start_step = checkpoint["epoch"], checkpoint["step"]
+            global_step, best_score = checkpoint["global_step"], checkpoint["best_score"]
+
+        def evaluate(epoch, steps):
+            nonlocal best_score
+            if rank != 0:
+                return
+            score = evaluator(bert_model, output_path=output_path, epoch=epoch, steps=steps)
+            if score > best_score:
+                best_score = score
+                bert_model.save(output_path)
+            loss_model.zero_grad()
+            loss_model.train()
+
+        def save_checkpoint(epoch, step):
+            rng_states = [self.get_rng_state()]
+            if distributed:
+                rng_states = [None] * num_replicas
+                dist.all_gather_object(rng_states, self.get_rng_state())
+            if rank != 0:
+                return
+            self.save_checkpoint(checkpoint_path, {
+                "model": loss_model.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "scheduler": scheduler.state_dict(),
+                "rng_states": rng_states,
+                "seed": self.seed,
+                "dataset_fingerprint": self.dataset_fingerprint,
+                "epoch": epoch,
+                "step": step,
+                "global_step": global_step,
+                "best_score": best_score
+            })
+
+        for epoch in range(start_epoch, self.epochs):
+            step = start_step if epoch == start_epoch else 0
+            train_dataloader.batch_sampler.set_epoch(epoch, start=step)
+            loss_model.zero_grad()
+            loss_model.train()
+
+            for features, labels in tqdm(train_dataloader, desc="Epoch {}".format(epoch + 1), initial=step, smoothing=0.05):
+                loss_value = train_model(features, labels)
+                loss_value.backward()
+                torch.nn.utils.clip_grad_norm_(loss_model.parameters(), 1)
+                optimizer.step()
+                optimizer.zero_grad()
+                scheduler.step()
+
+                step += 1
+                global_step += 1
+
+                if self.evaluation_steps > 0 and step % self.evaluation_steps == 0:
+                    evaluate(epoch, step)
+                if checkpoint_path and self.checkpoint_steps and global_step % self.checkpoint_steps == 0 and step < steps_per_epoch:
+                    save_checkpoint(epoch, step)
+
+            evaluate(epoch, -1)
+            if checkpoint_path:
+                save_checkpoint(epoch + 1, 0)
+
+        return bert_model
+
+    def train_distributed(self, bert_model, train_samples, val_samples, output_path, checkpoint_path=None):
+        """ Train model with num_workers CPU data-parallel worker processes, see train.
+        Workers shard the batches of the train set, all-reduce gradients over gloo,
+        and worker 0 evaluates, saves the model and writes checkpoints.
+
+        :param bert_model: BERT pre-trained model
+        :param train_samples: train triplets
+        :param val_samples: validation triplets
+        :param output_path: path to save model
+        :param checkpoint_path: checkpoint directory, no checkpoints if None
+        """
+        if device.type != 'cpu':
+            raise ValueError("error, num_workers > 1 is supported on CPU only")
+        if self.seed is None:
+            self.seed = int(torch.randint(2 ** 31, (1,)))
+
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind(("127.0.0.1", 0))
+            init_method = "tcp://127.0.0.1:{}".format(s.getsockname()[1])
+
+        logging.info("Training with {} worker processes".format(self.num_workers))
+        torch.multiprocessing.spawn(
+            train_worker, args=(self, train_samples, val_samples, output_path, checkpoint_path, init_method),
+            nprocs=self.num_workers
+        )
 
     def evaluate(self, test_samples, output_path):
         """ Evaluate generated model using test triplets
@@ -11,8 +11,10 @@ class FAQ_BERT_Ranker(object):
     :param bert_model_path: bert model path
     :param rank_field: BERT prediction for rank_field answer or question
     :param w_t: weight parameter used for re-ranking of ES score
+    :param as_of: month of the timeline snapshot used for search_mode='history'
+    :param score_cache: ScoreCache instance used to reuse BERT scores across queries
     """
-    def __init__(self, es, index, fields, top_k, bert_model_path, search_mode='current', rank_field='BERT-Q-a', w_t=10):
+    def __init__(self, es, index, fields, top_k, bert_model_path, search_mode='current', rank_field='BERT-Q-a', w_t=10, as_of=None, score_cache=None):
         self.es = es
         self.index = index
         self.fields = fields
@@ -21,12 +23,15 @@ class FAQ_BERT_Ranker(object):
         self.search_mode = search_mode
         self.rank_field = rank_field
         self.w_t = w_t
+        self.as_of = as_of
+        self.score_cache = score_cache
+        self.faq_bert = None
         
         self.searcher = None
         if self.search_mode == 'current':
             self.searcher = Searcher(es, index, fields, top_k)
         else:
-            self.searcher = History_Searcher(es, index, fields, top_k)
+            self.searcher = History_Searcher(es, index, fields, top_k, as_of)
 
         self.es_topk_results = []
         self.bert_topk_preds = []
@@ -70,31 +75,52 @@ class FAQ_BERT_Ranker(object):
     
         return es_topk_results
 
+    def get_faq_bert(self, reload=False):
+        """ Load FAQ_BERT model once per FAQ_BERT_Ranker instance
+
+        :param reload: load the model again, e.g. to benchmark loading it
+        :return: FAQ_BERT instance
+        """
+        if self.faq_bert is None or reload:
+            self.faq_bert = FAQ_BERT(bert_model_path=self.bert_model_path)
+        return self.faq_bert
+
+    def get_bert_scores(self, query_string, candidates):
+        """ Predict BERT scores of a query against candidates, reusing cached scores if a score cache is set
+
+        :param query_string: input query
+        :param candidates: list of candidate answers or questions
+        :return: list of scores aligned with candidates
+        """
+        predict = lambda query, candidate: self.get_faq_bert().predict(query, candidate)
+        if self.score_cache is None:
+            return [predict(query_string, candidate) for candidate in candidates]
+        return self.score_cache.get_scores(self.bert_model_path, self.rank_field, query_string, candidates, predict)
+
     def get_bert_topk_preds(self, es_topk_results):
         """ Get BERT top-k predictions by rank field 
         
         :param es_topk_results: Python dictionary
         :return: BERT predictions on ES top-k results
         """
-        faq_bert = FAQ_BERT(bert_model_path=self.bert_model_path)
-
         bert_topk_preds = []
         
         query_string = es_topk_results['query_string']
         topk_results = es_topk_results['topk_results']
 
-        for doc in topk_results:
+        if self.rank_field == "BERT-Q-a":
+            candidates = [doc['answer'] for doc in topk_results]
+        elif self.rank_field == "BERT-Q-q":
+            candidates = [doc['question'] for doc in topk_results]
+        else:
+            raise ValueError("error, no rank_field found for {}".format(self.rank_field))
+
+        bert_scores = self.get_bert_scores(query_string, candidates)
+
+        for doc, bert_score in zip(topk_results, bert_scores):
             question = doc['question']
             answer = doc['answer']
             es_score = doc['es_score']
-            
-            bert_score = 0
-            if self.rank_field == "BERT-Q-a":
-                bert_score = faq_bert.predict(query_string, answer)
-            elif self.rank_field == "BERT-Q-q":
-                bert_score = faq_bert.predict(query_string, question)
-            else:
-                raise ValueError("error, no rank_field found for {}".format(self.rank_field))
 
             if self.search_mode == 'current':
                 bert_topk_preds.append(
@@ -166,6 +192,17 @@ class FAQ_BERT_Ranker(object):
         
         return ranked_results
 
+    def get_stages(self):
+        """ Get the stages of rank_results, used to benchmark them one at a time
+
+        :return: list of (stage name, function)
+        """
+        return [
+            ("es", self.get_es_topk_results),
+            ("bert", self.get_bert_topk_preds),
+            ("rerank", self.get_ranked_results)
+        ]
+
     def rank_results(self, query_string):
         """ Rank ES top-k results for a given input query string 
             using BERT pretrained model
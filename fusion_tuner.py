@@ -0,0 +1,236 @@
+from evaluation import Evaluation
+from evaluation import load_rank_results
+from evaluation import compute_ap_scores
+from evaluation import compute_prec_scores
+from evaluation import compute_ndcg_scores
+from tqdm import tqdm
+import pandas as pd
+import numpy as np
+import argparse
+import logging
+import os.path
+import time
+
+logging.basicConfig(
+    format="%(asctime)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    level=logging.INFO
+)
+
+# constant of reciprocal rank fusion
+RRF_K = 60
+
+def get_fusion_arrays(query_results, valid_queries):
+    """ Load BERT top-k predictions of valid queries into padded label, ES score and BERT score arrays
+
+    :param query_results: iterable of query strings and associated topk_preds
+    :param valid_queries: query strings to evaluate
+    :return: labels, ES scores, BERT scores (num_queries x max_len), number of results per query
+    """
+    rows = []
+    for result in query_results:
+        if result['query_string'] in valid_queries:
+            rows.append((
+                [pred['label'] for pred in result['topk_preds']],
+                [pred['es_score'] for pred in result['topk_preds']],
+                [pred['bert_score'] for pred in result['topk_preds']]
+            ))
+
+    lengths = np.array([len(row_labels) for row_labels, _, _ in rows], dtype=int)
+    max_len = int(lengths.max()) if len(rows) else 0
+
+    labels = np.zeros((len(rows), max_len))
+    es_scores = np.zeros((len(rows), max_len))
+    bert_scores = np.zeros((len(rows), max_len))
+    for i, (row_labels, row_es_scores, row_bert_scores) in enumerate(rows):
+        labels[i, :lengths[i]] = row_labels
+        es_scores[i, :lengths[i]] = row_es_scores
+        bert_scores[i, :lengths[i]] = row_bert_scores
+
+    return labels, es_scores, bert_scores, lengths
+
+def minmax_scores(scores, valid):
+    """ Scale scores of each query to [0, 1] over its valid results
+
+    :param scores: padded score array
+    :param valid: mask of valid results
+    :return: scaled score array
+    """
+    low = np.where(valid, scores, np.inf).min(axis=1, keepdims=True)
+    high = np.where(valid, scores, -np.inf).max(axis=1, keepdims=True)
+    scale = np.where(high > low, high - low, 1)
+    return np.where(valid, (scores - low) / scale, 0.0)
+
+def rank_scores(scores, valid):
+    """ Get the 1-based rank of each result of a query by descending score
+
+    :param scores: padded score array
+    :param valid: mask of valid results
+    :return: rank array
+    """
+    order = np.argsort(-np.where(valid, scores, -np.inf), axis=1, kind='stable')
+    return np.argsort(order, axis=1) + 1
+
+def linear_fusion(es_scores, bert_scores, valid, weights):
+    """ w_t * es_score + bert_score, as used by ReRanker and FAQ_BERT_Ranker """
+    return weights * es_scores + bert_scores
+
+def minmax_fusion(es_scores, bert_scores, valid, weights):
+    """ w_t * es_score + bert_score with both scores min-max scaled per query """
+    return weights * minmax_scores(es_scores, valid) + minmax_scores(bert_scores, valid)
+
+def rrf_fusion(es_scores, bert_scores, valid, weights):
+    """ weighted reciprocal rank fusion, w_t / (k + es_rank) + 1 / (k + bert_rank) """
+    return weights / (RRF_K + rank_scores(es_scores, valid)) + 1 / (RRF_K + rank_scores(bert_scores, valid))
+
+FUSIONS = {
+    "linear": linear_fusion,
+    "minmax": minmax_fusion,
+    "rrf": rrf_fusion
+}
+
+def compute_fusion_metrics(labels, es_scores, bert_scores, lengths, weights, fusion="linear", top_k=[2, 3, 5]):
+    """ Compute MAP, P@k and NDCG@k of every w_t at once.
+    Fused scores of all weights are stacked into one (num_weights * num_queries) x max_len array
+    and ranked with a single argsort, the way get_reranked_results sorts each query.
+
+    :param labels: padded label array
+    :param es_scores: padded ES score array
+    :param bert_scores: padded BERT score array
+    :param lengths: number of results per query
+    :param weights: list of w_t
+    :param fusion: fusion function name, one of FUSIONS
+    :param top_k: list of top k
+    :return: dictionary (metric name: key, array of mean score per w_t: value)
+    """
+    if fusion not in FUSIONS:
+        raise ValueError("error, no fusion found for {}".format(fusion))
+
+    num_weights = len(weights)
+    num_queries, max_len = labels.shape
+    valid = np.arange(max_len) < lengths[:, None]
+
+    fused = FUSIONS[fusion](es_scores, bert_scores, valid, np.asarray(weights, dtype=float)[:, None, None])
+    fused = np.where(valid[None], fused, -np.inf).reshape(num_weights * num_queries, max_len)
+    labels = np.tile(labels, (num_weights, 1))
+    lengths = np.tile(lengths, num_weights)
+
+    # sort each query by fused score, NDCG and P@k read the first k results
+    order = np.argsort(-fused, axis=1, kind='stable')
+    labels = np.take_along_axis(labels, order, axis=1)
+    fused = np.take_along_axis(fused, order, axis=1)
+
+    metrics = dict()
+    for k in top_k:
+        metrics["NDCG@{}".format(k)] = compute_ndcg_scores(labels, fused, lengths, k).reshape(num_weights, num_queries)
+    for k in top_k:
+        metrics["P@{}".format(k)] = compute_prec_scores(labels, lengths, k).reshape(num_weights, num_queries)
+    metrics["MAP"] = compute_ap_scores(labels, fused).reshape(num_weights, num_queries)
+
+    return {name: scores.mean(axis=1) if num_queries else np.zeros(num_weights) for name, scores in metrics.items()}
+
+class FusionTuner(Evaluation):
+    """ Class for tuning the fusion of ES and BERT scores over a grid of w_t and fusion functions.
+    BERT top-k predictions (bert_query_by_<field>.json) are loaded once per file, and all
+    configurations are evaluated from the cached score arrays without running ES or BERT.
+
+    Takes the parameters of Evaluation.
+
+    :param weights: list of w_t
+    :param fusions: list of fusion function names, see FUSIONS
+    """
+
+    def __init__(self, qas_filename, rank_results_filepath, weights=[0, 0.5, 1, 2, 5, 10, 20, 50], fusions=["linear", "minmax", "rrf"], **kwargs):
+        super(FusionTuner, self).__init__(qas_filename, rank_results_filepath, **kwargs)
+        self.weights = weights
+        self.fusions = fusions
+
+    def get_bert_result_filepaths(self):
+        """ Get the BERT prediction files of the supervised grid
+
+        :return: list of (rank_field, loss_type, query_type, neg_type, match_field, filepath) of existing files
+        """
+        match_fields = ["answer", "question", "question_answer", "question_answer_concat"]
+        filepaths = []
+
+        for rank_field in self.rank_fields:
+            for loss_type in self.loss_types:
+                for query_type in self.query_types:
+                    for neg_type in self.neg_types:
+                        file_path = self.rank_results_filepath + "/supervised/" + self.test_data + "/" + rank_field + "/" + loss_type + "/" + query_type + "/" + neg_type
+                        for field in match_fields:
+                            filepath = self.get_result_filepath(file_path + "/bert_query_by_" + field + ".json")
+                            if os.path.isfile(filepath):
+                                filepaths.append((rank_field, loss_type, query_type, neg_type, field, filepath))
+
+        return filepaths
+
+    def get_fusion_df(self):
+        """ Evaluate every BERT prediction file over the grid of fusions and w_t
+
+        :return: DataFrame with one row per configuration, fusion and w_t
+        """
+        rows = []
+        for rank_field, loss_type, query_type, neg_type, match_field, filepath in tqdm(self.get_bert_result_filepaths()):
+            query_results = load_rank_results(filepath)
+            labels, es_scores, bert_scores, lengths = get_fusion_arrays(query_results, self.valid_queries)
+
+            start = time.time()
+            for fusion in self.fusions:
+                metrics = compute_fusion_metrics(labels, es_scores, bert_scores, lengths, self.weights, fusion, self.top_k)
+                for i, w_t in enumerate(self.weights):
+                    row = {
+                        "Matching Field"    : match_field,
+                        "Ranking Field"     : rank_field,
+                        "Loss"              : loss_type,
+                        "Training Data"     : query_type,
+                        "Negative Sampling" : neg_type,
+                        "Fusion"            : fusion,
+                        "w_t"               : w_t
+                    }
+                    for name, scores in metrics.items():
+                        row[name] = round(float(scores[i]), 4)
+                    rows.append(row)
+            logging.info("{} tuned over {} configurations in {:.3f}s".format(
+                filepath, len(self.fusions) * len(self.weights), time.time() - start))
+
+        return pd.DataFrame(rows)
+
+    def get_best_configs(self, metric="NDCG@5"):
+        """ Get the best fusion and w_t of each BERT model and matching field
+
+        :param metric: metric to maximize e.g. NDCG@5, P@3, MAP
+        :return: DataFrame of best configurations sorted by metric
+        """
+        df = self.get_fusion_df()
+        if df.empty:
+            return df
+
+        config = ["Matching Field", "Ranking Field", "Loss", "Training Data", "Negative Sampling"]
+        best = df.loc[df.groupby(config)[metric].idxmax()]
+        return best.sort_values(metric, ascending=False).reset_index(drop=True)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Grid search of the ES and BERT score fusion")
+    parser.add_argument('--datasets', nargs='+', default=['CovidFAQ', 'StackFAQ', 'FAQIR'])
+    parser.add_argument('--test_data', default='user_query', choices=['synthetic', 'user_query'])
+    parser.add_argument('--jc_threshold', type=float, default=1.0)
+    parser.add_argument('--weights', nargs='+', type=float, default=[0, 0.5, 1, 2, 5, 10, 20, 50])
+    parser.add_argument('--fusions', nargs='+', default=list(FUSIONS.keys()))
+    parser.add_argument('--metric', default='NDCG@5')
+    args = parser.parse_args()
+
+    for dataset in args.datasets:
+        tuner = FusionTuner(
+            qas_filename="data/" + dataset + "/query_answer_pairs.json",
+            rank_results_filepath="data/" + dataset + "/rank_results",
+            weights=args.weights, fusions=args.fusions,
+            jc_threshold=args.jc_threshold, test_data=args.test_data
+        )
+        best = tuner.get_best_configs(args.metric)
+        if best.empty:
+            print("{}: no BERT predictions found".format(dataset))
+            continue
+        print("{} best configuration by {}:".format(dataset, args.metric))
+        print(best.head(1).T.to_string(header=False))
@@ -42,12 +42,11 @@ class SyntheticQueryGenerator(object):
         
         synthetic_query_answer_pairs = []
 
-        for _, row in relevance_label_df.iterrows():
-            
-            answer = row['answer']
-            question = row['question']
-            label = row['label']
-            _id = row['id']
+        rows = zip(
+            relevance_label_df['answer'].tolist(), relevance_label_df['question'].tolist(),
+            relevance_label_df['label'].tolist(), relevance_label_df['id'].tolist()
+        )
+        for answer, question, label, _id in rows:
 
             answer = remove_urls(answer)
             t5_qas = self.generate_synthetic_qas(answer)
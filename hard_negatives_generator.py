@@ -1,28 +1,157 @@
 from evaluation import get_relevance_label_df
-from evaluation import get_relevance_label
+from evaluation import Qrels
 from shared.utils import load_from_json
 from shared.utils import dump_to_json
+from shared.utils import make_dirs
+from shared.utils import truncate_jsonl
 from searcher import Searcher
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from tqdm import tqdm
 import pandas as pd
+import numpy as np
+import logging
 import random
+import json
+import time
+import os
 
 class Hard_Negatives_Generator(object):
-    def __init__(self, es, index, query_by, top_k=10, query_type='faq'):
+    """ Class for mining hard negative question-answer pairs with Elasticsearch (BM25) or a bi-encoder
+
+    :param es: Elasticsearch instance, not used for dense mining
+    :param index: Elasticsearch index name, not used for dense mining
+    :param query_by: field(s) the query is matched against e.g. answer, question, question_answer
+    :param top_k: number of retrieved candidates per query, true answers among them are dropped
+    :param query_type: faq or user_query
+    :param num_workers: maximum number of concurrent ES queries
+    :param max_retries: number of retries of a failed ES query
+    :param retry_delay: seconds to wait before the first retry, doubled after each failed retry
+    """
+    def __init__(self, es, index, query_by, top_k=10, query_type='faq', num_workers=1, max_retries=3, retry_delay=0.5):
         self.es = es
         self.index = index
         self.query_by = query_by
         self.top_k = top_k
         self.query_type = query_type
+        self.num_workers = num_workers
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+    def query_with_retries(self, query_string):
+        """ Get ES top-k results of a query, retrying failed requests with exponential backoff
+
+        :param query_string: query string
+        :return: ES results
+        """
+        # one Searcher per query, as Searcher keeps the state of its last query
+        s = Searcher(self.es, index=self.index, fields=self.query_by, top_k=self.top_k)
+        for attempt in range(self.max_retries + 1):
+            try:
+                return s.query(query_string=query_string, raise_errors=True)
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+                logging.warning("Retrying query {!r} after failed attempt {}".format(query_string, attempt + 1))
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+    def get_query_hard_negatives(self, query_string, qrels):
+        """ Get hard negative question-answer pairs of a single query
+
+        :param query_string: query string
+        :param qrels: relevance judgments index
+        :return: list of hard negatives ranked from 1
+        """
+        # perform query using question as query_string
+        topk_results = self.query_with_retries(query_string)
+
+        # obtain relevance label for each answer
+        results = []
+        rank = 0
+        for doc in topk_results:
+            topk_answer = doc['answer']
+
+            # check if the answer is a true answer
+            label = qrels.get_label(query_string, topk_answer)
+
+            if label == 0:
+                rank += 1
+                data = dict()
+                data["query_string"] = query_string
+                data["neg_answer"] = doc["answer"]
+                data["question"] = doc["question"]
+                data["question_answer"] = doc["question_answer"]
+                data["score"] = doc["score"]
+                data["label"] = label
+                data["rank"] = rank
+                results.append(data)
+
+        return results
+
+    def iter_concurrent(self, query_strings, qrels):
+        """ Get hard negatives of each query from a thread pool of num_workers threads,
+        yielding them in the order of query_strings. Queries are submitted a few at a time
+        ahead of the one being yielded, so only a bounded number of results is buffered.
 
-    def get_hard_negatives(self, relevance_label_df):
-        """ Get a list of hard negative question-answer pairs """
+        :param query_strings: list of query strings
+        :param qrels: relevance judgments index
+        :return: generator of hard negative lists, one per query string
+        """
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            try:
+                for query_string in query_strings:
+                    pending.append(executor.submit(self.get_query_hard_negatives, query_string, qrels))
+                    if len(pending) >= 2 * self.num_workers:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                # drop queued queries after a failure or an early exit
+                for future in pending:
+                    future.cancel()
 
-        # define Searcher instance
-        s = Searcher(self.es, index=self.index, fields=self.query_by , top_k=self.top_k)
+    def get_completed_queries(self, output_filepath):
+        """ Get query strings whose hard negatives are fully written to a JSONL output file.
+        An interrupted run may have written only part of the last query, so its records are
+        dropped along with a partially written last line, and the query is mined again.
 
-        # Generate a dictionary where {key: query_string, value: list of answers}
-        relevance_label = get_relevance_label(relevance_label_df)
+        :param output_filepath: JSONL output filepath
+        :return: set of query strings
+        """
+        if not os.path.isfile(output_filepath):
+            return set()
+        truncate_jsonl(output_filepath)
+
+        completed = set()
+        last_query = None
+        last_start = offset = 0
+        with open(output_filepath, 'rb') as f:
+            for line in f:
+                query_string = json.loads(line)['query_string']
+                if query_string != last_query:
+                    if last_query is not None:
+                        completed.add(last_query)
+                    last_query, last_start = query_string, offset
+                offset += len(line)
+
+        with open(output_filepath, 'rb+') as f:
+            f.truncate(last_start)
+        return completed
+
+    def get_hard_negatives(self, relevance_label_df, qrels=None, output_filepath=None):
+        """ Get a list of hard negative question-answer pairs.
+        With num_workers > 1 queries are sent concurrently, results keep the order of the serial run.
+
+        :param relevance_label_df: dataframe of relevance labels
+        :param qrels: relevance judgments index, built from relevance_label_df if not given
+        :param output_filepath: if given, JSONL filepath the hard negatives are streamed to as queries complete,
+            appending to the file of an interrupted run and skipping its completed queries
+        :return: list of hard negatives, or output_filepath if given
+        """
+        relevance_label_df.rename(columns={'question': 'query_string'}, inplace=True)
+        if qrels is None:
+            qrels = Qrels(relevance_label_df)
 
         unique_questions = []
         
@@ -32,36 +161,165 @@ class Hard_Negatives_Generator(object):
         else:
             unique_questions = relevance_label_df.query_string.unique()
 
+        if output_filepath is not None:
+            completed = self.get_completed_queries(output_filepath)
+            logging.info("Resuming after {} completed queries".format(len(completed)))
+            unique_questions = [query_string for query_string in unique_questions if query_string not in completed]
+
+        if self.num_workers > 1:
+            query_results = self.iter_concurrent(unique_questions, qrels)
+        else:
+            query_results = (self.get_query_hard_negatives(query_string, qrels) for query_string in unique_questions)
+
+        if output_filepath is None:
+            results = []
+            for query_hard_negatives in tqdm(query_results, total=len(unique_questions)):
+                results.extend(query_hard_negatives)
+            return results
+
+        with open(output_filepath, 'a', encoding='utf-8') as f:
+            for query_hard_negatives in tqdm(query_results, total=len(unique_questions)):
+                f.write("".join(json.dumps(data) + "\n" for data in query_hard_negatives))
+                f.flush()
+
+        return output_filepath
+
+    def get_dense_hard_negatives(self, relevance_label_df, bert_model_path, qrels=None, batch_size=64):
+        """ Get a list of hard negative question-answer pairs retrieved by a bi-encoder.
+        Every query and FAQ is encoded once, and the top_k FAQs of all queries are selected
+        from batched similarity matrix products. The output has the schema of get_hard_negatives.
+
+        :param relevance_label_df: dataframe of relevance labels
+        :param bert_model_path: bi-encoder (SentenceTransformer) model path or name
+        :param qrels: relevance judgments index, built from relevance_label_df if not given
+        :param batch_size: number of texts per encoding batch and queries per similarity product
+        """
+        df = relevance_label_df.rename(columns={'question': 'query_string'})
+        if qrels is None:
+            qrels = Qrels(df)
+
+        if self.query_type == "faq":
+            unique_questions = df[df['query_type'] == self.query_type].query_string.unique()
+        else:
+            unique_questions = df.query_string.unique()
+
+        # FAQ documents, as indexed for the ES mode
+        docs = df[df['query_type'] == 'faq'].drop_duplicates(['query_string', 'answer'])
+        doc_questions = docs['query_string'].tolist()
+        doc_answers = docs['answer'].tolist()
+        doc_question_answers = [q + " " + a for q, a in zip(doc_questions, doc_answers)]
+        # intern the FAQ answers once, so that labels are looked up by id
+        doc_answer_ids = qrels.get_answer_ids(doc_answers)
+
+        if self.query_by in ('question', ['question']):
+            doc_texts = doc_questions
+        elif self.query_by in ('answer', ['answer']):
+            doc_texts = doc_answers
+        else:
+            doc_texts = doc_question_answers
+
+        # argpartition needs 0 < top_k <= number of FAQs
+        top_k = min(self.top_k, len(doc_texts))
+        if top_k <= 0 or len(unique_questions) == 0:
+            logging.info("No FAQs to mine hard negatives from with top_k={}".format(self.top_k))
+            return []
+
+        # imported here, so that ES mining does not load torch
+        from sentence_transformers import SentenceTransformer
+
+        model = SentenceTransformer(bert_model_path)
+
+        def encode(texts):
+            embeddings = model.encode(list(texts), batch_size=batch_size, convert_to_numpy=True, show_progress_bar=True)
+            return embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+        logging.info("Encoding {} queries and {} FAQs".format(len(unique_questions), len(doc_texts)))
+        query_embeddings = encode(unique_questions)
+        doc_embeddings = encode(doc_texts)
+
         results = []
-        for query_string in tqdm(unique_questions):
-
-            # perform query using question as query_string
-            topk_results = s.query(query_string=query_string)
-
-            # get the list of actual answers
-            answers = relevance_label[query_string]
-
-            # obtain relevance label for each answer
-            rank = 0
-            for doc in topk_results:
-                topk_answer = doc['answer']
-
-                # check if the answer is a true answer
-                label = 0
-                
-                if topk_answer in answers:
-                    label = 1
-
-                if label == 0:
-                    rank += 1
-                    data = dict()
-                    data["query_string"] = query_string
-                    data["neg_answer"] = doc["answer"]
-                    data["question"] = doc["question"]
-                    data["question_answer"] = doc["question_answer"]
-                    data["score"] = doc["score"]
-                    data["label"] = label
-                    data["rank"] = rank
-                    results.append(data) 
+        for start in tqdm(range(0, len(unique_questions), batch_size)):
+            scores = query_embeddings[start:start + batch_size] @ doc_embeddings.T
+
+            # select the top_k FAQs of each query, then sort them by descending score
+            topk = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+            topk_scores = np.take_along_axis(scores, topk, axis=1)
+            order = np.argsort(-topk_scores, axis=1, kind='stable')
+            topk = np.take_along_axis(topk, order, axis=1)
+            topk_scores = np.take_along_axis(topk_scores, order, axis=1)
+
+            for query_string, doc_ids, doc_scores in zip(unique_questions[start:start + batch_size], topk, topk_scores):
+                rank = 0
+                query_id = qrels.query2id.get(query_string)
+                for doc_id, score in zip(doc_ids, doc_scores):
+                    # skip true answers
+                    label = 1 if qrels.is_relevant_id(query_id, doc_answer_ids[doc_id]) else 0
+                    if label == 0:
+                        rank += 1
+                        data = dict()
+                        data["query_string"] = query_string
+                        data["neg_answer"] = doc_answers[doc_id]
+                        data["question"] = doc_questions[doc_id]
+                        data["question_answer"] = doc_question_answers[doc_id]
+                        data["score"] = float(score)
+                        data["label"] = label
+                        data["rank"] = rank
+                        results.append(data)
 
         return results
+
+    def get_finetune(self, query_answer_pairs, output_path, **finetuning_kwargs):
+        """ Get the finetune function of get_self_mined_hard_negatives, training a triplet bi-encoder
+        with FAQ_BERT_Finetuning.create_model on the hard negative triplets of each round
+
+        :param query_answer_pairs: question-answer pair list, the positives of the triplets
+        :param output_path: output path of FAQ_BERT_Finetuning, hard negatives of round i are saved to <output_path>/round_<i>
+        :param finetuning_kwargs: other FAQ_BERT_Finetuning parameters e.g. epochs, batch_size, pre_trained_name
+        :return: function (hard negatives, round) returning the path of the finetuned model
+        """
+        # imported here, so that ES mining does not load torch
+        from training_data_generator import Training_Data_Generator
+        from faq_bert_finetuning import FAQ_BERT_Finetuning
+
+        def finetune(hard_negatives, round):
+            round_path = output_path + "/round_{}".format(round)
+            make_dirs(round_path)
+            dump_to_json(hard_negatives, round_path + "/hard_negatives_{}.json".format(self.query_type))
+
+            tdg = Training_Data_Generator(neg_type='hard', query_type=self.query_type, loss_type='triplet', hard_filepath=round_path)
+            df = pd.concat(list(tdg.generate_dataset_chunks(query_answer_pairs)), ignore_index=True)
+
+            version = "round_{}".format(round)
+            finetuning = FAQ_BERT_Finetuning(
+                loss_type='triplet', query_type=self.query_type, neg_type='hard', version=version, **finetuning_kwargs
+            )
+            finetuning.create_model(df, output_path)
+
+            model_path = output_path + "/models/triplet_hard_{}_{}".format(self.query_type, version)
+            if not os.path.isfile(model_path + "/modules.json"):
+                raise ValueError("error, finetuning round {} did not save a model to {}".format(round, model_path))
+            return model_path
+
+        return finetune
+
+    def get_self_mined_hard_negatives(self, relevance_label_df, bert_model_path, finetune, num_rounds=2, qrels=None, batch_size=64):
+        """ Mine hard negatives over several rounds, each round with the model finetuned on the previous negatives
+
+        :param relevance_label_df: dataframe of relevance labels
+        :param bert_model_path: bi-encoder model path used for the first round
+        :param finetune: function (hard negatives, round) returning the path of a model trained on them, see get_finetune
+        :param num_rounds: number of mining rounds
+        :param qrels: relevance judgments index, built from relevance_label_df if not given
+        :param batch_size: number of texts per encoding batch and queries per similarity product
+        :return: hard negatives of the last round
+        """
+        hard_negatives = []
+        for i in range(num_rounds):
+            logging.info("Mining round {} with {}".format(i + 1, bert_model_path))
+            hard_negatives = self.get_dense_hard_negatives(relevance_label_df, bert_model_path, qrels, batch_size)
+            # nothing to finetune on
+            if not hard_negatives:
+                break
+            if i + 1 < num_rounds:
+                bert_model_path = finetune(hard_negatives, i + 1)
+        return hard_negatives
@@ -2,6 +2,13 @@ from elasticsearch_dsl import Index, Document, Integer, Text, analyzer, Keyword,
 from elasticsearch_dsl.connections import connections
 from elasticsearch import Elasticsearch, helpers
 from evaluation import get_relevance_label_df
+from indexer import bulk_index
+from indexer import get_generation_name
+from indexer import warm_index
+from indexer import swap_alias
+from indexer import cleanup_generations
+from indexer import validate_generation
+from shared.utils import iter_records
 from datetime import datetime
 from tqdm import tqdm
 import pandas as pd
@@ -18,65 +25,117 @@ class QA(Document):
     dateScraped = Keyword()
     date = Keyword()
     month = Keyword()
+    valid_from = Keyword()  # first month the FAQ is part of the timeline
+    valid_to = Keyword()    # first month the FAQ is no longer part of it, None if still valid
     question = Text(analyzer='snowball')
     answer = Text(analyzer='snowball')
     question_answer = Text(analyzer='snowball')
 
-def ingest_history_data(data, es, index):
-    """ Ingest data as a bulk of documents to ES index """
-
-    try:
-        docs = []
-        for pair in tqdm(data):
-            # initialize QA document
-            doc = QA()
-
-            if 'normTopic' in pair:
-                doc.topic = pair['normTopic']
-            if 'sourceUrl' in pair:
-                doc.sourceUrl = pair['wayBackUrl']
-            if 'sourceUrl' in pair:
-                doc.orgSourceUrl = pair['sourceUrl']
-            if 'sourceName' in pair:
-                doc.sourceName = pair['sourceName']
-            if 'dateScraped' in pair:
-                doc.dateScraped = pair['dateScraped']
-            if 'date' in pair:
-                date = str(pair['date'])
-                year = date[:4]
-                month = date[4:6]
-                day = date[-2:]
-                doc.date = day + "/" + month + "/" + year
-            if 'month' in pair:
-                doc.month = pair['month']
-            if 'question' in pair:
-                doc.question = pair['question']
-            if 'answer' in pair:
-                doc.answer = pair['answer']
-            if 'question' in pair and 'answer' in pair:
-                doc.question_answer = pair['question'] + " " + pair['answer']
-
-            docs.append(doc.to_dict(include_meta=False))
-
-        # bulk indexing
-        response = helpers.bulk(es, actions=docs, index=index, doc_type='doc')
-            
-    except Exception:
-        logging.error('exception occured', exc_info=True)
-
-def get_history_qa_pairs(filename):
-    """ Get faq qa pair list """
+def generate_history_docs(data):
+    """ Generate QA documents one at a time from history qa pairs
+
+    :param data: iterable of history qa pair dictionaries
+    :return: generator of QA documents as dictionaries
+    """
+    for pair in tqdm(data):
+        # initialize QA document
+        doc = QA()
+
+        if 'normTopic' in pair:
+            doc.topic = pair['normTopic']
+        if 'sourceUrl' in pair:
+            doc.sourceUrl = pair['wayBackUrl']
+        if 'sourceUrl' in pair:
+            doc.orgSourceUrl = pair['sourceUrl']
+        if 'sourceName' in pair:
+            doc.sourceName = pair['sourceName']
+        if 'dateScraped' in pair:
+            doc.dateScraped = pair['dateScraped']
+        if 'date' in pair:
+            date = str(pair['date'])
+            year = date[:4]
+            month = date[4:6]
+            day = date[-2:]
+            doc.date = day + "/" + month + "/" + year
+        if 'month' in pair:
+            doc.month = pair['month']
+        if 'valid_from' in pair:
+            doc.valid_from = pair['valid_from']
+        if 'valid_to' in pair and isinstance(pair['valid_to'], str):
+            doc.valid_to = pair['valid_to']
+        if 'question' in pair:
+            doc.question = pair['question']
+        if 'answer' in pair:
+            doc.answer = pair['answer']
+        if 'question' in pair and 'answer' in pair:
+            doc.question_answer = pair['question'] + " " + pair['answer']
+
+        yield doc.to_dict(include_meta=False)
+
+def build_history_docs(df):
+    """ Build QA document columns from a history qa pair dataframe
+
+    :param df: history qa pair dataframe
+    :return: dataframe with QA document columns
+    """
+    docs = pd.DataFrame(index=df.index)
+    if 'normTopic' in df.columns:
+        docs['topic'] = df['normTopic']
+    if 'sourceUrl' in df.columns:
+        docs['sourceUrl'] = df['wayBackUrl']
+        docs['orgSourceUrl'] = df['sourceUrl']
+    for field in ['sourceName', 'dateScraped']:
+        if field in df.columns:
+            docs[field] = df[field]
+    if 'date' in df.columns:
+        # reformat yyyymmdd to dd/mm/yyyy
+        date = df['date'].astype(str)
+        docs['date'] = date.str[-2:] + "/" + date.str[4:6] + "/" + date.str[:4]
+    for field in ['month', 'valid_from', 'valid_to', 'question', 'answer']:
+        if field in df.columns:
+            docs[field] = df[field]
+    if 'question' in df.columns and 'answer' in df.columns:
+        docs['question_answer'] = df['question'] + " " + df['answer']
+    return docs
+
+def ingest_history_data(data, es, index, chunk_size=500, thread_count=4):
+    """ Ingest data as a stream of bulk requests to ES index
+
+    :param data: history qa pair dataframe or iterable of history qa pair dictionaries
+    :param es: Elasticsearch instance
+    :param index: Elasticsearch index name
+    :param chunk_size: number of documents per bulk request
+    :param thread_count: number of threads used for bulk indexing
+    :return: number of indexed documents, number of errors
+    """
+    if isinstance(data, pd.DataFrame):
+        docs = tqdm(iter_records(build_history_docs(data)), total=len(data))
+    else:
+        docs = generate_history_docs(data)
+    return bulk_index(es, docs, index, chunk_size=chunk_size, thread_count=thread_count)
+
+def get_history_qa_pairs(filename, months=None):
+    """ Get history qa pair dataframe with a validity range per FAQ
+
+    A month snapshot of the timeline holds every FAQ scraped up to that month,
+    so each FAQ is valid from its own month onwards and valid_to is left open.
+    Filtering on valid_from <= month reproduces the snapshot of that month.
+
+    :param filename: historical faqs tsv filename
+    :param months: if given, keep only FAQs valid in these months
+    :return: history qa pair dataframe
+    """
     df = pd.read_csv(filename, sep='\t', header=0)
-    months = np.sort(df.month.unique())
+    if months:
+        df = df.loc[df['month'] <= max(months)]
+
+    df['valid_from'] = df['month']
+    df['valid_to'] = None
 
-    faq_dfs = []
-    for m in months:
-        subset = df.loc[df['month'] <= m]
-        print(m + "\t" + str(len(subset)))
-        snapshot = {'month': m, 'data': subset}
-        faq_dfs.append(snapshot)
+    for m in np.sort(df.month.unique()):
+        print(m + "\t" + str((df['valid_from'] <= m).sum()))
 
-    return faq_dfs
+    return df
 
 if __name__ == "__main__":
     
@@ -84,54 +143,52 @@ if __name__ == "__main__":
 
         # Ingesting data to Elasticsearch
         es = connections.create_connection(hosts=['localhost'], http_auth=('elastic', 'elastic'))
-        
-        dirnames = ["CovidFAQ"]
 
-        index_name = ""
-        faq_qa_pairs = []
+        # History_Searcher users query the alias with an as_of month
+        alias = "covidfaq_history"
 
         # Define a list of months to display in the timeline
         months = ['2020-03', '2020-04', '2020-05', '2020-06', '2020-07', '2020-08', '2020-09', '2020-10', '2020-11', '2020-12', '2021-01', '2021-02', '2021-03', '2021-04']
 
         # Load history data
         filename = './data/CovidFAQ/historical_faqs_for_indexing.tsv'
-        snapshots = get_history_qa_pairs(filename)
-
-        faq_qa_pairs = None
-        for m in months:
-            for s in snapshots:
-                if m == s['month']:
-                    faq_qa_pair_df = s['data']
-                    break
-                
-            index_name = "covidfaq_" + m
-            faq_qa_pairs = faq_qa_pair_df.T.to_dict().values()
-            faq_qa_pairs = list(faq_qa_pairs)
-             
-            print("{} records: ".format(index_name), len(faq_qa_pairs))
-
-            # Initialize index (only perform once)
-            index = Index(index_name)
-
-            # Define custom settings
-            index.settings(
-                number_of_shards=1,
-                number_of_replicas=0
-            )
-
-            # Delete the index, ignore if it doesn't exist
-            index.delete(ignore=404)
+        faq_qa_pair_df = get_history_qa_pairs(filename, months)
+
+        index_name = get_generation_name(alias)
 
+        print("{} records: ".format(index_name), len(faq_qa_pair_df))
+
+        # Initialize index
+        index = Index(index_name)
+
+        # Define custom settings
+        index.settings(
+            number_of_shards=1,
+            number_of_replicas=0
+        )
+
+        # Register a document with the index
+        index.document(QA)
+
+        try:
             # Create the index in Elasticsearch
             index.create()
 
-            # Register a document with the index
-            index.document(QA)
-
             # Ingest data to Elasticsearch
-            ingest_history_data(faq_qa_pairs, es, index_name)
+            num_docs, num_errors = ingest_history_data(faq_qa_pair_df, es, index_name)
+
+            validate_generation(es, alias, index_name, num_errors, len(faq_qa_pair_df))
+            warm_index(es, index_name)
+        except Exception:
+            # never leave a partial build behind, the alias keeps serving the previous generation
+            es.indices.delete(index=index_name, ignore=[404])
+            raise
+
+        # Swap alias to the new index and drop old generations
+        swap_alias(es, alias, index_name)
+        cleanup_generations(es, alias)
 
-            print("Finished indexing {} records to {} index".format(len(faq_qa_pairs), index_name))
+        print("Finished indexing {} records to {} index with {} errors".format(num_docs, index_name, num_errors))
 
     except Exception:
         logging.error('exception occured', exc_info=True)
@@ -8,15 +8,43 @@ class History_Searcher(object):
         if fields=None retrieve all results from index
     :param top_k: Elasticsearch top-k results.
         if top_k=None retrieve all results; else retrieve top-k results
+    :param as_of: month of the timeline snapshot e.g. 2020-05
+        if as_of=None retrieve results from the whole history
     """
-    def __init__(self, es, index, fields=None, top_k=None):
+    def __init__(self, es, index, fields=None, top_k=None, as_of=None):
         self.es = es
         self.index = index
         self.fields = fields
         self.top_k = top_k
+        self.as_of = as_of
         self.total_hits = 0
         self.max_score = 0
         self.results = []
+
+    def get_as_of_query(self, query):
+        """ Restrict query to documents valid in the as_of month
+        :param query: ES query
+        :return: ES query filtered by valid_from/valid_to
+        """
+        if self.as_of is None:
+            return query
+        return {
+            "bool": {
+                "must": query,
+                "filter": [
+                    {"range": {"valid_from": {"lte": self.as_of}}},
+                    {
+                        "bool": {
+                            "should": [
+                                {"range": {"valid_to": {"gt": self.as_of}}},
+                                {"bool": {"must_not": {"exists": {"field": "valid_to"}}}}
+                            ]
+                        }
+                    }
+                ]
+            }
+        }
+
     def query(self, query_string):
         """ Query ES index and retrive documents
         :param query_string: query string
@@ -24,30 +52,13 @@ class History_Searcher(object):
         """
         try:
             response = None
-            if self.fields is None or self.top_k is None:
-                response = self.es.search(
-                    index=self.index,
-                    body={
-                        "query": {
-                            "multi_match": {
-                                "query": query_string
-                            }
-                        }
-                    }
-                )
-            else:
-                response = self.es.search(
-                    index=self.index,
-                    body={
-                        "size": self.top_k,
-                        "query": {
-                            "multi_match": {
-                                "query": query_string,
-                                "fields": self.fields
-                            }
-                        }
-                    }
-                )
+            multi_match = {"query": query_string}
+            body = dict()
+            if not (self.fields is None or self.top_k is None):
+                multi_match["fields"] = self.fields
+                body["size"] = self.top_k
+            body["query"] = self.get_as_of_query({"multi_match": multi_match})
+            response = self.es.search(index=self.index, body=body)
             hits = response['hits']['hits']
             max_score = response['hits']['max_score']
             total_hits = response['hits']['total']['value']
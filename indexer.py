@@ -2,10 +2,17 @@ from elasticsearch_dsl import Index, Document, Integer, Text, analyzer, Keyword,
 from elasticsearch_dsl.connections import connections
 from elasticsearch import Elasticsearch, helpers
 from evaluation import get_relevance_label_df
+from shared.utils import load_from_json
+from shared.utils import dump_to_json
+from shared.utils import iter_records
 from datetime import datetime
 from tqdm import tqdm
+import pandas as pd
+import argparse
+import hashlib
 import logging
 import json
+import time
 import os
 
 class QA(Document):
@@ -13,96 +20,487 @@ class QA(Document):
     question = Text()
     answer = Text()
     question_answer = Text()
+    fingerprint = Keyword()
 
-def ingest_data(data, es, index):
-    """ Ingest data as a bulk of documents to ES index """
+def get_doc_id(pair, key_fields=('sourceUrl', 'question', 'answer')):
+    """ Get a deterministic document id from the key fields of a qa pair
+
+    FAQ pairs have no source url and may share a question across answers,
+    so the answer is part of the default key.
+
+    :param pair: qa pair dictionary
+    :param key_fields: fields identifying a qa pair
+    :return: hex digest
+    """
+    key = "\x1f".join(str(pair[field]) for field in key_fields if field in pair)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def get_fingerprint(doc, exclude_fields=('id', 'fingerprint')):
+    """ Get a fingerprint of the content of a document
+
+    Parsers number qa pairs by position, so the id is left out: adding or removing
+    a pair would otherwise change the fingerprint of every later pair.
+
+    :param doc: document as dictionary
+    :param exclude_fields: fields that are not part of the content
+    :return: hex digest
+    """
+    content = json.dumps({k: v for k, v in doc.items() if k not in exclude_fields}, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def get_doc(pair):
+    """ Get QA document from a qa pair
+
+    :param pair: qa pair dictionary
+    :return: QA document as dictionary
+    """
+    # initialize QA document
+    doc = QA()
+
+    if 'id' in pair:
+        doc.id = pair['id']
+    if 'question' in pair:
+        doc.question = pair['question']
+    if 'answer' in pair:
+        doc.answer = pair['answer']
+    if 'question' in pair and 'answer' in pair:
+        doc.question_answer = pair['question'] + " " + pair['answer']
+
+    return doc.to_dict(include_meta=False)
+
+def build_docs(df):
+    """ Build QA document columns from a qa pair dataframe
+
+    :param df: qa pair dataframe
+    :return: dataframe with QA document columns
+    """
+    docs = pd.DataFrame(index=df.index)
+    for field in ['id', 'question', 'answer']:
+        if field in df.columns:
+            docs[field] = df[field]
+    if 'question' in df.columns and 'answer' in df.columns:
+        docs['question_answer'] = df['question'] + " " + df['answer']
+    return docs
+
+def generate_docs(data, prev_fingerprints=None, fingerprints=None):
+    """ Generate bulk actions one at a time from qa pairs
+
+    If prev_fingerprints is given, only new or changed documents are indexed
+    and documents missing from data are deleted.
+
+    :param data: qa pair dataframe or iterable of qa pair dictionaries
+    :param prev_fingerprints: dictionary (doc id: key, fingerprint: value) of indexed documents
+    :param fingerprints: dictionary filled with (doc id: key, fingerprint: value) of data
+    :return: generator of bulk actions
+    """
+    if fingerprints is None:
+        fingerprints = dict()
+
+    if isinstance(data, pd.DataFrame):
+        docs = tqdm(iter_records(build_docs(data)), total=len(data))
+    else:
+        docs = (get_doc(pair) for pair in tqdm(data))
+
+    for doc in docs:
+        doc_id = get_doc_id(doc)
+        doc['fingerprint'] = get_fingerprint(doc)
+        fingerprints[doc_id] = doc['fingerprint']
+
+        if prev_fingerprints is None or prev_fingerprints.get(doc_id) != doc['fingerprint']:
+            yield {"_op_type": "index", "_id": doc_id, "_source": doc}
+
+    if prev_fingerprints is not None:
+        for doc_id in prev_fingerprints:
+            if doc_id not in fingerprints:
+                yield {"_op_type": "delete", "_id": doc_id}
+
+def get_manifest_diff(prev_fingerprints, fingerprints):
+    """ Get created, updated and deleted document ids between two manifests
+
+    :param prev_fingerprints: dictionary (doc id: key, fingerprint: value) of indexed documents
+    :param fingerprints: dictionary (doc id: key, fingerprint: value) of current data
+    :return: dictionary of created, updated and deleted doc id lists
+    """
+    created = [k for k in fingerprints if k not in prev_fingerprints]
+    updated = [k for k in fingerprints if k in prev_fingerprints and prev_fingerprints[k] != fingerprints[k]]
+    deleted = [k for k in prev_fingerprints if k not in fingerprints]
+    return {"created": created, "updated": updated, "deleted": deleted}
+
+def load_manifest(filepath):
+    """ Load manifest of indexed documents, empty if it does not exist
+
+    :param filepath: manifest filepath
+    :return: dictionary with index name and fingerprints
+    """
+    if not os.path.isfile(filepath):
+        return {"index": None, "fingerprints": dict()}
+    return load_from_json(filepath)
+
+def get_bulk_settings(es, index):
+    """ Get refresh interval and number of replicas of ES index
+
+    :param es: Elasticsearch instance
+    :param index: Elasticsearch index name
+    :return: dictionary of index settings
+    """
+    response = es.indices.get_settings(index=index)
+    settings = response[index]['settings']['index']
+    return {
+        "refresh_interval": settings.get('refresh_interval', '1s'),
+        "number_of_replicas": settings.get('number_of_replicas', '0')
+    }
+
+def get_failed_id(item):
+    """ Get the document id of a failed bulk response item
+
+    :param item: bulk response item e.g. {"index": {"_id": ..., "status": 400, "error": ...}}
+    :return: document id or None if the item has none
+    """
+    for response in item.values():
+        if isinstance(response, dict):
+            return response.get('_id')
+    return None
+
+def bulk_index(es, docs, index, chunk_size=500, thread_count=4, failed_ids=None):
+    """ Stream documents to ES index in chunks of bulk requests
+
+    Refresh is disabled and replicas are dropped while loading the index,
+    then the original settings are restored.
+
+    :param es: Elasticsearch instance
+    :param docs: iterable of documents as dictionaries
+    :param index: Elasticsearch index name
+    :param chunk_size: number of documents per bulk request
+    :param thread_count: number of threads; if thread_count > 1 use parallel_bulk, else streaming_bulk
+    :param failed_ids: set filled with the ids of documents that failed, None for failures without id
+    :return: number of indexed documents, number of errors
+    """
+    settings = get_bulk_settings(es, index)
+    es.indices.put_settings(index=index, body={"index": {"refresh_interval": "-1", "number_of_replicas": 0}})
+
+    num_docs = 0
+    num_errors = 0
+    chunk_errors = 0
+    start = chunk_start = time.time()
 
     try:
-        docs = []
-        for pair in tqdm(data):
-            
-            # initialize QA document
-            doc = QA()
-
-            if 'id' in pair:
-                doc.id = pair['id']
-            if 'question' in pair:
-                doc.question = pair['question']
-            if 'answer' in pair:
-                doc.answer = pair['answer']
-            if 'question' in pair and 'answer' in pair:
-                doc.question_answer = pair['question'] + " " + pair['answer']
-
-            docs.append(doc.to_dict(include_meta=False))
-
-        # bulk indexing
-        response = helpers.bulk(es, actions=docs, index=index, doc_type='doc')
-            
-    except Exception:
-        logging.error('exception occured', exc_info=True)
+        if thread_count > 1:
+            responses = helpers.parallel_bulk(
+                es, actions=docs, thread_count=thread_count, chunk_size=chunk_size,
+                raise_on_error=False, raise_on_exception=False, index=index, doc_type='doc'
+            )
+        else:
+            responses = helpers.streaming_bulk(
+                es, actions=docs, chunk_size=chunk_size,
+                raise_on_error=False, raise_on_exception=False, index=index, doc_type='doc'
+            )
+
+        for ok, item in responses:
+            num_docs += 1
+            # deleting a document that is already gone is not an error
+            if not ok and item.get('delete', {}).get('status') == 404:
+                ok = True
+            if not ok:
+                num_errors += 1
+                chunk_errors += 1
+                logging.error('failed to index document: {}'.format(item))
+                if failed_ids is not None:
+                    failed_ids.add(get_failed_id(item))
+
+            # report errors and throughput per chunk
+            if num_docs % chunk_size == 0:
+                elapsed = time.time() - chunk_start
+                logging.info("{}: indexed {} docs, {} errors in chunk, {:.0f} docs/s".format(
+                    index, num_docs, chunk_errors, chunk_size / max(elapsed, 1e-6)))
+                chunk_errors = 0
+                chunk_start = time.time()
+    finally:
+        es.indices.put_settings(index=index, body={"index": settings})
+        es.indices.refresh(index=index)
+
+    elapsed = time.time() - start
+    logging.info("{}: indexed {} docs with {} errors in {:.2f}s ({:.0f} docs/s)".format(
+        index, num_docs, num_errors, elapsed, num_docs / max(elapsed, 1e-6)))
+
+    return num_docs, num_errors
+
+def ingest_data(data, es, index, chunk_size=500, thread_count=4, prev_fingerprints=None, fingerprints=None, failed_ids=None):
+    """ Ingest data as a stream of bulk requests to ES index
+
+    :param data: qa pair dataframe or iterable of qa pair dictionaries
+    :param es: Elasticsearch instance
+    :param index: Elasticsearch index name
+    :param chunk_size: number of documents per bulk request
+    :param thread_count: number of threads used for bulk indexing
+    :param prev_fingerprints: fingerprints of indexed documents, if given only the delta is sent
+    :param fingerprints: dictionary filled with fingerprints of data
+    :param failed_ids: set filled with the ids of documents that failed, None for failures without id
+    :return: number of indexed documents, number of errors
+    """
+    actions = generate_docs(data, prev_fingerprints=prev_fingerprints, fingerprints=fingerprints)
+    return bulk_index(es, actions, index, chunk_size=chunk_size, thread_count=thread_count, failed_ids=failed_ids)
 
 def get_faq_qa_pairs(query_answer_pairs_filepath):
-    """ Get faq qa pair list """
+    """ Get faq qa pair dataframe """
     relevance_label_df = get_relevance_label_df(query_answer_pairs_filepath)
     faq_qa_pair_df = relevance_label_df[relevance_label_df['query_type'] == 'faq']
-    faq_qa_pairs = faq_qa_pair_df.T.to_dict().values()
-    faq_qa_pairs = list(faq_qa_pairs)
-    return faq_qa_pairs
+    return faq_qa_pair_df
+
+def get_generation_name(alias):
+    """ Get a fresh versioned index name for a given alias
+
+    :param alias: Elasticsearch alias name e.g. covidfaq
+    :return: index name e.g. covidfaq_20210401120000
+    """
+    return alias + "_" + datetime.now().strftime("%Y%m%d%H%M%S")
+
+def get_generations(es, alias):
+    """ Get versioned indices of a given alias sorted from oldest to newest
+
+    :param es: Elasticsearch instance
+    :param alias: Elasticsearch alias name
+    :return: list of index names
+    """
+    indices = es.indices.get(index=alias + "_*")
+    generations = [name for name in indices if name[len(alias) + 1:].isdigit()]
+    return sorted(generations)
+
+def get_alias_index(es, alias):
+    """ Get the index an alias currently points to
+
+    :param es: Elasticsearch instance
+    :param alias: Elasticsearch alias name
+    :return: index name or None if alias does not exist
+    """
+    if not es.indices.exists_alias(name=alias):
+        return None
+    return list(es.indices.get_alias(name=alias).keys())[0]
+
+def warm_index(es, index, fields=['question', 'answer', 'question_answer']):
+    """ Refresh, merge and run a query against a new index before it serves traffic
+
+    :param es: Elasticsearch instance
+    :param index: Elasticsearch index name
+    :param fields: fields to query
+    """
+    es.indices.refresh(index=index)
+    es.indices.forcemerge(index=index, max_num_segments=1)
+    es.search(index=index, body={"size": 1, "query": {"multi_match": {"query": "warm up", "fields": fields}}})
+
+def swap_alias(es, alias, index):
+    """ Point alias to index atomically, removing it from any other index
+
+    :param es: Elasticsearch instance
+    :param alias: Elasticsearch alias name
+    :param index: Elasticsearch index name
+    """
+    actions = []
+    if es.indices.exists_alias(name=alias):
+        for current in es.indices.get_alias(name=alias):
+            actions.append({"remove": {"index": current, "alias": alias}})
+    actions.append({"add": {"index": index, "alias": alias}})
+    es.indices.update_aliases(body={"actions": actions})
+
+def cleanup_generations(es, alias, keep=3):
+    """ Delete old versioned indices of an alias, keeping the newest ones
+
+    The index the alias currently points to is never deleted.
+
+    :param es: Elasticsearch instance
+    :param alias: Elasticsearch alias name
+    :param keep: number of generations to retain
+    :return: list of deleted index names
+    """
+    current = get_alias_index(es, alias)
+    generations = get_generations(es, alias)
+    deleted = []
+    for name in generations[:-keep] if keep > 0 else generations:
+        if name != current:
+            es.indices.delete(index=name)
+            deleted.append(name)
+    return deleted
+
+def validate_generation(es, alias, index, num_errors, num_expected):
+    """ Check that a new generation holds every document before it is swapped in
+
+    :param es: Elasticsearch instance
+    :param alias: Elasticsearch alias name
+    :param index: Elasticsearch index name of the new generation
+    :param num_errors: number of bulk indexing errors
+    :param num_expected: number of unique documents sent to the index
+    """
+    es.indices.refresh(index=index)
+    num_indexed = es.count(index=index)['count']
+    if num_errors > 0 or num_indexed != num_expected:
+        raise ValueError("error, {} failed with {} errors and {} of {} docs indexed, alias {} not swapped".format(
+            index, num_errors, num_indexed, num_expected, alias))
+
+def rebuild_index(es, alias, data, keep=3, chunk_size=500, thread_count=4, manifest_filepath=None):
+    """ Build data into a fresh versioned index, warm it and swap the alias to it
+
+    Queries on the alias keep being served by the previous generation until the swap.
+    A build that fails, or has indexing errors or missing documents, is deleted and its
+    error re-raised, leaving the alias and older generations untouched.
+
+    :param es: Elasticsearch instance
+    :param alias: Elasticsearch alias name
+    :param data: qa pair dataframe or iterable of qa pair dictionaries
+    :param keep: number of generations to retain
+    :param chunk_size: number of documents per bulk request
+    :param thread_count: number of threads used for bulk indexing
+    :param manifest_filepath: if given, save fingerprints of indexed documents to manifest
+    :return: new index name, number of indexed documents, number of errors
+    """
+    index_name = get_generation_name(alias)
+
+    # Initialize index
+    index = Index(index_name)
+
+    # Define custom settings
+    index.settings(
+        number_of_shards=1,
+        number_of_replicas=0
+    )
+
+    # Register a document with the index
+    index.document(QA)
+
+    fingerprints = dict()
+    try:
+        # Create the index in Elasticsearch
+        index.create()
+
+        # Ingest data to Elasticsearch
+        num_docs, num_errors = ingest_data(
+            data, es, index_name, chunk_size=chunk_size, thread_count=thread_count, fingerprints=fingerprints
+        )
+
+        validate_generation(es, alias, index_name, num_errors, len(fingerprints))
+        warm_index(es, index_name)
+    except Exception:
+        # never leave a partial build behind, the alias keeps serving the previous generation
+        es.indices.delete(index=index_name, ignore=[404])
+        raise
+
+    swap_alias(es, alias, index_name)
+    cleanup_generations(es, alias, keep=keep)
+
+    if manifest_filepath:
+        dump_to_json({"index": index_name, "fingerprints": fingerprints}, manifest_filepath)
+
+    return index_name, num_docs, num_errors
+
+def update_index(es, alias, data, manifest_filepath, keep=3, chunk_size=500, thread_count=4):
+    """ Send only created, updated and deleted documents to the index behind alias
+
+    The manifest stores the fingerprint of every indexed document. If it does not
+    belong to the index the alias points to (e.g. after a rollback), the index is rebuilt.
+    Documents that failed keep their previous manifest entry, so the next update retries them.
+
+    :param es: Elasticsearch instance
+    :param alias: Elasticsearch alias name
+    :param data: qa pair dataframe or iterable of qa pair dictionaries
+    :param manifest_filepath: manifest filepath
+    :param keep: number of generations to retain on rebuild
+    :param chunk_size: number of documents per bulk request
+    :param thread_count: number of threads used for bulk indexing
+    :return: index name, number of indexed documents, number of errors
+    """
+    manifest = load_manifest(manifest_filepath)
+    index_name = get_alias_index(es, alias)
+
+    if index_name is None or manifest['index'] != index_name:
+        logging.info("{}: manifest does not match alias, rebuilding index".format(alias))
+        return rebuild_index(
+            es, alias, data, keep=keep, chunk_size=chunk_size,
+            thread_count=thread_count, manifest_filepath=manifest_filepath
+        )
+
+    prev_fingerprints = manifest['fingerprints']
+    fingerprints = dict()
+    failed_ids = set()
+    num_docs, num_errors = ingest_data(
+        data, es, index_name, chunk_size=chunk_size, thread_count=thread_count,
+        prev_fingerprints=prev_fingerprints, fingerprints=fingerprints, failed_ids=failed_ids
+    )
+
+    diff = get_manifest_diff(prev_fingerprints, fingerprints)
+    logging.info("{}: {} created, {} updated, {} deleted".format(
+        index_name, len(diff['created']), len(diff['updated']), len(diff['deleted'])))
+
+    if None in failed_ids:
+        logging.error("{}: {} errors without document id, manifest not updated".format(index_name, num_errors))
+        return index_name, num_docs, num_errors
+
+    # record only acknowledged documents
+    for doc_id in failed_ids:
+        if doc_id in prev_fingerprints:
+            fingerprints[doc_id] = prev_fingerprints[doc_id]
+        else:
+            fingerprints.pop(doc_id, None)
+
+    dump_to_json({"index": index_name, "fingerprints": fingerprints}, manifest_filepath)
+
+    return index_name, num_docs, num_errors
+
+def rollback_alias(es, alias):
+    """ Point alias back to the generation preceding the current one
+
+    :param es: Elasticsearch instance
+    :param alias: Elasticsearch alias name
+    :return: index name the alias points to after rollback
+    """
+    current = get_alias_index(es, alias)
+    generations = get_generations(es, alias)
+
+    if current not in generations or generations.index(current) == 0:
+        raise ValueError("error, no previous generation found for {}".format(alias))
+
+    previous = generations[generations.index(current) - 1]
+    swap_alias(es, alias, previous)
+    return previous
 
 if __name__ == "__main__":
     try:
 
+        parser = argparse.ArgumentParser(description="Update, rebuild or roll back FAQ indices")
+        parser.add_argument("command", choices=["update", "rebuild", "rollback"], nargs="?", default="update")
+        parser.add_argument("--datasets", nargs="+", default=["CovidFAQ", "FAQIR", "StackFAQ"])
+        parser.add_argument("--keep", type=int, default=3, help="number of index generations to retain")
+        args = parser.parse_args()
+
         # Ingesting data to Elasticsearch
         es = connections.create_connection(hosts=['localhost'], http_auth=('elastic', 'elastic'))
-        
-        dirnames = ["CovidFAQ", "FAQIR", "StackFAQ"]
-
-        index_name = ""
-        faq_qa_pairs = []
-
-        now = datetime.now()
-        date = now.strftime("%Y-%m-%d")
-
-        for dirname in dirnames:
-            if dirname == "CovidFAQ":
-                index_name = "covidfaq_" + date
-                filepath = 'data/' + dirname + '/query_answer_pairs.json'
-                faq_qa_pairs = get_faq_qa_pairs(filepath)
-            elif dirname == "FAQIR":
-                index_name = "faqir_" + date
-                filepath = 'data/' + dirname + '/query_answer_pairs.json'
-                faq_qa_pairs = get_faq_qa_pairs(filepath)
-            elif dirname == "StackFAQ":
-                index_name = "stackfaq_" + date
-                filepath = 'data/' + dirname + '/query_answer_pairs.json'
-                faq_qa_pairs = get_faq_qa_pairs(filepath)
-            else:
-                raise ValueError("error, directory not exists")
 
-            print("{} records: ".format(dirname), len(faq_qa_pairs))
-
-            # Initialize index (only perform once)
-            index = Index(index_name)
+        for dirname in args.datasets:
+            if dirname not in {"CovidFAQ", "FAQIR", "StackFAQ"}:
+                raise ValueError("error, directory not exists")
 
-            # Define custom settings
-            index.settings(
-                number_of_shards=1,
-                number_of_replicas=0
-            )
+            # Searcher users query the stable alias e.g. covidfaq
+            alias = dirname.lower()
 
-            # Delete the index, ignore if it doesn't exist
-            index.delete(ignore=404)
+            if args.command == "rollback":
+                index_name = rollback_alias(es, alias)
+                print("Rolled back {} alias to {} index".format(alias, index_name))
+                continue
 
-            # Create the index in Elasticsearch
-            index.create()
+            filepath = 'data/' + dirname + '/query_answer_pairs.json'
+            manifest_filepath = 'data/' + dirname + '/index_manifest.json'
+            faq_qa_pairs = get_faq_qa_pairs(filepath)
 
-            # Register a document with the index
-            index.document(QA)
+            print("{} records: ".format(dirname), len(faq_qa_pairs))
 
-            # Ingest data to Elasticsearch
-            ingest_data(faq_qa_pairs, es, index_name)
+            if args.command == "rebuild":
+                index_name, num_docs, num_errors = rebuild_index(
+                    es, alias, faq_qa_pairs, keep=args.keep, manifest_filepath=manifest_filepath
+                )
+            else:
+                index_name, num_docs, num_errors = update_index(
+                    es, alias, faq_qa_pairs, manifest_filepath, keep=args.keep
+                )
 
-            print("Finished indexing {} records to {} index".format(len(faq_qa_pairs), index_name))
+            print("Finished indexing {} records to {} index with {} errors".format(num_docs, index_name, num_errors))
+            print("Alias {} now points to {} index".format(alias, index_name))
 
     except Exception:
         logging.error('exception occured', exc_info=True)
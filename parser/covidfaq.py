@@ -1,5 +1,6 @@
 from evaluation import jaccard_similarity
 from evaluation import levenstein_distance
+import logging
 
 class CovidFAQ_Parser(object):
     """ Class for parsing & extracting data from aligned_question_answer.csv """
@@ -11,35 +12,52 @@ class CovidFAQ_Parser(object):
         self.num_user_query_pairs = 0
         self.query_answer_pairs = []
         self.num_query_answer_pairs = 0
+        self.num_duplicates = dict()
         
     def extract_pairs(self, df, query_type):
         """ Extract qa pairs from DataFrame for a given query_type
     
         :param df: input DataFrame
         :param query_type: faq or user_query
-        :return: qa pairs
+        :return: qa pairs without duplicates, in first-seen order
         """
         qa_pairs = []
+        seen = set()
+        num_duplicates = 0
         if query_type == "faq":
             # select question, answer columns
             df = df[['question', 'answer']]
 
-            for _, row in df.iterrows():
+            for question, answer in zip(df['question'].tolist(), df['answer'].tolist()):
+
+                # keep the first occurrence of each pair
+                key = (question, answer)
+                if key in seen:
+                    num_duplicates += 1
+                    continue
+                seen.add(key)
+
                 data = dict()
                 data["label"] = 1
                 data["query_type"] = "faq"
-                data["question"] = row["question"]
-                data["answer"] = row["answer"]
+                data["question"] = question
+                data["answer"] = answer
                 qa_pairs.append(data)
 
         elif query_type == "user_query":
             # select query_string, answer columns
             df = df[['query_string', 'question', 'answer']]
 
-            for _, row in df.iterrows():
-                query_string = row["query_string"]
-                question = row["question"]
-                answer = row["answer"]
+            rows = zip(df['query_string'].tolist(), df['question'].tolist(), df['answer'].tolist())
+            for query_string, question, answer in rows:
+
+                # jc_sim and lv_dist follow from query_string and question,
+                # so duplicates are dropped before computing them
+                key = (query_string, question, answer)
+                if key in seen:
+                    num_duplicates += 1
+                    continue
+                seen.add(key)
                 
                 jc_sim = jaccard_similarity(query_string, question)
                 lv_dist = levenstein_distance(query_string, question)
@@ -56,13 +74,10 @@ class CovidFAQ_Parser(object):
         else:
             raise ValueError('error, no query_type found for {}'.format(query_type))
 
-        # remove duplicates
-        pairs = []
-        for pair in qa_pairs:
-            if pair not in pairs:
-                pairs.append(pair)
+        self.num_duplicates[query_type] = num_duplicates
+        logging.info("Dropped {} duplicate {} pairs".format(num_duplicates, query_type))
 
-        return pairs
+        return qa_pairs
 
     def get_query_answer_pairs(self, faq_pairs, user_query_pairs):
         """ Generate query answer pair list using faq, user query pairs 
@@ -1,16 +1,22 @@
 from shared.utils import load_from_json
 from shared.utils import dump_to_json
 from shared.utils import make_dirs
+from shared.utils import load_from_jsonl
+from shared.utils import dump_to_parquet
+from shared.utils import truncate_jsonl
 from evaluation import get_relevance_label_df
-from evaluation import get_relevance_label
+from evaluation import Qrels
+from evaluation import load_rank_results
 from datetime import datetime
 from tqdm import tqdm
 import pandas as pd
 import logging
+import json
 import os
 
 from searcher import Searcher
 from faq_bert import FAQ_BERT
+from score_cache import get_model_fingerprint
 
 logging.basicConfig(
     format="%(asctime)s - %(message)s",
@@ -26,9 +32,14 @@ class ReRanker(object):
     :param relevance_label_df: dataframe of relevance labels
     :param rank_field: BERT prediction for rank_field answer or question
     :param w_t: weight parameter used for re-ranking of ES score
+    :param qrels: relevance judgments index shared across runs, built from relevance_label_df if not given
+    :param score_cache: ScoreCache instance used to reuse BERT scores across runs
+    :param batch_size: if given, score the pairs of all queries in batches of batch_size instead of one pair at a time
+    :param max_seq_length: maximum number of tokens per BERT input
     """
 
-    def __init__(self, bert_model_path=None, test_queries=None, relevance_label_df=None, rank_field="BERT-Q-a", w_t=10):
+    def __init__(self, bert_model_path=None, test_queries=None, relevance_label_df=None, rank_field="BERT-Q-a", w_t=10, qrels=None, 
+                 score_cache=None, batch_size=None, max_seq_length=None):
         
         self.bert_model_path = bert_model_path
         self.test_queries = test_queries
@@ -37,12 +48,96 @@ class ReRanker(object):
         self.es_topk_results = []
         self.bert_topk_results = []
         self.reranked_results = []
+        self.faq_bert = None
+        self.score_cache = score_cache
+        self.batch_size = batch_size
+        self.max_seq_length = max_seq_length
+        self.batch_scores = dict()
 
-        if not relevance_label_df is None:
-            self.relevance_label = get_relevance_label(relevance_label_df)
+        self.qrels = qrels
+        if self.qrels is None and not relevance_label_df is None:
+            self.qrels = Qrels(relevance_label_df)
         
 
-    def get_es_topk_results(self, es, index, query_by, top_k):
+    def get_completed_queries(self, output_filepath):
+        """ Get query strings of the results already written to a JSONL output file,
+        dropping a partially written last line left by an interrupted run.
+        Results are written in input order, so they are the results of the first queries.
+
+        :param output_filepath: JSONL output filepath
+        :return: list of query strings in file order
+        """
+        if not os.path.isfile(output_filepath):
+            return []
+        truncate_jsonl(output_filepath)
+        return [result['query_string'] for result in load_from_jsonl(output_filepath)]
+
+    def stream_results(self, query_results, get_result, output_filepath=None, preds_key='rerank_preds'):
+        """ Apply get_result to each query and return the results, or append them
+        to a JSONL output file one query at a time, skipping the queries at the positions already written,
+        so that repeated query strings each keep their own result.
+        A .parquet output filepath is written in columnar format once all queries are done.
+
+        :param query_results: iterable of query strings or query results
+        :param get_result: function returning the result of a single query
+        :param output_filepath: JSONL or parquet output filepath
+        :param preds_key: key of the top-k predictions in each result
+        :return: list of results, or output_filepath if given
+        """
+        if output_filepath is None:
+            return [get_result(query_result) for query_result in tqdm(query_results)]
+
+        if output_filepath.endswith(".parquet"):
+            results = [get_result(query_result) for query_result in tqdm(query_results)]
+            dump_to_parquet(results, output_filepath, preds_key=preds_key)
+            return output_filepath
+
+        completed = self.get_completed_queries(output_filepath)
+        logging.info("Resuming after {} completed queries".format(len(completed)))
+
+        with open(output_filepath, 'a', encoding='utf-8') as f:
+            for i, query_result in enumerate(tqdm(query_results)):
+                query_string = query_result if isinstance(query_result, str) else query_result['query_string']
+                if i < len(completed):
+                    if completed[i] != query_string:
+                        raise ValueError("error, {} holds results of other queries at position {}".format(output_filepath, i))
+                    continue
+                f.write(json.dumps(get_result(query_result)) + "\n")
+                f.flush()
+
+        return output_filepath
+
+    def get_es_topk_result(self, searcher, query_string):
+        """ Get top-k results from Elasticsearch for a single query string
+
+        :param searcher: Searcher instance
+        :param query_string: query string
+        :return: query string and associated ES top-k results
+        """
+        # perform querying on ES
+        topk_results = searcher.query(query_string)
+
+        # obtain relevance label for each answer
+        topk_with_label = []
+        for doc in topk_results:
+            topk_answer = doc['answer']
+            topk_question = doc['question']
+
+            # check if the answer is a true answer
+            label = self.qrels.get_label(query_string, topk_answer)
+
+            data = {
+                "score": doc['score'],
+                "query_string": query_string,
+                "question": topk_question,
+                "answer": topk_answer,
+                "label": label
+            }
+            topk_with_label.append(data)
+
+        return {"query_string": query_string, "rerank_preds": topk_with_label}
+
+    def get_es_topk_results(self, es, index, query_by, top_k, output_filepath=None):
         """
         Get top-k results from Elasticsearch querying index field(s)
         for each query string in valid_queries
@@ -51,7 +146,8 @@ class ReRanker(object):
         :param index: Elasticsearch index
         :param query_by: Elasticsearch field(s) index
         :param top_k: Elasticsearch top-k results
-        :return: list of query strings and associated ES top-k results
+        :param output_filepath: if given, stream results to JSONL file and resume from it, or write parquet file
+        :return: list of query strings and associated ES top-k results, or output_filepath if given
         """
 
         logging.info("Generating ES top-k results ...")
@@ -59,157 +155,244 @@ class ReRanker(object):
         # define Searcher class and query by fields
         s = Searcher(es, index=index, fields=query_by, top_k=top_k)
 
-        es_topk_results = []
-        
-        if self.test_queries:
-            for query_string in tqdm(self.test_queries):
-
-                # perform querying on ES
-                topk_results = s.query(query_string)
-
-                # get the list of actual answers
-                answers = self.relevance_label[query_string]
-                
-                # obtain relevance label for each answer
-                topk_with_label = []
-                for doc in topk_results:
-                    topk_answer = doc['answer']
-                    topk_question = doc['question']
-
-                    # check if the answer is a true answer
-                    label = 0
-                    if topk_answer in answers:
-                        label = 1
-
-                    data = {
-                        "score": doc['score'],
-                        "query_string": query_string,
-                        "question": topk_question,
-                        "answer": topk_answer,
-                        "label": label
-                    }
-                    topk_with_label.append(data)
-
-                es_topk_results.append({"query_string": query_string, "rerank_preds": topk_with_label})
-        else:
+        if not self.test_queries:
             raise ValueError('error, test queries required')
 
+        return self.stream_results(
+            self.test_queries, lambda query_string: self.get_es_topk_result(s, query_string), output_filepath
+        )
+
+    def get_faq_bert(self, reload=False):
+        """ Load FAQ_BERT model once per ReRanker instance
+
+        :param reload: load the model again, e.g. to benchmark loading it
+        :return: FAQ_BERT instance
+        """
+        if self.faq_bert is None or reload:
+            if self.bert_model_path:
+                self.faq_bert = FAQ_BERT(bert_model_path=self.bert_model_path, max_seq_length=self.max_seq_length)
+            else:
+                raise ValueError('error, BERT model path required')
+        return self.faq_bert
+
+    def get_candidates(self, result):
+        """ Get the candidates scored by BERT for a single query by rank field
+
+        :param result: Elasticsearch result of a query
+        :return: list of candidate answers or questions
+        """
+        if self.rank_field == "BERT-Q-a":
+            return [elem['answer'] for elem in result['rerank_preds']]
+        elif self.rank_field == "BERT-Q-q":
+            return [elem['question'] for elem in result['rerank_preds']]
+        else:
+            raise ValueError("error, no rank_field found for {}".format(self.rank_field))
+
+    def predict(self, query_string, candidate):
+        """ Predict the BERT score of a query-candidate pair, using the batch scores if available
+
+        :param query_string: query string
+        :param candidate: candidate answer or question
+        :return: score
+        """
+        if (query_string, candidate) in self.batch_scores:
+            return self.batch_scores[(query_string, candidate)]
+        return self.get_faq_bert().predict(query_string, candidate)
+
+    def predict_batch(self, all_results):
+        """ Score the (query, candidate) pairs of all queries in one stream. Pairs are deduplicated,
+        already cached pairs are skipped, and the rest are sorted by token length and run in
+        batches of batch_size by FAQ_BERT; scores are kept in batch_scores for the per-query pass.
+
+        :param all_results: list of Elasticsearch results
+        """
+        pairs = []
+        for result in all_results:
+            for candidate in self.get_candidates(result):
+                pairs.append((result['query_string'], candidate))
+        pairs = list(dict.fromkeys(pairs))
+
+        if self.score_cache is not None:
+            model_fingerprint = get_model_fingerprint(self.bert_model_path)
+            keys = [self.score_cache.get_key(model_fingerprint, self.rank_field, query, candidate) for query, candidate in pairs]
+            cached = self.score_cache.get_many(keys)
+            pairs = [pair for pair, key in zip(pairs, keys) if key not in cached]
+
+        if not pairs:
+            return
+
+        logging.info("Scoring {} pairs in batches of {} ...".format(len(pairs), self.batch_size))
+        scores = self.get_faq_bert().predict_batch(pairs, batch_size=self.batch_size)
+        self.batch_scores = dict(zip(pairs, scores))
+
+    def get_bert_scores(self, query_string, candidates):
+        """ Predict BERT scores of a query against candidates, reusing cached scores if a score cache is set.
+        The BERT model is only loaded when a score is not cached.
 
-        return es_topk_results
+        :param query_string: query string
+        :param candidates: list of candidate answers or questions
+        :return: list of scores aligned with candidates
+        """
+        if self.score_cache is None:
+            return [self.predict(query_string, candidate) for candidate in candidates]
+        return self.score_cache.get_scores(self.bert_model_path, self.rank_field, query_string, candidates, self.predict)
+
+    def get_bert_topk_pred(self, result):
+        """ Predict similarity / label score for each question-answer pair of a single query
+
+        :param result: Elasticsearch result of a query
+        :return: query string and topk predictions
+        """
+        query_string = result['query_string']
+        topk_results = result['rerank_preds']
+
+        bert_scores = self.get_bert_scores(query_string, self.get_candidates(result))
+
+        response = dict()
+        topk_preds = []
+        for elem, bert_score in zip(topk_results, bert_scores):
+            es_score = elem['score']
+            question = elem['question']
+            answer = elem['answer']
+
+            # reuse the label of the ES stage, the answer is only looked up if it is missing
+            label = elem['label'] if 'label' in elem else self.qrels.get_label(query_string, answer)
+
+            data = {
+                "es_score": es_score,
+                "question": question,
+                "answer": answer,
+                "bert_score": bert_score,
+                "label": label
+            }
+            topk_preds.append(data)
+
+        response["query_string"] = query_string
+        response["topk_preds"] = topk_preds
+        return response
 
-    def get_bert_topk_preds(self, all_results):
+    def get_bert_topk_preds(self, all_results, output_filepath=None):
         """ 
-        Predict similarity / label score for each question-answer pair
+        Predict similarity / label score for each question-answer pair.
+        If batch_size is set, the pairs of all queries are scored in batches before the per-query pass.
         
-        :param all_results: Elasticsearch results
-        :return: topk prediction list
+        :param all_results: Elasticsearch results, or json / JSONL / parquet filepath of Elasticsearch results
+        :param output_filepath: if given, stream predictions to JSONL file and resume from it, or write parquet file
+        :return: topk prediction list, or output_filepath if given
         """
         
         logging.info("Generating BERT top-k results ...")
         
-        faq_bert = None
-        if self.bert_model_path:
-            faq_bert = FAQ_BERT(bert_model_path=self.bert_model_path)
-        else:
+        if not self.bert_model_path:
             raise ValueError('error, BERT model path required')
 
-        bert_topk_results = []
-        for result in tqdm(all_results):
-            query_string = result['query_string']                          
-            topk_results = result['rerank_preds']                        
-            
-            # get the list of actual answers
-            answers = self.relevance_label[query_string]
-            
-            response = dict()
-            topk_preds = []
-            for elem in topk_results:
-                es_score = elem['score']
-                question = elem['question']
-                answer = elem['answer']
-                
-                bert_score = 0
-                if self.rank_field == "BERT-Q-a":
-                    bert_score = faq_bert.predict(query_string, answer)
-                elif self.rank_field == "BERT-Q-q":
-                    bert_score = faq_bert.predict(query_string, question)
-                else:
-                    raise ValueError("error, no rank_field found for {}".format(self.rank_field))
-                
-                # check if the answer is a true answer
-                label = 0
-                if answer in answers:
-                    label = 1
-
-                data = {
-                    "es_score": es_score,
-                    "question": question,
-                    "answer": answer,
-                    "bert_score": bert_score,
-                    "label": label
-                }
-                topk_preds.append(data)
-            
-            response["query_string"] = query_string
-            response["topk_preds"] = topk_preds
-            bert_topk_results.append(response)
-        
-        return bert_topk_results
+        if isinstance(all_results, str):
+            all_results = load_rank_results(all_results)
+
+        if self.batch_size:
+            all_results = list(all_results)
+            if output_filepath and not output_filepath.endswith(".parquet"):
+                completed = self.get_completed_queries(output_filepath)
+                self.predict_batch(all_results[len(completed):])
+            else:
+                self.predict_batch(all_results)
+
+        try:
+            return self.stream_results(all_results, self.get_bert_topk_pred, output_filepath, preds_key='topk_preds')
+        finally:
+            self.batch_scores = dict()
+
+    def get_reranked_result(self, query_topk):
+        """ Rank the top-k predictions of a single query by final score in descending order
+
+        :param query_topk: query and topk prediction results
+        :return: query_string and ranked top-k results list
+        """
+        query_string = query_topk['query_string']
+        topk_preds = query_topk['topk_preds']
+
+        norm_results = []
+        for pred in topk_preds:
+            question = pred['question']
+            answer = pred['answer']
+            score = (self.w_t * pred['es_score']) + pred['bert_score']
+            label = pred['label']
 
-    def get_reranked_results(self, query_topk_preds):
+            result = {
+                'question': question,
+                'answer': answer, 
+                'score': score,
+                'label': label
+            }
+            norm_results.append(result)
+
+        rerank_preds = sorted(norm_results, key=lambda x: x['score'], reverse=True)
+        return {'query_string': query_string, 'rerank_preds': rerank_preds}
+
+    def get_reranked_results(self, query_topk_preds, output_filepath=None):
         """
         Rank the top-k results for each query in query_topk_preds.
         We sum bert_score with query_score and sort the list in descending order by final score
     
-        :param query_topk_preds: list consisting of query and topk prediction results
-        :return: query_string and ranked top-k results list
+        :param query_topk_preds: list consisting of query and topk prediction results, or its json / JSONL / parquet filepath
+        :param output_filepath: if given, stream re-ranked results to JSONL file and resume from it, or write parquet file
+        :return: query_string and ranked top-k results list, or output_filepath if given
         """
         
         logging.info("Re-ranking the top-k results ...")
-        
-        results = []
-        for query_topk in query_topk_preds:
-            query_string = query_topk['query_string']
-            topk_preds = query_topk['topk_preds']
-            
-            norm_results = []
-            for pred in topk_preds:
-                question = pred['question']
-                answer = pred['answer']
-                score = (self.w_t * pred['es_score']) + pred['bert_score']
-                label = pred['label']
-
-                result = {
-                    'question': question,
-                    'answer': answer, 
-                    'score': score,
-                    'label': label
-                }
-                norm_results.append(result)
-            results.append({'query_string': query_string, 'norm_results': norm_results})
-
-        # rank all topk predictions by final_score in descending order
-        reranked_results = []
-        for r in results:
-            query_string = r['query_string']
-            norm_results = r['norm_results']
-            rerank_preds = sorted(norm_results, key=lambda x: x['score'], reverse=True)
-            reranked_results.append({'query_string': query_string, 'rerank_preds': rerank_preds})
-        return reranked_results
-
-    def rank_results(self, es, index, query_by, top_k=10):
+
+        if isinstance(query_topk_preds, str):
+            query_topk_preds = load_rank_results(query_topk_preds)
+
+        return self.stream_results(query_topk_preds, self.get_reranked_result, output_filepath)
+
+    def get_stages(self, es, index, query_by, top_k=10):
+        """ Get the stages of ranking a single query, used to benchmark them one at a time
+
+        :param es: Elasticsearch instance
+        :param index: Elasticsearch index
+        :param query_by: Elasticsearch query field
+        :param top_k: top-k results
+        :return: list of (stage name, function)
+        """
+        s = Searcher(es, index=index, fields=query_by, top_k=top_k)
+        return [
+            ("es", lambda query_string: self.get_es_topk_result(s, query_string)),
+            ("bert", self.get_bert_topk_pred),
+            ("rerank", self.get_reranked_result)
+        ]
+
+    def get_output_filepaths(self, output_path, match_field, file_format="jsonl"):
+        """ Get the ES, BERT and re-ranked output filepaths of a match field, named as Evaluation looks them up
+        e.g. <output_path>/es_query_by_answer.jsonl, bert_query_by_answer.jsonl, reranked_query_by_answer.jsonl
+
+        :param output_path: output directory
+        :param match_field: answer / question / question_answer / question_answer_concat
+        :param file_format: jsonl or parquet
+        :return: ES, BERT and re-ranked output filepaths
+        """
+        make_dirs(output_path)
+        return tuple(
+            "{}/{}_query_by_{}.{}".format(output_path, stage, match_field, file_format)
+            for stage in ["es", "bert", "reranked"]
+        )
+
+    def rank_results(self, es, index, query_by, top_k=10, es_filepath=None, bert_filepath=None, reranked_filepath=None):
         """ Rank query results in Elasticsearch index 
         
         :param index: Elasticsearch instance
         :param index: Elasticsearch index
         :param query_by: Elasticsearch query field 
         :param top_k: top-k results
+        :param es_filepath: if given, stream ES results of each query to this JSONL file, resuming an interrupted run
+        :param bert_filepath: if given, stream BERT results of each query to this JSONL file, resuming an interrupted run
+        :param reranked_filepath: if given, stream re-ranked results of each query to this JSONL file, resuming an interrupted run;
+            attributes then hold the filepaths, see get_output_filepaths for the names Evaluation reads
         """
-        
-        es_topk_results = self.get_es_topk_results(es=es, index=index, query_by=query_by, top_k=top_k)
-        bert_topk_results = self.get_bert_topk_preds(es_topk_results)
-        reranked_results = self.get_reranked_results(bert_topk_results)
+        es_topk_results = self.get_es_topk_results(es=es, index=index, query_by=query_by, top_k=top_k, output_filepath=es_filepath)
+        bert_topk_results = self.get_bert_topk_preds(es_topk_results, output_filepath=bert_filepath)
+        reranked_results = self.get_reranked_results(bert_topk_results, output_filepath=reranked_filepath)
 
         self.es_topk_results = es_topk_results
         self.bert_topk_results = bert_topk_results
-        self.reranked_results = reranked_results
\ No newline at end of file
+        self.reranked_results = reranked_results
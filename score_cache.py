@@ -0,0 +1,194 @@
+from shared.utils import isDir
+import threading
+import hashlib
+import logging
+import sqlite3
+import time
+import os
+
+logging.basicConfig(
+    format="%(asctime)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    level=logging.INFO
+)
+
+# model fingerprints computed in this process, keyed by model path and file stats
+model_fingerprints = dict()
+
+def get_text_hash(text):
+    """ Get content hash of a text
+
+    :param text: input text
+    :return: sha1 hex digest
+    """
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def get_model_files(model_path):
+    """ Get files of a model directory in a deterministic order
+
+    :param model_path: model directory path
+    :return: list of file paths
+    """
+    filepaths = []
+    for root, dirs, files in sorted(os.walk(model_path)):
+        dirs.sort()
+        filepaths.extend(os.path.join(root, filename) for filename in sorted(files))
+    return filepaths
+
+def get_model_fingerprint(model_path):
+    """ Get content hash of a model directory, computed once per process and version of its files.
+    Two copies of the same model share a fingerprint, a retrained model does not,
+    even if it is saved in place to the same path.
+
+    :param model_path: model directory path
+    :return: sha1 hex digest of model file names and contents
+    """
+    if not isDir(model_path):
+        raise ValueError("model not found")
+
+    filepaths = get_model_files(model_path)
+    # file names, mtimes and sizes change when the model is retrained in place
+    stats = [os.stat(filepath) for filepath in filepaths]
+    key = (model_path, tuple((filepath, stat.st_mtime_ns, stat.st_size) for filepath, stat in zip(filepaths, stats)))
+    if key in model_fingerprints:
+        return model_fingerprints[key]
+
+    h = hashlib.sha1()
+    for filepath in filepaths:
+        h.update(os.path.relpath(filepath, model_path).encode('utf-8'))
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+
+    # keep a single fingerprint per model path
+    for stale_key in [k for k in model_fingerprints if k[0] == model_path]:
+        del model_fingerprints[stale_key]
+    model_fingerprints[key] = h.hexdigest()
+    return model_fingerprints[key]
+
+class ScoreCache(object):
+    """ Persistent content-addressed cache of BERT scores backed by sqlite.
+    Scores are keyed by (model fingerprint, rank_field, query text hash, candidate text hash),
+    so re-ranking with a different w_t or re-running an evaluation reuses scores
+    instead of running BERT inference again.
+
+    :param filepath: sqlite database filepath
+    :param max_entries: maximum number of cached scores, least recently used scores are evicted beyond it
+    """
+    def __init__(self, filepath, max_entries=1000000):
+        self.filepath = filepath
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+        dirname = os.path.dirname(filepath)
+        if dirname and not isDir(dirname):
+            os.makedirs(dirname)
+
+        self.conn = sqlite3.connect(filepath, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS scores (key TEXT PRIMARY KEY, score REAL, last_used REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used)")
+        self.conn.commit()
+
+    def get_key(self, model_fingerprint, rank_field, query_string, candidate):
+        """ Get cache key of a query-candidate pair
+
+        :param model_fingerprint: fingerprint of the BERT model
+        :param rank_field: BERT prediction for rank_field answer or question
+        :param query_string: query string
+        :param candidate: candidate answer or question
+        :return: cache key
+        """
+        return "{}:{}:{}:{}".format(
+            model_fingerprint, rank_field, get_text_hash(query_string), get_text_hash(candidate)
+        )
+
+    def get_many(self, keys):
+        """ Get cached scores and mark them as recently used
+
+        :param keys: list of cache keys
+        :return: dictionary (key: cache key, value: score) of cached keys
+        """
+        scores = dict()
+        if not keys:
+            return scores
+        with self.lock:
+            # stay below sqlite's limit of variables per statement
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.conn.execute(
+                    "SELECT key, score FROM scores WHERE key IN ({})".format(placeholders), chunk
+                ).fetchall()
+                scores.update(rows)
+            if scores:
+                now = time.time()
+                self.conn.executemany(
+                    "UPDATE scores SET last_used = ? WHERE key = ?", [(now, key) for key in scores]
+                )
+                self.conn.commit()
+        return scores
+
+    def put_many(self, scores):
+        """ Add scores to the cache and evict least recently used scores beyond max_entries
+
+        :param scores: dictionary (key: cache key, value: score)
+        """
+        if not scores:
+            return
+        with self.lock:
+            now = time.time()
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO scores (key, score, last_used) VALUES (?, ?, ?)",
+                [(key, float(score), now) for key, score in scores.items()]
+            )
+            num_evicted = self.evict()
+            self.conn.commit()
+        if num_evicted:
+            logging.info("Evicted {} scores from {}".format(num_evicted, self.filepath))
+
+    def evict(self):
+        """ Delete least recently used scores beyond max_entries
+
+        :return: number of evicted scores
+        """
+        num_entries = self.conn.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+        num_evicted = num_entries - self.max_entries
+        if num_evicted <= 0:
+            return 0
+        self.conn.execute(
+            "DELETE FROM scores WHERE key IN (SELECT key FROM scores ORDER BY last_used LIMIT ?)", (num_evicted,)
+        )
+        return num_evicted
+
+    def get_scores(self, model_path, rank_field, query_string, candidates, predict):
+        """ Get BERT scores of a query against candidates, predicting only the uncached ones
+
+        :param model_path: BERT model path
+        :param rank_field: BERT prediction for rank_field answer or question
+        :param query_string: query string
+        :param candidates: list of candidate answers or questions
+        :param predict: function returning the BERT score of a (query_string, candidate) pair
+        :return: list of scores aligned with candidates
+        """
+        model_fingerprint = get_model_fingerprint(model_path)
+        keys = [self.get_key(model_fingerprint, rank_field, query_string, candidate) for candidate in candidates]
+        cached = self.get_many(keys)
+
+        new_scores = dict()
+        for key, candidate in zip(keys, candidates):
+            if key not in cached and key not in new_scores:
+                new_scores[key] = predict(query_string, candidate)
+        self.put_many(new_scores)
+
+        return [cached[key] if key in cached else new_scores[key] for key in keys]
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+
+    def close(self):
+        """ Close the sqlite connection """
+        with self.lock:
+            self.conn.close()
@@ -4,7 +4,7 @@ class Searcher(object):
     """ Class for retrieving Elasticsearch documents
     
     :param es: Elasticsearch instance
-    :param index: Elasticsearch index name
+    :param index: Elasticsearch index name or alias (e.g. covidfaq)
     :param fields: query fields
         if fields=None retrieve all results from index
     :param top_k: Elasticsearch top-k results. 
@@ -19,10 +19,11 @@ class Searcher(object):
         self.max_score = 0
         self.results = []
 
-    def query(self, query_string):
+    def query(self, query_string, raise_errors=False):
         """ Query ES index and retrive documents
         
         :param query_string: query string
+        :param raise_errors: re-raise failed requests instead of logging them
         :return: ES results 
         """
         try:
@@ -76,6 +77,8 @@ class Searcher(object):
             self.total_hits = total_hits
         
         except Exception:
+            if raise_errors:
+                raise
             logging.error('exception occured', exc_info=True)
 
         return self.results
@@ -17,6 +17,18 @@ def make_dirs(path):
     if not os.path.exists(path):
         os.makedirs(path)
 
+def iter_records(df):
+    """ Iterate over DataFrame rows as plain dictionaries
+    Columns are read once, so rows are neither transposed nor built as Series.
+    Missing values (None / NaN) are left out of each record.
+
+    :param df: pandas DataFrame
+    :return: generator of dictionaries
+    """
+    columns = list(df.columns)
+    for values in zip(*(df[column].tolist() for column in columns)):
+        yield {k: v for k, v in zip(columns, values) if v is not None and v == v}
+
 def dump_to_json(data, filepath, indent=4, sort_keys=True):
     """ Dump dictionary to json file to a given filepath name 
     
@@ -39,6 +51,130 @@ def load_from_json(filepath):
         data = json.load(data_file)
     return data
 
+def load_from_jsonl(filepath):
+    """ Load JSONL file from filepath one record at a time
+    A partially written last line is skipped.
+
+    :param filepath: filepath name
+    :return: generator of python dictionaries
+    """
+    with open(filepath, encoding='utf-8') as data_file:
+        for line in data_file:
+            if not line.endswith("\n"):
+                break
+            yield json.loads(line)
+
+def truncate_jsonl(filepath):
+    """ Drop a partially written last line from JSONL file so that records can be appended
+    
+    :param filepath: filepath name
+    """
+    with open(filepath, 'rb+') as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        # scan backwards for the last newline
+        while pos > 0:
+            size = min(65536, pos)
+            f.seek(pos - size)
+            block = f.read(size)
+            i = block.rfind(b"\n")
+            if i != -1:
+                pos = pos - size + i + 1
+                break
+            pos -= size
+        if pos != end:
+            f.truncate(pos)
+
+def dump_to_parquet(results, filepath, preds_key='rerank_preds'):
+    """ Dump rank results to columnar parquet file, one row per top-k candidate.
+    Text columns are dictionary-encoded, scores and labels are stored in typed columns.
+    A query without predictions is kept as a single row with null rank and prediction columns.
+
+    :param results: list of dictionaries with query_string and list of top-k predictions
+    :param filepath: filepath name
+    :param preds_key: key of the top-k predictions e.g. rerank_preds / topk_preds
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    query_strings = []
+    ranks = []
+    preds = []
+    for result in results:
+        # placeholder row, so that the query is not lost
+        result_preds = result[preds_key] or [None]
+        for rank, pred in enumerate(result_preds):
+            query_strings.append(result['query_string'])
+            ranks.append(None if pred is None else rank)
+            preds.append(pred)
+
+    columns = {"query_string": query_strings, "rank": ranks}
+    nested_query_string = False
+    for pred in preds:
+        for key in (pred or dict()):
+            if key == "query_string":
+                nested_query_string = True
+            elif key not in columns:
+                columns[key] = [None if pred is None else pred.get(key) for pred in preds]
+
+    arrays = dict()
+    for key, values in columns.items():
+        if key == "label":
+            arrays[key] = pa.array(values, type=pa.int8())
+        elif key == "rank":
+            arrays[key] = pa.array(values, type=pa.int32())
+        elif key.endswith("score"):
+            arrays[key] = pa.array(values, type=pa.float64())
+        else:
+            arrays[key] = pa.array(values).dictionary_encode()
+
+    metadata = {"preds_key": preds_key, "nested_query_string": str(int(nested_query_string))}
+    table = pa.table(arrays).replace_schema_metadata(metadata)
+    pq.write_table(table, filepath)
+
+def load_parquet_columns(filepath, columns=None):
+    """ Load columns of parquet file as arrow arrays
+
+    :param filepath: filepath name
+    :param columns: list of column names, all columns if None, columns missing from the file are left out
+    :return: dictionary (column name: key, arrow array: value), schema metadata
+    """
+    import pyarrow.parquet as pq
+
+    if columns is not None:
+        names = set(pq.read_schema(filepath).names)
+        columns = [column for column in columns if column in names]
+    table = pq.read_table(filepath, columns=columns)
+    metadata = {k.decode(): v.decode() for k, v in (table.schema.metadata or {}).items()}
+    return {name: table.column(name).combine_chunks() for name in table.column_names}, metadata
+
+def load_from_parquet(filepath):
+    """ Load rank results dumped by dump_to_parquet into a list of dictionaries
+
+    :param filepath: filepath name
+    :return: list of dictionaries with query_string and list of top-k predictions
+    """
+    columns, metadata = load_parquet_columns(filepath)
+    preds_key = metadata.get("preds_key", "rerank_preds")
+    nested_query_string = metadata.get("nested_query_string") == "1"
+
+    columns = {name: array.to_pylist() for name, array in columns.items()}
+    query_strings = columns.pop("query_string")
+    ranks = columns.pop("rank")
+
+    results = []
+    for i, query_string in enumerate(query_strings):
+        if ranks[i] is None:
+            results.append({"query_string": query_string, preds_key: []})
+            continue
+        if ranks[i] == 0:
+            results.append({"query_string": query_string, preds_key: []})
+        pred = {name: values[i] for name, values in columns.items()}
+        if nested_query_string:
+            pred["query_string"] = query_string
+        results[-1][preds_key].append(pred)
+    return results
+
 def dump_to_txt(data, filepath):
     """ Dump data to txt file format to a given filepath name 
     
@@ -0,0 +1,65 @@
+from batch_sampler import LengthBucketSampler
+from batch_sampler import get_padding_ratio
+import numpy as np
+import pytest
+import math
+
+def get_lengths(num_examples=103, seed=0):
+    return np.random.default_rng(seed).integers(1, 128, size=(num_examples, 2))
+
+def test_epoch_covers_every_example_once():
+    sampler = LengthBucketSampler(get_lengths(), batch_size=8, bucket_size=4)
+    batches = list(sampler)
+    assert len(batches) == len(sampler)
+    assert sorted(i for batch in batches for i in batch) == list(range(103))
+
+def test_batches_are_reproducible_and_change_per_epoch():
+    lengths = get_lengths()
+    first = LengthBucketSampler(lengths, batch_size=8, bucket_size=4, seed=3)
+    second = LengthBucketSampler(lengths, batch_size=8, bucket_size=4, seed=3)
+    epoch_0 = list(first)
+    assert list(second) == epoch_0
+    # iterating advances the epoch
+    assert list(first) != epoch_0
+
+def test_set_epoch_resumes_from_start():
+    sampler = LengthBucketSampler(get_lengths(), batch_size=8, bucket_size=4)
+    sampler.set_epoch(2)
+    epoch_2 = list(sampler)
+    sampler.set_epoch(2, start=5)
+    assert list(sampler) == epoch_2[5:]
+    # the next iteration starts the following epoch from its first batch
+    sampler.set_epoch(3)
+    epoch_3 = list(sampler)
+    sampler.set_epoch(2, start=5)
+    list(sampler)
+    assert list(sampler) == epoch_3
+
+@pytest.mark.parametrize("num_replicas", [2, 3, 4])
+def test_shards_partition_the_batches(num_replicas):
+    lengths = get_lengths()
+    single = LengthBucketSampler(lengths, batch_size=8, bucket_size=4)
+    all_batches = [batch.tolist() for batch in single.get_all_batches(1)]
+
+    shards = []
+    for rank in range(num_replicas):
+        sampler = LengthBucketSampler(lengths, batch_size=8, bucket_size=4, num_replicas=num_replicas, rank=rank)
+        sampler.set_epoch(1)
+        shards.append(list(sampler))
+
+    # every worker gets as many batches, wrapping around to the first batches
+    assert [len(shard) for shard in shards] == [math.ceil(len(single) / num_replicas)] * num_replicas
+    interleaved = [shard[i] for i in range(len(shards[0])) for shard in shards]
+    assert interleaved[:len(all_batches)] == all_batches
+    assert interleaved[len(all_batches):] == all_batches[:len(interleaved) - len(all_batches)]
+
+def test_length_bucketing_pads_less_than_random_batches():
+    lengths = get_lengths(num_examples=1000)
+    bucketed = LengthBucketSampler(lengths, batch_size=16, bucket_size=10)
+    random = LengthBucketSampler(lengths, batch_size=16, bucket_size=1)
+    assert bucketed.get_padding_ratio() < random.get_padding_ratio()
+
+def test_padding_ratio():
+    lengths = [[2], [4], [4], [4]]
+    assert get_padding_ratio(lengths, [[0, 1], [2, 3]]) == pytest.approx(2 / 16)
+    assert get_padding_ratio(lengths, []) == 0.0
@@ -0,0 +1,119 @@
+from sklearn.metrics import average_precision_score
+from sklearn.metrics import ndcg_score
+from shared.utils import dump_to_json
+from shared.utils import dump_to_parquet
+from shared.utils import load_from_parquet
+from evaluation import get_rank_arrays
+from evaluation import compute_rank_metrics
+from evaluation import compute_ap_scores
+from evaluation import compute_prec_scores
+from evaluation import compute_ndcg_scores
+import numpy as np
+import pytest
+
+def get_query_results(seed=0, num_queries=200, max_len=12):
+    """ Random rank results with tied scores, all-zero labels and queries without predictions """
+    rng = np.random.default_rng(seed)
+    query_results = []
+    for i in range(num_queries):
+        num_preds = int(rng.integers(0, max_len + 1))
+        labels = rng.integers(0, 2, size=num_preds) if i % 5 else np.zeros(num_preds, dtype=int)
+        # few distinct scores, so that ties are frequent
+        scores = rng.integers(0, 4, size=num_preds) / 2
+        query_results.append({
+            "query_string": "query {}".format(i),
+            "rerank_preds": [{"label": int(l), "score": float(s)} for l, s in zip(labels, scores)]
+        })
+    return query_results
+
+def sklearn_map(query_results):
+    ap_scores = []
+    for result in query_results:
+        labels = [topk['label'] for topk in result['rerank_preds']]
+        reranks = [topk['score'] for topk in result['rerank_preds']]
+        ap = 0
+        if labels and reranks and np.any(labels):
+            ap = average_precision_score(np.array(labels), np.array(reranks))
+        ap_scores.append(ap)
+    return np.array(ap_scores)
+
+def sklearn_prec(query_results, k):
+    prec_scores = []
+    for result in query_results:
+        labels = [topk['label'] for topk in result['rerank_preds'][:k]]
+        prec = 0
+        if labels and np.any(labels):
+            prec = sum(labels) / len(labels)
+        prec_scores.append(prec)
+    return np.array(prec_scores)
+
+def sklearn_ndcg(query_results, k):
+    ndcg_scores = []
+    for result in query_results:
+        labels = [topk['label'] for topk in result['rerank_preds'][:k]]
+        reranks = [topk['score'] for topk in result['rerank_preds'][:k]]
+        ndcg = 0
+        # sklearn rejects single-document rankings
+        if len(labels) > 1:
+            ndcg = ndcg_score(np.asarray([labels]), np.asarray([reranks]))
+        elif labels:
+            ndcg = float(labels[0])
+        ndcg_scores.append(ndcg)
+    return np.array(ndcg_scores)
+
+@pytest.fixture
+def rank_arrays():
+    query_results = get_query_results()
+    valid_queries = {result['query_string'] for result in query_results}
+    _, labels, scores, lengths = get_rank_arrays(query_results, valid_queries)
+    return query_results, labels, scores, lengths
+
+def test_map_equals_sklearn(rank_arrays):
+    query_results, labels, scores, _ = rank_arrays
+    np.testing.assert_allclose(compute_ap_scores(labels, scores), sklearn_map(query_results))
+
+@pytest.mark.parametrize("k", [1, 3, 5, 10, 20])
+def test_prec_equals_sklearn_loop(rank_arrays, k):
+    query_results, labels, _, lengths = rank_arrays
+    np.testing.assert_allclose(compute_prec_scores(labels, lengths, k), sklearn_prec(query_results, k))
+
+@pytest.mark.parametrize("k", [1, 3, 5, 10, 20])
+def test_ndcg_equals_sklearn(rank_arrays, k):
+    query_results, labels, scores, lengths = rank_arrays
+    np.testing.assert_allclose(compute_ndcg_scores(labels, scores, lengths, k), sklearn_ndcg(query_results, k))
+
+def test_rank_arrays_skip_invalid_queries():
+    query_results = get_query_results(num_queries=10)
+    valid_queries = {"query 1", "query 7", "unknown"}
+    query_strings, labels, scores, lengths = get_rank_arrays(query_results, valid_queries)
+    assert query_strings == ["query 1", "query 7"]
+    assert labels.shape == scores.shape == (2, lengths.max())
+
+def test_parquet_metrics_equal_json(tmp_path):
+    query_results = get_query_results(seed=1, num_queries=50)
+    for result in query_results:
+        for topk in result['rerank_preds']:
+            topk.update({"question": "question", "answer": "answer of " + result['query_string']})
+    json_filepath = str(tmp_path / "reranked_query_by_question.json")
+    parquet_filepath = str(tmp_path / "reranked_query_by_question.parquet")
+    dump_to_json(query_results, json_filepath)
+    dump_to_parquet(query_results, parquet_filepath)
+
+    # a subset of queries, so that filtering is checked as well
+    valid_queries = {result['query_string'] for result in query_results[::2]}
+    json_metrics = compute_rank_metrics(json_filepath, valid_queries, [1, 5, 10])
+    parquet_metrics = compute_rank_metrics(parquet_filepath, valid_queries, [1, 5, 10])
+
+    assert parquet_metrics['query_strings'] == json_metrics['query_strings']
+    np.testing.assert_array_equal(parquet_metrics['lengths'], json_metrics['lengths'])
+    np.testing.assert_allclose(parquet_metrics['map'], json_metrics['map'])
+    for k in [1, 5, 10]:
+        np.testing.assert_allclose(parquet_metrics['prec'][k], json_metrics['prec'][k])
+        np.testing.assert_allclose(parquet_metrics['ndcg'][k], json_metrics['ndcg'][k])
+
+def test_parquet_round_trip_keeps_queries_without_predictions(tmp_path):
+    query_results = get_query_results(seed=2, num_queries=20)
+    query_results.append({"query_string": "query without predictions", "rerank_preds": []})
+    filepath = str(tmp_path / "es_query_by_question.parquet")
+    dump_to_parquet(query_results, filepath)
+    assert load_from_parquet(filepath) == query_results
@@ -0,0 +1,53 @@
+from indexer import get_manifest_diff
+from indexer import generate_docs
+from indexer import get_doc_id
+import pandas as pd
+
+def get_pairs(num_pairs):
+    return [{"id": i, "question": "question {}".format(i), "answer": "answer {}".format(i)} for i in range(num_pairs)]
+
+def get_fingerprints(pairs):
+    fingerprints = dict()
+    for _ in generate_docs(pairs, fingerprints=fingerprints):
+        pass
+    return fingerprints
+
+def test_manifest_diff():
+    prev_fingerprints = {"a": "1", "b": "2", "c": "3"}
+    fingerprints = {"a": "1", "b": "changed", "d": "4"}
+    assert get_manifest_diff(prev_fingerprints, fingerprints) == {
+        "created": ["d"], "updated": ["b"], "deleted": ["c"]
+    }
+
+def test_manifest_diff_of_unchanged_data_is_empty():
+    fingerprints = get_fingerprints(get_pairs(5))
+    assert get_manifest_diff(fingerprints, dict(fingerprints)) == {"created": [], "updated": [], "deleted": []}
+
+def test_removing_a_pair_only_deletes_it():
+    pairs = get_pairs(5)
+    prev_fingerprints = get_fingerprints(pairs)
+
+    # parsers renumber the remaining pairs
+    new_pairs = [dict(pair, id=i) for i, pair in enumerate(pairs[1:])]
+    fingerprints = get_fingerprints(new_pairs)
+
+    assert get_manifest_diff(prev_fingerprints, fingerprints) == {
+        "created": [], "updated": [], "deleted": [get_doc_id(pairs[0])]
+    }
+    actions = list(generate_docs(new_pairs, prev_fingerprints=prev_fingerprints))
+    assert actions == [{"_op_type": "delete", "_id": get_doc_id(pairs[0])}]
+
+def test_changed_answer_is_a_new_document():
+    pairs = get_pairs(3)
+    prev_fingerprints = get_fingerprints(pairs)
+    pairs[1]['answer'] = "new answer"
+    fingerprints = get_fingerprints(pairs)
+
+    diff = get_manifest_diff(prev_fingerprints, fingerprints)
+    assert diff['created'] == [get_doc_id(pairs[1])]
+    assert diff['updated'] == []
+    assert len(diff['deleted']) == 1
+
+def test_dataframe_and_records_have_the_same_fingerprints():
+    pairs = get_pairs(4)
+    assert get_fingerprints(pd.DataFrame.from_records(pairs)) == get_fingerprints(pairs)
@@ -0,0 +1,53 @@
+from score_cache import ScoreCache
+from score_cache import get_model_fingerprint
+import itertools
+import pytest
+import os
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    # strictly increasing clock, so that recency does not depend on the timer resolution
+    clock = itertools.count()
+    monkeypatch.setattr("score_cache.time.time", lambda: next(clock))
+    score_cache = ScoreCache(str(tmp_path / "scores.db"), max_entries=3)
+    yield score_cache
+    score_cache.close()
+
+@pytest.fixture
+def model_path(tmp_path):
+    path = tmp_path / "model"
+    path.mkdir()
+    (path / "pytorch_model.bin").write_bytes(b"weights")
+    return str(path)
+
+def test_least_recently_used_scores_are_evicted(cache):
+    cache.put_many({"a": 0.1})
+    cache.put_many({"b": 0.2})
+    cache.put_many({"c": 0.3})
+    # reading a makes b the least recently used score
+    assert cache.get_many(["a"]) == {"a": 0.1}
+    cache.put_many({"d": 0.4})
+
+    assert len(cache) == 3
+    assert cache.get_many(["a", "b", "c", "d"]) == {"a": 0.1, "c": 0.3, "d": 0.4}
+
+def test_eviction_keeps_max_entries(cache):
+    cache.put_many({str(i): float(i) for i in range(10)})
+    assert len(cache) == 3
+
+def test_scores_are_only_predicted_once(cache, model_path):
+    calls = []
+    def predict(query_string, candidate):
+        calls.append(candidate)
+        return float(len(candidate))
+
+    assert cache.get_scores(model_path, "answer", "query", ["x", "yy", "x"], predict) == [1.0, 2.0, 1.0]
+    assert cache.get_scores(model_path, "answer", "query", ["yy", "x"], predict) == [2.0, 1.0]
+    assert calls == ["x", "yy"]
+
+def test_fingerprint_changes_when_model_is_retrained_in_place(model_path):
+    fingerprint = get_model_fingerprint(model_path)
+    filepath = os.path.join(model_path, "pytorch_model.bin")
+    with open(filepath, "wb") as f:
+        f.write(b"retrained weights")
+    assert get_model_fingerprint(model_path) != fingerprint
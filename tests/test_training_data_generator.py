@@ -0,0 +1,35 @@
+from training_data_generator import Training_Data_Generator
+import numpy as np
+import pytest
+
+def get_id2qa(num_pairs):
+    return {i: ("question {}".format(i), "answer {}".format(i), "faq") for i in range(1, num_pairs + 1)}
+
+@pytest.mark.parametrize("num_pairs,num_samples", [(30, 24), (26, 24), (100, 5)])
+def test_negatives_are_distinct_and_exclude_self(num_pairs, num_samples):
+    generator = Training_Data_Generator(num_samples=num_samples)
+    id2negids = generator.get_id2negids(get_id2qa(num_pairs))
+
+    assert len(id2negids) == num_pairs
+    for id, neg_ids in id2negids.items():
+        assert len(neg_ids) == num_samples
+        assert len(set(neg_ids)) == num_samples
+        assert id not in set(neg_ids)
+
+def test_id_0_is_never_a_negative():
+    id2qa = {i: ("question {}".format(i), "answer {}".format(i), "faq") for i in range(0, 30)}
+    id2negids = Training_Data_Generator(num_samples=10).get_id2negids(id2qa)
+    assert all(0 not in set(neg_ids) for neg_ids in id2negids.values())
+
+def test_negatives_are_reproducible_with_random_seed():
+    id2qa = get_id2qa(50)
+    first = Training_Data_Generator(random_seed=7, num_samples=10).get_id2negids(id2qa)
+    second = Training_Data_Generator(random_seed=7, num_samples=10).get_id2negids(id2qa)
+    other = Training_Data_Generator(random_seed=8, num_samples=10).get_id2negids(id2qa)
+
+    assert all(np.array_equal(first[id], second[id]) for id in id2qa)
+    assert not all(np.array_equal(first[id], other[id]) for id in id2qa)
+
+def test_too_few_candidates_raise():
+    with pytest.raises(ValueError):
+        Training_Data_Generator(num_samples=24).get_id2negids(get_id2qa(24))
@@ -0,0 +1,195 @@
+from shared.utils import load_from_json
+from shared.utils import dump_to_json
+from shared.utils import make_dirs
+from score_cache import get_text_hash
+from tqdm import tqdm
+import numpy as np
+import hashlib
+import logging
+import torch
+import json
+import os
+
+logging.basicConfig(
+    format="%(asctime)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    level=logging.INFO
+)
+
+def get_tokenizer_fingerprint(tokenizer, max_length):
+    """ Get content hash of a tokenizer, two tokenizers with the same fingerprint produce the same token ids
+
+    :param tokenizer: HuggingFace tokenizer
+    :param max_length: maximum number of token ids cached per text
+    :return: sha1 hex digest of tokenizer class, vocabulary, settings and max_length
+    """
+    settings = {k: v for k, v in tokenizer.init_kwargs.items() if k not in ('name_or_path', 'tokenizer_file')}
+    h = hashlib.sha1()
+    h.update(type(tokenizer).__name__.encode('utf-8'))
+    h.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode('utf-8'))
+    h.update(json.dumps(settings, sort_keys=True, default=str).encode('utf-8'))
+    h.update(str(max_length).encode('utf-8'))
+    return h.hexdigest()
+
+class TokenCache(object):
+    """ Token ids of unique texts stored in memory-mapped arrays, keyed by tokenizer fingerprint.
+    Each text is tokenized once without special tokens and truncated to max_length ids,
+    which is all any truncated input of at most max_length tokens can use.
+
+    :param cache_path: directory of the cache, one subdirectory per tokenizer fingerprint
+    :param tokenizer: HuggingFace tokenizer
+    :param max_length: maximum number of tokens per model input
+    :param batch_size: number of texts tokenized at once when adding texts
+    """
+    def __init__(self, cache_path, tokenizer, max_length, batch_size=1000):
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.fingerprint = get_tokenizer_fingerprint(tokenizer, max_length)
+        self.dirpath = cache_path + "/" + self.fingerprint
+        make_dirs(self.dirpath)
+
+        self.index = dict()
+        self.ids = np.zeros(0, dtype=np.int32)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        if os.path.isfile(self.dirpath + "/index.json"):
+            self.load()
+
+    def load(self):
+        """ Load the text index and memory-map the token id arrays """
+        self.index = load_from_json(self.dirpath + "/index.json")
+        self.ids = np.load(self.dirpath + "/ids.npy", mmap_mode='r')
+        self.offsets = np.load(self.dirpath + "/offsets.npy")
+
+    def save(self, ids, offsets):
+        """ Replace the cache files, index last so that it never points past the arrays
+
+        :param ids: concatenated token ids of all texts
+        :param offsets: start of each text in ids, followed by the total number of ids
+        """
+        for name, array in (("ids", ids), ("offsets", offsets)):
+            np.save(self.dirpath + "/" + name + ".tmp.npy", array)
+            os.replace(self.dirpath + "/" + name + ".tmp.npy", self.dirpath + "/" + name + ".npy")
+        dump_to_json(self.index, self.dirpath + "/index.tmp.json", indent=None)
+        os.replace(self.dirpath + "/index.tmp.json", self.dirpath + "/index.json")
+
+    def add(self, texts):
+        """ Tokenize texts that are not cached yet and append them to the cache
+
+        :param texts: iterable of texts
+        """
+        new_texts = dict()
+        for text in texts:
+            key = get_text_hash(text)
+            if key not in self.index and key not in new_texts:
+                new_texts[key] = text
+        if not new_texts:
+            return
+
+        logging.info("Tokenizing {} new texts into {}".format(len(new_texts), self.dirpath))
+        keys = list(new_texts.keys())
+        new_ids = []
+        for start in tqdm(range(0, len(keys), self.batch_size)):
+            batch = [new_texts[key] for key in keys[start:start + self.batch_size]]
+            encoded = self.tokenizer(batch, add_special_tokens=False, truncation=True, max_length=self.max_length)
+            new_ids.extend(encoded['input_ids'])
+
+        lengths = np.array([len(text_ids) for text_ids in new_ids], dtype=np.int64)
+        ids = np.concatenate([np.asarray(self.ids), np.fromiter(
+            (i for text_ids in new_ids for i in text_ids), dtype=np.int32, count=int(lengths.sum())
+        )])
+        offsets = np.concatenate([self.offsets, self.offsets[-1] + np.cumsum(lengths)])
+
+        num_texts = len(self.index)
+        self.index.update((key, num_texts + i) for i, key in enumerate(keys))
+        self.save(ids, offsets)
+        self.load()
+
+    def get(self, text):
+        """ Get the cached token ids of a text
+
+        :param text: input text
+        :return: list of token ids without special tokens
+        """
+        i = self.index[get_text_hash(text)]
+        return self.ids[self.offsets[i]:self.offsets[i + 1]].tolist()
+
+    def get_lengths(self, examples, pair=False):
+        """ Get the number of tokens of the model inputs of each example, with special tokens and truncation
+
+        :param examples: list of InputExample with cached texts
+        :param pair: texts of an example form a single input, as for CrossEncoder
+        :return: array of lengths, one column per text or a single column for text pairs
+        """
+        rows = [[self.index[get_text_hash(text)] for text in example.texts] for example in examples]
+        lengths = np.diff(self.offsets)[np.array(rows, dtype=np.int64).reshape(len(rows), -1)]
+        if pair:
+            lengths = lengths.sum(axis=1, keepdims=True)
+        return np.minimum(lengths + self.tokenizer.num_special_tokens_to_add(pair=pair), self.max_length)
+
+    def get_features(self, ids, pair_ids=None):
+        """ Build padded model inputs from cached token ids, equal to tokenizing the texts with
+        padding=True, truncation='longest_first' and max_length. Pairs longer than max_length are
+        truncated by prepare_for_model, which can keep one token more of the first text than a fast tokenizer.
+
+        :param ids: list of token id lists
+        :param pair_ids: list of token id lists of the second texts, for text pairs
+        :return: dictionary of input tensors
+        """
+        if pair_ids is None:
+            pair_ids = [None] * len(ids)
+        encoded = [
+            self.tokenizer.prepare_for_model(
+                text_ids, text_pair_ids, add_special_tokens=True, truncation='longest_first', max_length=self.max_length
+            )
+            for text_ids, text_pair_ids in zip(ids, pair_ids)
+        ]
+        return dict(self.tokenizer.pad(encoded, padding=True, return_tensors='pt'))
+
+    def __getstate__(self):
+        # worker processes map the cache files instead of receiving a copy of the token ids
+        state = self.__dict__.copy()
+        del state['ids']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.ids = np.zeros(0, dtype=np.int32)
+        if self.index:
+            self.ids = np.load(self.dirpath + "/ids.npy", mmap_mode='r')
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, text):
+        return get_text_hash(text) in self.index
+
+class CachedCollator(object):
+    """ DataLoader collate function building batches of InputExample from cached token ids,
+    in the format of SentenceTransformer / CrossEncoder smart_batching_collate
+
+    :param token_cache: TokenCache holding the ids of every example text
+    :param loss_type: triplet (one input per text) or softmax (one input per text pair)
+    :param device: torch device of the batch tensors
+    :param num_labels: number of labels of softmax models, float labels if 1
+    """
+    def __init__(self, token_cache, loss_type, device, num_labels=1):
+        self.token_cache = token_cache
+        self.loss_type = loss_type
+        self.device = device
+        self.num_labels = num_labels
+
+    def __call__(self, batch):
+        columns = list(zip(*[[self.token_cache.get(text) for text in example.texts] for example in batch]))
+        if self.loss_type == "triplet":
+            labels = torch.tensor([example.label for example in batch]).to(self.device)
+            sentence_features = []
+            for column in columns:
+                features = self.token_cache.get_features(list(column))
+                sentence_features.append({name: tensor.to(self.device) for name, tensor in features.items()})
+            return sentence_features, labels
+
+        dtype = torch.float if self.num_labels == 1 else torch.long
+        labels = torch.tensor([example.label for example in batch], dtype=dtype).to(self.device)
+        features = self.token_cache.get_features(list(columns[0]), list(columns[1]))
+        return {name: tensor.to(self.device) for name, tensor in features.items()}, labels
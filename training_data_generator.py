@@ -1,8 +1,12 @@
-import random
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
+from collections import defaultdict
 from shared.utils import make_dirs
 from shared.utils import load_from_json
+from shared.utils import load_from_jsonl
+import hashlib
+import os.path
 import sys
 
 class Training_Data_Generator(object):
@@ -14,9 +18,10 @@ class Training_Data_Generator(object):
     :param query_type: query type (faq or user_query) 
     :param loss_type: the loss type as method used for BERT Fine-tuning (softmax or triplet loss)
     :param hard_filepath: the absolut path to hard negatives filepath
+    :param chunk_size: number of dataset rows generated and written at once
     """
     def __init__(self, random_seed=5, num_samples=24, neg_type='simple', query_type='faq', 
-                loss_type='triplet', hard_filepath=''):
+                loss_type='triplet', hard_filepath='', chunk_size=10000):
         
         self.random_seed = random_seed
         self.num_samples = num_samples
@@ -25,6 +30,8 @@ class Training_Data_Generator(object):
     
         self.query_type = query_type
         self.loss_type = loss_type
+        self.chunk_size = chunk_size
+        self.num_rows = 0
         self.pos_labels = []
         self.neg_labels = []
         self.num_pos_labels = 0
@@ -53,55 +60,84 @@ class Training_Data_Generator(object):
         qap_df = pd.DataFrame.from_records(query_answer_pairs)
         qap_by_query_type = qap_df[qap_df['query_type'] == self.query_type]
         
-        pos_labels = []
-        for _, row in qap_by_query_type.iterrows():
-            id = row['id']
-            qa_pair = {
-                "id": id,
-                "label": 1,
-                "question": row['question'],
-                "answer": row['answer'],
-                "query_type": row['query_type']
-            }
-            pos_labels.append(qa_pair)
-            
-            self.id2qa[id] = (qa_pair['question'], qa_pair['answer'], qa_pair['query_type'])
+        ids = qap_by_query_type['id'].tolist()
+        questions = qap_by_query_type['question'].tolist()
+        answers = qap_by_query_type['answer'].tolist()
+        query_types = qap_by_query_type['query_type'].tolist()
+
+        pos_labels = [
+            {"id": id, "label": 1, "question": question, "answer": answer, "query_type": query_type}
+            for id, question, answer, query_type in zip(ids, questions, answers, query_types)
+        ]
+        self.id2qa.update(zip(ids, zip(questions, answers, query_types)))
             
         return pos_labels
     
+    def get_neg_id_matrix(self, ids):
+        """ Draw random negative samples for all qa pairs at once.
+        Each row holds num_samples distinct positions into ids, excluding the row itself and id 0;
+        positions drawn as self or as a duplicate of the row are rejected and redrawn.
+
+        :param ids: array of qa pair ids
+        :return: matrix (len(ids) x num_samples) of positions into ids
+        """
+        ids = np.asarray(ids, dtype=object)
+        pool = np.flatnonzero(ids != 0)
+        if self.num_samples > len(pool) - 1:
+            raise ValueError("error, num_samples {} larger than number of negative candidates".format(self.num_samples))
+
+        rng = np.random.default_rng(self.random_seed)
+        rows = np.arange(len(ids))[:, None]
+        neg_ids = pool[rng.integers(0, len(pool), size=(len(ids), self.num_samples))]
+
+        while True:
+            # mark positions repeating an earlier position of the same row
+            order = np.argsort(neg_ids, axis=1, kind='stable')
+            sorted_ids = np.take_along_axis(neg_ids, order, axis=1)
+            sorted_dup = np.zeros(neg_ids.shape, dtype=bool)
+            sorted_dup[:, 1:] = sorted_ids[:, 1:] == sorted_ids[:, :-1]
+            rejected = np.zeros(neg_ids.shape, dtype=bool)
+            np.put_along_axis(rejected, order, sorted_dup, axis=1)
+            rejected |= neg_ids == rows
+
+            num_rejected = int(rejected.sum())
+            if num_rejected == 0:
+                return neg_ids
+            neg_ids[rejected] = pool[rng.integers(0, len(pool), size=num_rejected)]
+
     def get_id2negids(self, id2qa):
-        """ Generate random negative sample ids for qa pairs 
+        """ Generate random negative sample ids for qa pairs, reproducible with random_seed
         
         :param id2qa: dictionary (id: key, question-answer (tuple): value)
-        :return: dictionary (id: key, neg_ids: value)
+        :return: dictionary (id: key, neg_ids (array): value)
         """
-        random.seed(self.random_seed)
-        id2negids = dict()
-        total_qa = len(id2qa)
-        ids = id2qa.keys()
-        for id, qa in id2qa.items():
-            neg_ids = random.sample([x for x in ids if x != id and x !=0], self.num_samples)
-            id2negids[id] = neg_ids
-        return id2negids
+        ids = np.empty(len(id2qa), dtype=object)
+        ids[:] = list(id2qa.keys())
+        neg_ids = ids[self.get_neg_id_matrix(ids)]
+        return dict(zip(ids, neg_ids))
 
     def generate_neg_labels(self, id2negids):
-        """ Generate negative labels from id2negids 
+        """ Generate negative labels from id2negids as columns
         
         :param id2negids: dictionary (id: key, neg_ids: value)
-        :return: list of negative labels as dictionaries
+        :return: dataframe of negative labels
         """
-        neg_labels = []
-        for k, v  in id2negids.items():
-            for id in v:
-                neg_label = dict()
-                neg_label['id'] = str(k)
-                neg_label['question'] = self.id2qa[k][0]
-                neg_answer = self.id2qa[id][1]
-                neg_label['answer'] = neg_answer
-                neg_label['label'] = 0
-                neg_label['query_type'] = self.id2qa[id][2]
-                neg_labels.append(neg_label)
-        return neg_labels
+        qa_df = pd.DataFrame.from_dict(self.id2qa, orient='index', columns=['question', 'answer', 'query_type'])
+        if not id2negids:
+            return pd.DataFrame(columns=['id', 'question', 'answer', 'label', 'query_type'])
+
+        ids = pd.Index(list(id2negids.keys()))
+        neg_ids = np.concatenate([np.asarray(v, dtype=object) for v in id2negids.values()])
+        counts = [len(v) for v in id2negids.values()]
+
+        neg_qa = qa_df.loc[neg_ids]
+        return pd.DataFrame({
+            "id": ids.repeat(counts).astype(str),
+            "question": qa_df.loc[ids, 'question'].values.repeat(counts),
+            "answer": neg_qa['answer'].values,
+            "label": 0,
+            "query_type": neg_qa['query_type'].values
+        })
 
     def get_seq_len_df(self, query_answer_pairs):
         """ Get sequence length in dataframe 
@@ -130,9 +166,13 @@ class Training_Data_Generator(object):
                 id2negids = self.get_id2negids(self.id2qa)
                 neg_labels = self.generate_neg_labels(id2negids)
                 pos_df = pd.DataFrame(pos_labels)
-                neg_df = pd.DataFrame(neg_labels)
+                neg_df = neg_labels.copy()
             elif self.neg_type == "hard":
-                neg_labels = load_from_json(self.hard_filepath)
+                if os.path.isfile(self.hard_filepath):
+                    neg_labels = load_from_json(self.hard_filepath)
+                else:
+                    # hard negatives streamed by Hard_Negatives_Generator
+                    neg_labels = list(load_from_jsonl(self.hard_filepath + "l"))
                 pos_labels = query_answer_pairs
                 neg_df = pd.DataFrame.from_records(neg_labels)
                 neg_df = neg_df[neg_df['rank'] <= self.num_samples]
@@ -150,77 +190,148 @@ class Training_Data_Generator(object):
 
         return pos_df, neg_df
 
-    def generate_triplet_dataset(self, query_answer_pairs, output_path):
-        """ Generate ground-truth dataset for feature learning 
+    def get_row_digest(self, row):
+        """ Get a fixed-size digest of a row used to drop duplicate rows
 
-        :param qa_pairs: question-answer pair list
-        :param output_path: output path name
+        :param row: tuple of values
+        :return: 16 bytes digest
         """
-        # create directory structure
-        output_path = output_path + "/dataset/" + self.loss_type + "/" + self.query_type
-        make_dirs(output_path)
+        return hashlib.blake2b("\x1f".join(map(str, row)).encode('utf-8'), digest_size=16).digest()
 
-        df = None
-        pos_df = None
-        neg_df = None
-    
-        if self.loss_type == "triplet":
-            if self.neg_type == "simple":
-                # generate pos, neg dataframes
-                pos_df, neg_df = self.get_pos_neg_df(query_answer_pairs)
-                
-                # rename colnames
-                pos_df['positive'] = pos_df['answer']
-                neg_df['negative'] = neg_df['answer']
-            
-                # drop columns answer, label, query_type
-                pos_df.drop(['answer', 'label', 'query_type'], axis=1, inplace=True)
-                neg_df.drop(['answer', 'label', 'query_type'], axis=1, inplace=True)
-
-                # convert colname to data types
-                pos_df['id'] = pos_df['id'].astype(int)
-                pos_df['question'] = pos_df['question'].astype(str)
-                neg_df['id'] = neg_df['id'].astype(int)
-                neg_df['question'] = neg_df['question'].astype(str)
-            
-                df = pd.merge(pos_df, neg_df, on=['question', 'id'])
-                df.drop(['id'], axis=1, inplace=True)
+    def iter_chunks(self, rows, columns):
+        """ Group rows into dataframes of chunk_size rows
 
-            elif self.neg_type == "hard":
-                # generate pos, neg dataframes
-                pos_df, neg_df = self.get_pos_neg_df(query_answer_pairs)
-                if ('label' in pos_df.columns) and ('label' in neg_df.columns):
-                    pos_df.drop(['label'], axis=1, inplace=True)
-                    neg_df.drop(['label'], axis=1, inplace=True)
-    
-                pos_df.rename(columns={'answer': 'pos_answer', 'question': 'query_string'}, inplace=True)
-                df = pd.merge(pos_df, neg_df, on=['query_string'])
-                df.drop_duplicates(inplace=True)
+        :param rows: iterable of row tuples
+        :param columns: column names
+        :return: generator of dataframes
+        """
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == self.chunk_size:
+                yield pd.DataFrame(chunk, columns=columns)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=columns)
 
-                df.drop(['id', 'query_type', 'question', 'question_answer', 'rank', 'score'], axis=1, inplace=True)
-                df.rename(columns={'query_string': 'question', 'pos_answer': 'positive', 'neg_answer': 'negative'}, inplace=True)
-        elif self.loss_type == "softmax":
-            if self.neg_type == "simple":
-                # generate pos, neg dataframes
-                pos_df, neg_df = self.get_pos_neg_df(query_answer_pairs)
-                df = pd.concat([pos_df, neg_df])
-                df.drop(['id', 'query_type'], axis=1, inplace=True)
-                
-            elif self.neg_type == "hard": 
-                # generate pos, neg dataframes
-                pos_df, neg_df = self.get_pos_neg_df(query_answer_pairs)
-                pos_df.drop(['id', 'query_type'], axis=1, inplace=True)
-
-                neg_df.drop(['question_answer', 'rank', 'score', 'question'], axis=1, inplace=True)
-                neg_df.rename(columns={'query_string': 'question', 'neg_answer': 'answer'}, inplace=True)
-                df = pd.concat([pos_df, neg_df])
+    def iter_triplets(self, pos_df, neg_df):
+        """ Generate triplet rows of every positive with the negatives of its question,
+        in the order of a merge of pos_df and neg_df, without materializing the merge
+
+        :param pos_df: positive dataframe
+        :param neg_df: negative dataframe
+        :return: generator of (question, positive, negative) tuples
+        """
+        if self.neg_type == "simple":
+            key2negs = defaultdict(list)
+            for id, question, answer in zip(neg_df['id'].astype(int), neg_df['question'].astype(str), neg_df['answer']):
+                key2negs[(question, id)].append(answer)
+
+            for id, question, answer in zip(pos_df['id'].astype(int), pos_df['question'].astype(str), pos_df['answer']):
+                for negative in key2negs.get((question, id), []):
+                    yield (question, answer, negative)
+
+        elif self.neg_type == "hard":
+            pos_df = pos_df.drop(columns=['label'], errors='ignore')
+            neg_df = neg_df.drop(columns=['label'], errors='ignore')
+            pos_query = pos_df.columns.get_loc('question')
+            pos_answer = pos_df.columns.get_loc('answer')
+            neg_answer = neg_df.columns.get_loc('neg_answer')
+
+            key2negs = defaultdict(list)
+            for neg in neg_df.itertuples(index=False, name=None):
+                key2negs[neg[neg_df.columns.get_loc('query_string')]].append(neg)
+
+            # drop rows repeating all fields of an earlier positive-negative row
+            seen = set()
+            for pos in pos_df.itertuples(index=False, name=None):
+                for neg in key2negs.get(pos[pos_query], []):
+                    digest = self.get_row_digest(pos + neg)
+                    if digest in seen:
+                        continue
+                    seen.add(digest)
+                    yield (pos[pos_query], pos[pos_answer], neg[neg_answer])
         else:
-            raise ValueError("error, no loss_type found for {}".format(self.loss_type))
+            raise ValueError("error, no neg_type found for {}".format(self.neg_type))
 
-        df.to_csv(output_path + "/" + self.neg_type + "_" + self.query_type + "_dataset.csv", index=False)
+    def iter_labeled_pairs(self, pos_df, neg_df):
+        """ Generate labeled pair rows, positives first
+
+        :param pos_df: positive dataframe
+        :param neg_df: negative dataframe
+        :return: generator of (label, question, answer) tuples
+        """
+        for row in zip(pos_df['label'], pos_df['question'], pos_df['answer']):
+            yield row
 
+        if self.neg_type == "simple":
+            neg_rows = zip(neg_df['label'], neg_df['question'], neg_df['answer'])
+        elif self.neg_type == "hard":
+            neg_rows = zip(neg_df['label'], neg_df['query_string'], neg_df['neg_answer'])
+        else:
+            raise ValueError("error, no neg_type found for {}".format(self.neg_type))
+        for row in neg_rows:
+            yield row
+
+    def generate_dataset_chunks(self, query_answer_pairs):
+        """ Generate the ground-truth dataset in chunks of chunk_size rows
+
+        :param query_answer_pairs: question-answer pair list
+        :return: generator of dataframes
+        """
+        pos_df, neg_df = self.get_pos_neg_df(query_answer_pairs)
         self.pos_df = pos_df
         self.neg_df = neg_df
-        self.df = df
 
-       
+        if self.loss_type == "triplet":
+            return self.iter_chunks(self.iter_triplets(pos_df, neg_df), ['question', 'positive', 'negative'])
+        elif self.loss_type == "softmax":
+            return self.iter_chunks(self.iter_labeled_pairs(pos_df, neg_df), ['label', 'question', 'answer'])
+        else:
+            raise ValueError("error, no loss_type found for {}".format(self.loss_type))
+
+    def write_dataset(self, chunks, filepath):
+        """ Write dataset chunks to a csv or parquet file one chunk at a time
+
+        :param chunks: iterable of dataframes with the same columns
+        :param filepath: .csv or .parquet output filepath
+        :return: number of written rows
+        """
+        num_rows = 0
+        writer = None
+        try:
+            for chunk in chunks:
+                if filepath.endswith(".parquet"):
+                    import pyarrow as pa
+                    import pyarrow.parquet as pq
+
+                    table = pa.Table.from_pandas(chunk, preserve_index=False)
+                    if writer is None:
+                        writer = pq.ParquetWriter(filepath, table.schema)
+                    writer.write_table(table)
+                else:
+                    chunk.to_csv(filepath, index=False, mode='w' if num_rows == 0 else 'a', header=num_rows == 0)
+                num_rows += len(chunk)
+        finally:
+            if writer is not None:
+                writer.close()
+        return num_rows
+
+    def generate_triplet_dataset(self, query_answer_pairs, output_path, file_format='csv'):
+        """ Generate ground-truth dataset for feature learning.
+        Triplets or labeled pairs are generated and written in chunks, so memory
+        does not grow with the number of negatives per question.
+
+        :param qa_pairs: question-answer pair list
+        :param output_path: output path name
+        :param file_format: csv or parquet
+        """
+        # create directory structure
+        output_path = output_path + "/dataset/" + self.loss_type + "/" + self.query_type
+        make_dirs(output_path)
+
+        if file_format not in {'csv', 'parquet'}:
+            raise ValueError("error, no file_format found for {}".format(file_format))
+
+        filepath = output_path + "/" + self.neg_type + "_" + self.query_type + "_dataset." + file_format
+        self.num_rows = self.write_dataset(self.generate_dataset_chunks(query_answer_pairs), filepath)
@@ -9,6 +9,8 @@ import json
 import os
 
 from faq_bert_ranker import FAQ_BERT_Ranker
+from history_searcher import History_Searcher
+from score_cache import ScoreCache
 from shared.utils import isDir
 
 env_path = Path('.') / '.env'
@@ -18,6 +20,10 @@ project_id =  os.environ.get('PROJECT_ID')
 session_id = os.environ.get('SESSION_ID')
 language_code = os.environ.get('LANGUAGE_CODE')
 chatbot_credentials = os.environ.get('CHATBOT_CREDENTIALS')
+score_cache_filepath = os.environ.get('SCORE_CACHE', 'output/bert_score_cache.db')
+
+# BERT scores shared across requests, repeated queries skip inference
+score_cache = ScoreCache(score_cache_filepath)
 
 try:
     es = connections.create_connection(hosts=['localhost'], http_auth=('elastic', 'elastic'))
@@ -27,68 +33,88 @@ except TransportError as e:
 app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
+def get_history_index(index):
+    """ Map a legacy month index name (e.g. covidfaq_2020-05) to the history alias and as_of month
+
+    :param index: index name
+    :return: history alias, as_of month
+    """
+    dataset, _, month = index.rpartition("_")
+    if dataset and month[:4].isdigit():
+        return dataset + "_history", month
+    return index, None
+
 @app.route('/api/chatbot/search/<dataset>', methods=['GET'])
 @cross_origin()
 def get_index_list(dataset):
     try:
+        history_index = dataset.lower() + "_history"
+
+        # begin: list the months of the timeline
+        response = es.search(
+            index=history_index,
+            body={
+                "size": 0,
+                "aggs": {
+                    "months": {
+                        "terms": {"field": "valid_from", "size": 10000}
+                    }
+                }
+            }
+        )
+        months = sorted(bucket['key'] for bucket in response['aggregations']['months']['buckets'])
+        # end: list the months of the timeline
+
         index_list = []
-        count = -1
-        for elem in es.cat.indices(format="json"):
-            if elem['index'].startswith(dataset):
-                count += 1
-                index = elem['index']
-                num_docs = es.count(index=index)["count"]
-                
-                # begin: aggregate topics and document counts
-                response = es.search(
-                    index= index,
-                    body={
-                        "size": 10000,
-                        "query": {
-                            "match_all": {}
+        for count, month in enumerate(months):
+            searcher = History_Searcher(es, history_index, as_of=month)
+
+            # begin: aggregate topics and document counts of the month snapshot
+            response = es.search(
+                index=history_index,
+                body={
+                    "size": 0,
+                    "track_total_hits": True,
+                    "query": searcher.get_as_of_query({"match_all": {}}),
+                    "aggs": {
+                        "topics": {
+                            "terms": {"field": "topic", "size": 10000}
                         }
                     }
-                )
-                
-                hits = response['hits']['hits']
-                total_hits = response['hits']['total']['value']
-
-                doc_count = {}
-                for hit in hits:
-                    topic = hit['_source']['topic']
-                    if topic in doc_count:
-                        prev_count = doc_count[topic]
-                        doc_count[topic] = prev_count + 1
-                    else:
-                        doc_count[topic] = 1
-                # end: aggregate topics and document counts
-                topic_list = []
-                for topic in doc_count:
-                    topic_list.append(
-                        {
-                            "topic": topic,
-                            "num_doc": doc_count[topic],
-                        }
-                    )
-                topic_list = sorted(topic_list, key= lambda k: k['num_doc'], reverse=True)
-               
-                topk_topic = []
-                for topic in topic_list:
-                    t = topic['topic'] + " (" + str(topic['num_doc']) + ")"
-                    topk_topic.append(t)
-
-                index_list.append(
+                }
+            )
+
+            num_docs = response['hits']['total']['value']
+
+            doc_count = {}
+            for bucket in response['aggregations']['topics']['buckets']:
+                doc_count[bucket['key']] = bucket['doc_count']
+            # end: aggregate topics and document counts of the month snapshot
+            topic_list = []
+            for topic in doc_count:
+                topic_list.append(
                     {
-                        "label": index.split("_")[1],
-                        "value": count,
-                        "legend": str(num_docs),
-                        "topics": topk_topic
+                        "topic": topic,
+                        "num_doc": doc_count[topic],
                     }
                 )
+            topic_list = sorted(topic_list, key= lambda k: k['num_doc'], reverse=True)
+
+            topk_topic = []
+            for topic in topic_list:
+                t = topic['topic'] + " (" + str(topic['num_doc']) + ")"
+                topk_topic.append(t)
+
+            index_list.append(
+                {
+                    "label": month,
+                    "value": count,
+                    "legend": str(num_docs),
+                    "topics": topk_topic
+                }
+            )
 
-        index_list = sorted(index_list, key= lambda k: k['label'])
-
-        # Iterate over the list of indices to compute the diffence of documents
+        # Iterate over the list of months to compute the diffence of documents
         index_list_ = []
         prev_num_docs = 0
         for index in index_list:
@@ -123,6 +149,7 @@ def chatbot_response():
         top_k = json_data.get('top_k', 5)
         dataset = json_data.get('dataset', 'CovidFAQ')
         index = json_data.get('index')
+        as_of = json_data.get('as_of')
         fields = json_data.get('field', ['question_answer'])
         
         # Define model parameters
@@ -159,9 +186,13 @@ def chatbot_response():
                 response = [{"answer": "No model found with given parameters ..."}]
                 return json.dumps(response)
             
+            # Query the history index as of the selected month of the timeline
+            if as_of is None:
+                index, as_of = get_history_index(index)
+
             # Perform ranking
             faq_bert_ranker = FAQ_BERT_Ranker(
-                es=es, index=index, fields=fields, top_k=top_k, bert_model_path=bert_model_path, search_mode='history'
+                es=es, index=index, fields=fields, top_k=top_k, bert_model_path=bert_model_path, search_mode='history', as_of=as_of, score_cache=score_cache
             )
 
             ranked_results = faq_bert_ranker.rank_results(query_string)